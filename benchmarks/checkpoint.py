@@ -0,0 +1,159 @@
+"""
+Benchmarks activation checkpointing of the modules selectable with
+--checkpoint_modules in train.py at reduced sizes.
+
+Reports the forward + backward time and the activation memory held between
+the forward and backward passes with and without checkpointing. On CPU the
+memory is the total size of the tensors saved for backward, on CUDA it's the
+peak allocated memory.
+
+    python benchmarks/checkpoint.py --batch_size 2 --cam_shape 240,320
+"""
+
+import argparse
+import copy
+import time
+from typing import Callable, Dict, List, Set, Tuple
+
+import torch
+from torch import nn
+from torchvision import models
+
+from torchdrive.autograd import activation_checkpoint
+from torchdrive.models.bev import BEVUpsampler, GridTransformer
+from torchdrive.models.simple_bev import ResnetFPN2d
+
+
+def tuple_int(s: str) -> Tuple[int, ...]:
+    return tuple(int(v) for v in s.split(","))
+
+
+def tuple_str(s: str) -> Tuple[str, ...]:
+    return tuple(s.split(","))
+
+
+parser = argparse.ArgumentParser(description="activation checkpointing benchmark")
+parser.add_argument("--batch_size", type=int, default=2)
+parser.add_argument("--cam_shape", type=tuple_int, default=(240, 320))
+parser.add_argument("--bev_shape", type=tuple_int, default=(16, 16))
+parser.add_argument("--dim", type=int, default=96)
+parser.add_argument("--hr_dim", type=int, default=32)
+parser.add_argument("--num_upsamples", type=int, default=2)
+parser.add_argument("--voxel_height", type=int, default=16)
+parser.add_argument("--iters", type=int, default=3)
+parser.add_argument(
+    "--modules",
+    type=tuple_str,
+    default=("cam_encoder", "transformer", "fpn", "upsampler", "voxel_decoder"),
+)
+parser.add_argument("--device", type=str, default="cpu")
+args: argparse.Namespace = parser.parse_args()
+
+device = torch.device(args.device)
+BS: int = args.batch_size
+h, w = args.cam_shape
+feat_shape = (h // 16, w // 16)
+hr_shape = tuple(s * 2**args.num_upsamples for s in args.bev_shape)
+
+
+def cam_encoder() -> nn.Module:
+    # RegNetEncoder trunk without the pretrained weights
+    m = models.regnet_x_400mf()
+    return nn.Sequential(m.stem, *m.trunk_output[:3])
+
+
+# name: (module, inputs)
+MODULES: Dict[str, Tuple[Callable[[], nn.Module], Callable[[], List[object]]]] = {
+    "cam_encoder": (cam_encoder, lambda: [torch.rand(BS, 3, h, w)]),
+    "transformer": (
+        lambda: GridTransformer(
+            input_shape=feat_shape,
+            output_shape=args.bev_shape,
+            input_dim=args.dim,
+            dim=args.dim,
+            num_inputs=1,
+        ),
+        lambda: [[torch.rand(BS, args.dim, *feat_shape, requires_grad=True)]],
+    ),
+    "fpn": (
+        lambda: ResnetFPN2d(args.dim),
+        lambda: [torch.rand(BS, args.dim, *args.bev_shape, requires_grad=True)],
+    ),
+    "upsampler": (
+        lambda: BEVUpsampler(
+            num_upsamples=args.num_upsamples,
+            bev_shape=args.bev_shape,
+            dim=args.dim,
+            output_dim=args.hr_dim,
+        ),
+        lambda: [torch.rand(BS, args.dim, *args.bev_shape, requires_grad=True)],
+    ),
+    # same as the VoxelTask decoder
+    "voxel_decoder": (
+        lambda: nn.Conv2d(args.hr_dim, 4 * args.voxel_height, kernel_size=1),
+        lambda: [torch.rand(BS, args.hr_dim, *hr_shape, requires_grad=True)],
+    ),
+}
+
+
+def output_sum(out: object) -> torch.Tensor:
+    if isinstance(out, torch.Tensor):
+        return out.float().sum()
+    assert isinstance(out, (tuple, list))
+    return sum(output_sum(o) for o in out)
+
+
+def run(m: nn.Module, inputs: List[object]) -> Tuple[float, float]:
+    """
+    Returns the seconds per iteration and activation MB.
+    """
+    storages: Set[int] = set()
+    saved = 0
+
+    def pack(t: torch.Tensor) -> torch.Tensor:
+        nonlocal saved
+        storage = t.untyped_storage()
+        if storage.data_ptr() not in storages:
+            storages.add(storage.data_ptr())
+            saved += storage.nbytes()
+        return t
+
+    # warmup
+    output_sum(m(*inputs)).backward()
+
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    start = time.perf_counter()
+    for i in range(args.iters):
+        if i == 0:
+            with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+                loss = output_sum(m(*inputs))
+        else:
+            loss = output_sum(m(*inputs))
+        loss.backward()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        saved = torch.cuda.max_memory_allocated() - base
+    elapsed = (time.perf_counter() - start) / args.iters
+    return elapsed, saved / 2**20
+
+
+torch.manual_seed(0)
+for name in args.modules:
+    make_module, make_inputs = MODULES[name]
+    base = make_module().to(device)
+    inputs = [
+        [t.to(device) for t in x] if isinstance(x, list) else x.to(device)
+        for x in make_inputs()
+    ]
+    for checkpoint in (False, True):
+        m = copy.deepcopy(base)
+        if checkpoint:
+            activation_checkpoint(m)
+        elapsed, mb = run(m, inputs)
+        print(
+            f"{name:14s} checkpoint={checkpoint!s:5s} "
+            f"{elapsed * 1000:8.1f} ms/iter {mb:8.1f} MB"
+        )
@@ -0,0 +1,163 @@
+"""
+Benchmarks MultiCamDataset throughput on a locally generated synthetic
+dataset.
+
+Reports the items/s, the per stage loading time per item returned in
+Batch.load_times and the resident memory per worker of a DataLoader for each
+number of workers.
+
+    python benchmarks/dataset.py --num_workers 0,2,4 --cameras main,narrow
+
+The dataset is written to --data_dir if it doesn't already contain one so
+repeated runs can skip the encoding.
+"""
+
+import argparse
+import glob
+import os
+import os.path
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from torchdrive.datasets.rice import MultiCamDataset
+from torchdrive.datasets.synthetic import write_dataset
+
+
+def tuple_int(s: str) -> Tuple[int, ...]:
+    return tuple(int(v) for v in s.split(","))
+
+
+def tuple_str(s: str) -> Tuple[str, ...]:
+    return tuple(s.split(","))
+
+
+parser = argparse.ArgumentParser(description="dataset benchmark")
+parser.add_argument("--data_dir", type=str, help="reuse or write the dataset here")
+parser.add_argument("--cameras", type=tuple_str, default=("main",))
+parser.add_argument("--num_drives", type=int, default=2)
+parser.add_argument("--num_frames", type=int, default=180)
+parser.add_argument("--width", type=int, default=1280, help="source video width")
+parser.add_argument("--height", type=int, default=960, help="source video height")
+parser.add_argument("--cam_shape", type=tuple_int, default=(480, 640))
+parser.add_argument("--nframes_per_point", type=int, default=2)
+parser.add_argument("--num_workers", type=tuple_int, default=(0, 2, 4))
+parser.add_argument("--num_items", type=int, default=64)
+parser.add_argument("--num_decode_threads", type=int, default=0)
+parser.add_argument("--batch_remap", default=False, action="store_true")
+args: argparse.Namespace = parser.parse_args()
+
+STAGES = (
+    "info",
+    "cam_T",
+    "offsets",
+    "calibration",
+    "decode",
+    "scale",
+    "remap",
+    "tensor",
+)
+
+
+def rss_mb(pid: int) -> float:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def child_pids() -> List[int]:
+    pids = []
+    for path in glob.glob(f"/proc/{os.getpid()}/task/*/children"):
+        with open(path) as f:
+            pids += [int(pid) for pid in f.read().split()]
+    return pids
+
+
+def run(dataset: MultiCamDataset, num_workers: int) -> None:
+    g = torch.Generator()
+    g.manual_seed(0)
+    idxs = torch.randperm(len(dataset), generator=g)[: args.num_items].tolist()
+    dataloader = DataLoader(
+        Subset(dataset, idxs),
+        batch_size=None,
+        num_workers=num_workers,
+        persistent_workers=False,
+    )
+    it = iter(dataloader)
+    # exclude the worker start up
+    next(it)
+    start = time.perf_counter()
+    count = 0
+    worker_rss: Dict[int, float] = {}
+    times: Dict[str, float] = defaultdict(float)
+    for batch in it:
+        count += 1
+        if batch is not None and batch.load_times is not None:
+            for k, v in batch.load_times.items():
+                # sum the per camera stages
+                times[k.partition("/")[0]] += v
+        for pid in child_pids():
+            try:
+                worker_rss[pid] = max(worker_rss.get(pid, 0.0), rss_mb(pid))
+            except FileNotFoundError:
+                pass
+    elapsed = time.perf_counter() - start
+
+    rss = list(worker_rss.values()) or [rss_mb(os.getpid())]
+    print(
+        f"num_workers={num_workers:2d} {count / elapsed:7.2f} items/s "
+        f"rss/worker mean={sum(rss) / len(rss):7.1f}MB max={max(rss):7.1f}MB "
+        f"main={rss_mb(os.getpid()):7.1f}MB"
+    )
+    # per worker loading time, the decode threads overlap so the stages can
+    # sum to more than the wall time
+    for stage in STAGES:
+        print(f"  {stage:12s} {times[stage] / count * 1000:8.2f} ms/item")
+
+
+def main(root: str) -> None:
+    index_file = os.path.join(root, "index.txt")
+    mask_dir = os.path.join(root, "masks")
+    if not os.path.exists(index_file):
+        print(
+            f"encoding {args.num_drives} drives of {args.num_frames} "
+            f"{args.width}x{args.height} frames for {len(args.cameras)} cameras"
+        )
+        index_file, mask_dir = write_dataset(
+            root,
+            args.num_drives,
+            args.cameras,
+            args.num_frames,
+            width=args.width,
+            height=args.height,
+        )
+
+    torch.set_num_threads(1)
+    dataset = MultiCamDataset(
+        index_file=index_file,
+        mask_dir=mask_dir,
+        cameras=list(args.cameras),
+        dynamic=True,
+        cam_shape=args.cam_shape,
+        nframes_per_point=args.nframes_per_point,
+        batch_remap=args.batch_remap,
+        num_decode_threads=args.num_decode_threads,
+        stage_timing=True,
+    )
+    print(f"{len(dataset)} items")
+
+    for num_workers in args.num_workers:
+        run(dataset, num_workers)
+
+
+if args.data_dir:
+    main(args.data_dir)
+else:
+    with tempfile.TemporaryDirectory() as root:
+        main(root)
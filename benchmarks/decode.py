@@ -0,0 +1,93 @@
+"""
+Benchmarks decoding frames to tensors with MultiCamDataset on a locally
+generated synthetic HEVC clip.
+
+Compares the 16 bit RGB path (rgb48le) with the 8 bit RGB path (rgb24), both
+converted from YUV at the target resolution, and the 8 bit path with a single
+float conversion of the stacked frames.
+
+    python benchmarks/decode.py --cam_shape 480,640
+"""
+
+import argparse
+import os.path
+import tempfile
+import time
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import torch
+
+from torchdrive.datasets.rice import MultiCamDataset, normalize01
+from torchdrive.datasets.synthetic import write_drive, write_masks
+
+
+def tuple_int(s: str) -> Tuple[int, ...]:
+    return tuple(int(v) for v in s.split(","))
+
+
+parser = argparse.ArgumentParser(description="decode benchmark")
+parser.add_argument("--width", type=int, default=1280, help="source video width")
+parser.add_argument("--height", type=int, default=960, help="source video height")
+parser.add_argument("--num_frames", type=int, default=90)
+parser.add_argument("--cam_shape", type=tuple_int, default=(480, 640))
+parser.add_argument("--frames_per_decode", type=int, default=5)
+parser.add_argument("--iters", type=int, default=3)
+args: argparse.Namespace = parser.parse_args()
+
+torch.set_num_threads(1)
+
+with tempfile.TemporaryDirectory() as root:
+    cameras = ["main"]
+    print(f"encoding {args.num_frames} {args.width}x{args.height} frames")
+    path = write_drive(
+        root, "drive", cameras, args.num_frames, width=args.width, height=args.height
+    )
+    mask_dir = os.path.join(root, "masks")
+    write_masks(mask_dir, cameras, args.width, args.height)
+
+    dataset = MultiCamDataset(
+        index_file=os.path.join(root, "index.txt"),
+        mask_dir=mask_dir,
+        cameras=cameras,
+        dynamic=True,
+        cam_shape=args.cam_shape,
+        nframes_per_point=args.frames_per_decode,
+    )
+    starts = range(0, args.num_frames - args.frames_per_decode, 9)
+
+    def decode_rgb48le(frames: List[int]) -> List[torch.Tensor]:
+        return dataset._get_frames(path, "main", frames, fmt="rgb48le")
+
+    def decode_rgb24(frames: List[int]) -> List[torch.Tensor]:
+        return dataset._get_frames(path, "main", frames, fmt="rgb24")
+
+    def decode_rgb24_stacked(frames: List[int]) -> torch.Tensor:
+        # single float conversion of the stacked uint8 frames as in
+        # _get_rect_frames_batched
+        raw = dataset._get_raw_frames(path, "main", frames, None, "rgb24")
+        color = torch.from_numpy(np.stack(raw)).permute(0, 3, 1, 2)
+        color = color.to(torch.float32, memory_format=torch.contiguous_format)
+        return normalize01(color.div_(255))
+
+    decoders: Dict[str, Callable[[List[int]], object]] = {
+        "rgb48le": decode_rgb48le,
+        "rgb24": decode_rgb24,
+        "rgb24 stacked": decode_rgb24_stacked,
+    }
+    for name, decode in decoders.items():
+        # warm up the decoder, graphs and page cache
+        decode(list(range(args.frames_per_decode)))
+
+        start = time.perf_counter()
+        num_frames = 0
+        for _ in range(args.iters):
+            for i in starts:
+                frames = list(range(i, i + args.frames_per_decode))
+                decode(frames)
+                num_frames += len(frames)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name:14s} {num_frames / elapsed:8.1f} frames/s "
+            f"{elapsed / num_frames * 1000:6.2f} ms/frame"
+        )
@@ -0,0 +1,78 @@
+"""
+Converts the drives in a MultiCamDataset into memory-mapped training shards
+for use with torchdrive.datasets.shard.ShardDataset.
+"""
+
+import argparse
+import os
+from multiprocessing import Pool
+from typing import Optional, Tuple
+
+from torchdrive.datasets.rice import MultiCamDataset
+from torchdrive.datasets.shard import try_write_drive_shard
+from tqdm import tqdm
+
+
+def tuple_str(s: str) -> Tuple[str, ...]:
+    return tuple(s.split(","))
+
+
+def tuple_int(s: str) -> Tuple[int, ...]:
+    return tuple(int(v) for v in s.split(","))
+
+
+parser = argparse.ArgumentParser(description="preprocess")
+parser.add_argument("--output", required=True, type=str)
+parser.add_argument("--dataset", type=str, required=True)
+parser.add_argument("--masks", type=str, required=True)
+parser.add_argument("--num_workers", type=int, default=16)
+parser.add_argument(
+    "--cameras",
+    default="main,narrow,fisheye,leftpillar,rightpillar,leftrepeater,rightrepeater,backup",
+    type=tuple_str,
+)
+parser.add_argument("--cam_shape", type=tuple_int, required=True)
+parser.add_argument("--num_encode_frames", type=int, default=3)
+parser.add_argument("--limit_size", type=int)
+parser.add_argument(
+    "--overwrite", default=False, action="store_true", help="rewrite existing shards"
+)
+
+args: argparse.Namespace = parser.parse_args()
+
+os.makedirs(args.output, exist_ok=True)
+
+dataset = MultiCamDataset(
+    index_file=args.dataset,
+    mask_dir=args.masks,
+    cameras=list(args.cameras),
+    dynamic=True,
+    cam_shape=args.cam_shape,
+    # must match train.py
+    nframes_per_point=args.num_encode_frames + 2,
+    limit_size=args.limit_size,
+)
+
+paths = [
+    path
+    for path in dataset.path_heading_bin.keys()
+    if args.overwrite
+    or not os.path.exists(
+        os.path.join(args.output, os.path.basename(os.path.normpath(path)))
+    )
+]
+print(f"writing {len(paths)} drives to {args.output}")
+
+
+def write(path: str) -> Optional[str]:
+    # corrupt drives are logged and skipped
+    return try_write_drive_shard(dataset, path, args.output)
+
+
+failed = 0
+with Pool(args.num_workers) as pool:
+    for shard_dir in tqdm(pool.imap_unordered(write, paths), total=len(paths)):
+        if shard_dir is None:
+            failed += 1
+if failed > 0:
+    print(f"skipped {failed} drives that failed to decode")
@@ -1,8 +1,22 @@
+import functools
 import itertools
 from contextlib import contextmanager
-from typing import cast, Generator, List, Optional, overload, Tuple, TypeVar, Union
+from fnmatch import fnmatchcase
+from typing import (
+    cast,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    overload,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
 import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
 from torch.utils.tensorboard import SummaryWriter
 
 
@@ -108,3 +122,89 @@ def log_grad_norm(
 
     t.register_hook(backward_hook)
     return t
+
+
+@contextmanager
+def _frozen_norm_stats(m: nn.Module) -> Generator[None, None, None]:
+    """
+    Prevents the batch norm layers in m from updating their running statistics.
+    """
+    norms = [
+        norm
+        for norm in m.modules()
+        if isinstance(norm, nn.modules.batchnorm._BatchNorm)
+        and norm.track_running_stats
+        and norm.momentum is not None
+    ]
+    state = []
+    for norm in norms:
+        state.append((norm.momentum, norm.num_batches_tracked.clone()))
+        norm.momentum = 0.0
+    try:
+        yield
+    finally:
+        for norm, (momentum, num_batches_tracked) in zip(norms, state):
+            norm.momentum = momentum
+            norm.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def activation_checkpoint(m: nn.Module) -> nn.Module:
+    """
+    activation_checkpoint enables activation checkpointing for the module in
+    place. The intermediate activations are recomputed during the backwards
+    pass instead of being stored. The module is returned unwrapped so the
+    parameter names and state dicts are unchanged.
+
+    This uses the non-reentrant checkpoint so it works with autograd_pause and
+    autograd_resume. The recomputation runs whenever the backwards pass
+    reaches the module, including from autograd_resume. The batch norm running
+    statistics are only updated by the original forward pass.
+    """
+    forward = m.forward
+
+    @functools.wraps(forward)
+    def checkpointed_forward(*args: object, **kwargs: object) -> object:
+        if not torch.is_grad_enabled():
+            return forward(*args, **kwargs)
+
+        calls = 0
+
+        def run(*args: object, **kwargs: object) -> object:
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                return forward(*args, **kwargs)
+            with _frozen_norm_stats(m):
+                return forward(*args, **kwargs)
+
+        return checkpoint(run, *args, use_reentrant=False, **kwargs)
+
+    m.forward = checkpointed_forward
+    return m
+
+
+def activation_checkpoint_modules(
+    root: nn.Module, patterns: Iterable[str]
+) -> List[str]:
+    """
+    Enables activation_checkpoint for the submodules of root with qualified
+    names matching any of the fnmatch patterns. Wildcards only match a single
+    name component and torch.compile wrappers are skipped over so
+    "camera_encoders.*" matches each compiled camera encoder.
+
+    Returns:
+        the matched module names
+    """
+    patterns = list(patterns)
+    matched = []
+    for name, m in root.named_modules():
+        if hasattr(m, "_orig_mod"):
+            continue
+        name = name.replace("._orig_mod", "")
+        parts = len(name.split("."))
+        for pattern in patterns:
+            if len(pattern.split(".")) == parts and fnmatchcase(name, pattern):
+                matched.append(name)
+                activation_checkpoint(m)
+                break
+    return matched
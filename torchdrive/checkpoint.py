@@ -14,6 +14,15 @@ def similarity(a: str, b: str) -> float:
     return SequenceMatcher(None, a, b).ratio()
 
 
+def checkpoint_interval(checkpoint_every: int, global_batch_size: int) -> int:
+    """
+    checkpoint_interval returns the number of optimizer steps between
+    checkpoints to save every checkpoint_every examples. Batches larger than
+    checkpoint_every (e.g. with gradient accumulation) checkpoint every step.
+    """
+    return max(checkpoint_every // global_batch_size, 1)
+
+
 def remap_state_dict(
     state_dict: Dict[str, torch.Tensor], m: nn.Module, check_suffix: bool = True
 ) -> typing.OrderedDict[str, torch.Tensor]:
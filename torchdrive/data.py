@@ -1,8 +1,11 @@
+import dataclasses
+import math
 from concurrent.futures import Future, ThreadPoolExecutor
-from contextlib import contextmanager
-from dataclasses import dataclass, fields
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, fields, replace
 from typing import (
     Callable,
+    ContextManager,
     Dict,
     Generator,
     Iterator,
@@ -45,6 +48,14 @@ class Batch:
 
     global_batch_size: int = 1
 
+    # optional data loading time in seconds per stage, summed over the examples
+    # in the batch. Only set when the dataset records stage timing.
+    load_times: Optional[Dict[str, float]] = None
+
+    # optional (drive, frame index) of each frame of each example so per frame
+    # results can be reused across examples [BS][num_frames]
+    frame_ids: Optional[List[List[Tuple[str, int]]]] = None
+
     def batch_size(self) -> int:
         return self.weight.numel()
 
@@ -65,6 +76,13 @@ class Batch:
             }
         )
 
+    def replace(self, **changes: object) -> "Batch":
+        """
+        returns a copy of the batch with the specified fields replaced, the
+        same as dataclasses.replace.
+        """
+        return replace(self, **changes)
+
     def split(self, split_size: int) -> List["Batch"]:
         """
         Splits the batch into `split_size` sized pieces.
@@ -75,12 +93,21 @@ class Batch:
         if BS % split_size != 0:
             parts += 1
         for i in range(parts):
-            out.append({"global_batch_size": self.global_batch_size})
+            out.append(
+                {
+                    "global_batch_size": self.global_batch_size,
+                    "load_times": self.load_times,
+                }
+            )
         for field in fields(Batch):
             name = field.name
-            if name == "global_batch_size":
+            if name in ("global_batch_size", "load_times"):
                 continue
             original = getattr(self, name)
+            if original is None:
+                for g in out:
+                    g[name] = None
+                continue
             parts = split(original, split_size)
             for i, p in enumerate(parts):
                 out[i][name] = p
@@ -168,19 +195,53 @@ def _collate_weight(
     return weights
 
 
+def _collate_load_times(
+    times: List[Optional[Dict[str, float]]],
+) -> Optional[Dict[str, float]]:
+    out: Optional[Dict[str, float]] = None
+    for t in times:
+        if t is None:
+            continue
+        if out is None:
+            out = {}
+        for k, v in t.items():
+            out[k] = out.get(k, 0.0) + v
+    return out
+
+
+def _collate_frame_ids(
+    ids: List[Optional[List[List[Tuple[str, int]]]]],
+) -> Optional[List[List[Tuple[str, int]]]]:
+    out = []
+    for i in ids:
+        if i is None:
+            return None
+        out += i
+    return out
+
+
 _COLLATE_FIELDS: Mapping[str, Callable[[object], object]] = {
     "long_cam_T": _collate_long_cam_T,
     "weight": _collate_weight,
     "global_batch_size": sum,
+    "load_times": _collate_load_times,
+    "frame_ids": _collate_frame_ids,
 }
 
+# Batch fields that aren't tensors
+_METADATA_FIELDS: Tuple[str, ...] = ("global_batch_size", "load_times", "frame_ids")
+
 
 def collate(
-    batch: Union[List[Optional[Batch]], List[Batch]], strict: bool = True
+    batch: Union[List[Optional[Batch]], List[Batch]],
+    strict: bool = True,
+    packed: bool = False,
 ) -> Optional[Batch]:
     """
     collate merges a provided set of single example batches and allows some
     examples to be discarded if there's corrupted data.
+
+    If packed is True this returns a PackedBatch.
     """
     BS = len(batch)
     batch = [item for item in batch if item is not None]
@@ -189,6 +250,9 @@ def collate(
             raise RuntimeError(f"not enough data in batch, BS={BS}")
         return None
 
+    if packed:
+        return PackedBatch.collate(batch)
+
     return Batch(
         **{
             field.name: _COLLATE_FIELDS.get(field.name, default_collate)(
@@ -207,6 +271,260 @@ def nonstrict_collate(batch: List[Optional[Batch]]) -> Optional[Batch]:
     return collate(batch, strict=False)
 
 
+def packed_collate(batch: List[Optional[Batch]]) -> Optional[Batch]:
+    """
+    nonstrict_collate that returns a PackedBatch.
+    """
+    return collate(batch, strict=False, packed=True)
+
+
+# (field, key) of each tensor in a Batch. The key is the camera for dict
+# fields, the position for tuple fields and "" for tensor fields.
+_Key = Tuple[str, Union[str, int]]
+# dtype, offset and per example shape of a tensor in a PackedBatch
+_Index = Dict[_Key, Tuple[torch.dtype, int, Tuple[int, ...]]]
+
+
+def _tensors(batch: Batch) -> Dict[_Key, torch.Tensor]:
+    out = {}
+    for field in fields(Batch):
+        name = field.name
+        if name in _METADATA_FIELDS:
+            continue
+        value = getattr(batch, name)
+        if isinstance(value, torch.Tensor):
+            out[(name, "")] = value
+        elif isinstance(value, dict):
+            for key, t in value.items():
+                out[(name, key)] = t
+        elif isinstance(value, tuple):
+            for i, t in enumerate(value):
+                out[(name, i)] = t
+    return out
+
+
+@dataclass(frozen=True)
+class PackedBatch(Batch):
+    """
+    PackedBatch is a Batch where every tensor is a view into one contiguous
+    [BS, M] buffer per dtype, each example's tensors stored in its row.
+
+    Transferring, pinning and splitting operate on the buffers so they're a
+    single operation per dtype instead of one per field and camera. Splits
+    are zero copy views.
+
+    All the Batch accessors work the same. replace() keeps the buffers when
+    the replaced tensors fit in them, e.g. the car position transforms.
+    Batches created with dataclasses.replace or with tensors of a different
+    dtype or shape have no buffers and behave like a regular Batch.
+    """
+
+    buffers: Optional[Dict[torch.dtype, torch.Tensor]] = dataclasses.field(
+        default=None, init=False, repr=False, compare=False
+    )
+    index: Optional[_Index] = dataclasses.field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    @staticmethod
+    def pack(batch: Batch, pin_memory: bool = False) -> "PackedBatch":
+        """
+        Copies a collated batch into a PackedBatch.
+        """
+        tensors = _tensors(batch)
+        BS = batch.batch_size()
+        index, buffers = _allocate(
+            {key: (t.dtype, tuple(t.shape[1:])) for key, t in tensors.items()},
+            BS,
+            batch.device(),
+            pin_memory,
+        )
+        for key, t in tensors.items():
+            dtype, offset, shape = index[key]
+            buffers[dtype][:, offset : offset + math.prod(shape)].copy_(
+                t.reshape(BS, -1)
+            )
+        return _from_buffers(buffers, index, _metadata(batch))
+
+    @staticmethod
+    def collate(items: List[Batch], pin_memory: bool = False) -> "PackedBatch":
+        """
+        Collates single example batches the same as collate directly into the
+        packed buffers.
+        """
+        long_cam_T = _collate_long_cam_T([item.long_cam_T for item in items])
+        examples = []
+        for i, item in enumerate(items):
+            tensors = _tensors(replace(item, long_cam_T=()))
+            for j, t in enumerate(long_cam_T):
+                tensors[("long_cam_T", j)] = t[i]
+            examples.append(tensors)
+
+        index, buffers = _allocate(
+            {key: (t.dtype, tuple(t.shape)) for key, t in examples[0].items()},
+            len(items),
+            items[0].device(),
+            pin_memory,
+        )
+        for i, tensors in enumerate(examples):
+            for key, t in tensors.items():
+                dtype, offset, shape = index[key]
+                buffers[dtype][i, offset : offset + math.prod(shape)].copy_(
+                    t.reshape(-1)
+                )
+
+        batch = _from_buffers(
+            buffers,
+            index,
+            {
+                name: _COLLATE_FIELDS[name]([getattr(item, name) for item in items])
+                for name in _METADATA_FIELDS
+            },
+        )
+        weight = batch.weight
+        # normalize to sum to 1
+        weight /= weight.sum() + 1e-8
+        return batch
+
+    def _with_buffers(
+        self,
+        buffers: Dict[torch.dtype, torch.Tensor],
+        frame_ids: Optional[List[List[Tuple[str, int]]]] = None,
+    ) -> "PackedBatch":
+        index = self.index
+        assert index is not None
+        metadata = _metadata(self)
+        if frame_ids is not None:
+            metadata["frame_ids"] = frame_ids
+        return _from_buffers(buffers, index, metadata)
+
+    def replace(self, **changes: object) -> Batch:
+        """
+        Like Batch.replace but keeps the buffers if every replaced tensor has
+        the same dtype and shape. The buffers holding replaced tensors are
+        copied so the original batch isn't modified, the others are shared.
+        """
+        out = super().replace(**changes)
+        buffers = self.buffers
+        index = self.index
+        if buffers is None or index is None:
+            return out
+        BS = self.batch_size()
+        before = _tensors(self)
+        after = _tensors(out)
+        if after.keys() != before.keys():
+            return out
+        changed = {key: t for key, t in after.items() if t is not before[key]}
+        for key, t in changed.items():
+            dtype, _, shape = index[key]
+            if (
+                t.dtype != dtype
+                or t.shape != (BS, *shape)
+                or t.device != self.device()
+                or t.requires_grad
+            ):
+                return out
+
+        new_buffers = dict(buffers)
+        for dtype in {index[key][0] for key in changed}:
+            new_buffers[dtype] = buffers[dtype].clone()
+        for key, t in changed.items():
+            dtype, offset, shape = index[key]
+            new_buffers[dtype][:, offset : offset + math.prod(shape)].copy_(
+                t.reshape(BS, -1)
+            )
+        return _from_buffers(new_buffers, index, _metadata(out))
+
+    def to(self, device: torch.device) -> Batch:
+        buffers = self.buffers
+        if buffers is None:
+            return super().to(device)
+        return self._with_buffers(
+            {dtype: buf.to(device, non_blocking=True) for dtype, buf in buffers.items()}
+        )
+
+    def pin_memory(self) -> Batch:
+        buffers = self.buffers
+        if buffers is None:
+            return self
+        return self._with_buffers(
+            {dtype: buf.pin_memory() for dtype, buf in buffers.items()}
+        )
+
+    def split(self, split_size: int) -> List[Batch]:
+        buffers = self.buffers
+        if buffers is None:
+            return super().split(split_size)
+        parts = {dtype: torch.split(buf, split_size) for dtype, buf in buffers.items()}
+        num_parts = len(next(iter(parts.values())))
+        frame_ids = self.frame_ids
+        return [
+            self._with_buffers(
+                {dtype: p[i] for dtype, p in parts.items()},
+                (
+                    frame_ids[i * split_size : (i + 1) * split_size]
+                    if frame_ids is not None
+                    else None
+                ),
+            )
+            for i in range(num_parts)
+        ]
+
+
+def _allocate(
+    layout: Mapping[_Key, Tuple[torch.dtype, Tuple[int, ...]]],
+    BS: int,
+    device: torch.device,
+    pin_memory: bool,
+) -> Tuple[_Index, Dict[torch.dtype, torch.Tensor]]:
+    """
+    Assigns each tensor an offset in the buffer for its dtype and allocates
+    the buffers.
+    """
+    index: _Index = {}
+    sizes: Dict[torch.dtype, int] = {}
+    for key, (dtype, shape) in layout.items():
+        offset = sizes.get(dtype, 0)
+        index[key] = (dtype, offset, shape)
+        sizes[dtype] = offset + math.prod(shape)
+    buffers = {
+        dtype: torch.empty(
+            (BS, size), dtype=dtype, device=device, pin_memory=pin_memory
+        )
+        for dtype, size in sizes.items()
+    }
+    return index, buffers
+
+
+def _metadata(batch: Batch) -> Dict[str, object]:
+    return {name: getattr(batch, name) for name in _METADATA_FIELDS}
+
+
+def _from_buffers(
+    buffers: Dict[torch.dtype, torch.Tensor],
+    index: _Index,
+    metadata: Mapping[str, object],
+) -> PackedBatch:
+    """
+    Creates a PackedBatch with views into the buffers.
+    """
+    out: Dict[str, object] = {}
+    for (name, key), (dtype, offset, shape) in index.items():
+        buf = buffers[dtype]
+        t = buf[:, offset : offset + math.prod(shape)].view(buf.size(0), *shape)
+        if isinstance(key, int):
+            out[name] = (*out.get(name, ()), t)
+        elif key == "":
+            out[name] = t
+        else:
+            out.setdefault(name, {})[key] = t
+
+    batch = PackedBatch(**out, **metadata)
+    object.__setattr__(batch, "buffers", buffers)
+    object.__setattr__(batch, "index", index)
+    return batch
+
+
 T = TypeVar("T")
 
 
@@ -225,6 +543,21 @@ def transfer(k: str, x: T, device: torch.device) -> T:
     return x
 
 
+def _map_tensors(fn: Callable[[torch.Tensor], torch.Tensor], x: T) -> T:
+    """
+    applies fn to all tensors in the provided object.
+    """
+    if isinstance(x, torch.Tensor):
+        return fn(x)
+    if isinstance(x, list):
+        return [_map_tensors(fn, i) for i in x]
+    if isinstance(x, tuple):
+        return tuple(_map_tensors(fn, i) for i in x)
+    if isinstance(x, dict):
+        return {key: _map_tensors(fn, value) for key, value in x.items()}
+    return x
+
+
 def split(x: T, split_size: int) -> List[T]:
     """
     split split_size the object into `split_size` pieces.
@@ -249,6 +582,8 @@ def split(x: T, split_size: int) -> List[T]:
                     groups.append([])
                 groups[i].append(v)
         return [tuple(g) for g in groups]
+    elif isinstance(x, list):
+        return [x[i : i + split_size] for i in range(0, len(x), split_size)]
     raise ValueError(f"can't split {x}")
 
 
@@ -330,3 +665,294 @@ class TransferCollator:
 
     def __len__(self) -> int:
         return len(self.dataloader) // self.batch_size
+
+
+class _Buffers:
+    """
+    _Buffers is a set of reusable collate buffers on a single device. Each
+    buffer is only reallocated when the collated shape or dtype changes.
+    """
+
+    def __init__(self, device: torch.device, pin_memory: bool = False) -> None:
+        self.device = device
+        self.pin_memory = pin_memory
+        self.tensors: Dict[Tuple[str, str], torch.Tensor] = {}
+
+    def buffer(
+        self, key: Tuple[str, str], shape: Tuple[int, ...], dtype: torch.dtype
+    ) -> torch.Tensor:
+        """
+        Returns the preallocated buffer for key, reallocating it if the shape
+        or dtype changed.
+        """
+        buf = self.tensors.get(key)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = torch.empty(
+                shape, dtype=dtype, device=self.device, pin_memory=self.pin_memory
+            )
+            self.tensors[key] = buf
+        return buf
+
+    def stack(self, key: Tuple[str, str], tensors: List[torch.Tensor]) -> torch.Tensor:
+        buf = self.buffer(key, (len(tensors), *tensors[0].shape), tensors[0].dtype)
+        for i, t in enumerate(tensors):
+            buf[i].copy_(t, non_blocking=True)
+        return buf
+
+    def stack_group(
+        self, name: str, tensors: Mapping[str, List[torch.Tensor]]
+    ) -> Dict[str, torch.Tensor]:
+        """
+        Stacks the per camera tensors into contiguous views of a single flat
+        buffer so the whole field can be transferred at once.
+        """
+        dtypes = {ts[0].dtype for ts in tensors.values()}
+        if len(dtypes) != 1:
+            return {key: self.stack((name, key), ts) for key, ts in tensors.items()}
+
+        shapes = {key: (len(ts), *ts[0].shape) for key, ts in tensors.items()}
+        numel = sum(math.prod(shape) for shape in shapes.values())
+        flat = self.buffer((name, ""), (numel,), dtypes.pop())
+        out = {}
+        offset = 0
+        for key, ts in tensors.items():
+            shape = shapes[key]
+            size = math.prod(shape)
+            buf = flat[offset : offset + size].view(shape)
+            for i, t in enumerate(ts):
+                buf[i].copy_(t, non_blocking=True)
+            out[key] = buf
+            offset += size
+        return out
+
+    def stack_padded(
+        self, key: Tuple[str, str], tensors: List[torch.Tensor]
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Same as _collate_long_cam_T. The buffers are sized to the longest
+        sequence seen so far so they're only reallocated when that grows.
+        """
+        lens = self.buffer((key[0], "lens"), (len(tensors),), torch.int64)
+        lens.copy_(torch.tensor([t.size(0) for t in tensors]), non_blocking=True)
+        max_len = max(t.size(0) for t in tensors)
+
+        BS = len(tensors)
+        shape = tensors[0].shape[1:]
+        buf = self.tensors.get(key)
+        if (
+            buf is None
+            or buf.shape[0] != BS
+            or buf.shape[1] < max_len
+            or buf.shape[2:] != shape
+            or buf.dtype != tensors[0].dtype
+        ):
+            buf = self.buffer(key, (BS, max_len, *shape), tensors[0].dtype)
+            self.buffer((key[0], "mask"), (BS, max_len), torch.bool)
+        out = buf[:, :max_len]
+        out.zero_()
+        for i, t in enumerate(tensors):
+            out[i, : t.size(0)].copy_(t, non_blocking=True)
+
+        mask = self.tensors[(key[0], "mask")][:, :max_len]
+        torch.lt(
+            torch.arange(max_len, device=self.device).expand(BS, max_len),
+            lens.unsqueeze(1),
+            out=mask,
+        )
+        return (out, mask, lens)
+
+
+class _Slot:
+    """
+    _Slot is a reusable set of collated batch buffers along with the stream
+    they're transferred on and the events that order them with the consumer.
+    """
+
+    def __init__(self, device: torch.device, host_collate: bool) -> None:
+        self.buffers = _Buffers(device)
+        self.host: Optional[_Buffers] = None
+        if host_collate:
+            self.host = _Buffers(torch.device("cpu"), pin_memory=device.type == "cuda")
+        self.stream: Optional[torch.cuda.Stream] = None
+        self.ready: Optional[torch.cuda.Event] = None
+        self.released: Optional[torch.cuda.Event] = None
+        if device.type == "cuda":
+            self.stream = torch.cuda.Stream(device)
+            self.ready = torch.cuda.Event()
+            self.released = torch.cuda.Event()
+
+
+def _collate_into(buffers: _Buffers, items: List[Batch]) -> Batch:
+    """
+    Collates the items the same as collate into the buffers.
+    """
+    out: Dict[str, object] = {}
+    for field in fields(Batch):
+        name = field.name
+        values = [getattr(item, name) for item in items]
+        if name == "long_cam_T":
+            out[name] = buffers.stack_padded((name, ""), values)
+        elif name in _METADATA_FIELDS:
+            out[name] = _COLLATE_FIELDS[name](values)
+        elif isinstance(values[0], dict):
+            out[name] = buffers.stack_group(
+                name, {key: [v[key] for v in values] for key in values[0].keys()}
+            )
+        else:
+            out[name] = buffers.stack((name, ""), values)
+
+    weight = out["weight"]
+    assert isinstance(weight, torch.Tensor)
+    # normalize to sum to 1
+    weight /= weight.sum() + 1e-8
+
+    return Batch(**out)
+
+
+class PrefetchCollator:
+    """
+    PrefetchCollator is a successor to TransferCollator. It takes in a torch
+    DataLoader with a batch size of None and collates the examples directly
+    into a fixed set of preallocated device buffers on a background thread.
+
+    prefetch_depth batches are loaded ahead while the current one is in use
+    so there are prefetch_depth + 1 buffer slots, each with its own reusable
+    CUDA stream. Instead of synchronizing the stream, the consumer's stream
+    waits on an event recorded after the copies and the buffers are only
+    overwritten after an event recorded on the consumer's stream when the
+    next batch is requested. Batches are produced in DataLoader order.
+
+    With host_collate the examples are first collated on the host into pinned
+    buffers, with all cameras of a field sharing one flat buffer, and each
+    buffer is transferred with a single copy instead of one copy per example,
+    field and camera.
+
+    The returned batches are views into the slot buffers so they're only
+    valid until the next batch is requested.
+
+    On CPU the same code path runs without streams and events.
+
+    If the last batch is smaller than batch_size it is discarded.
+    """
+
+    def __init__(
+        self,
+        dataloader: DataLoader[Batch],
+        batch_size: int,
+        device: torch.device,
+        prefetch_depth: int = 2,
+        host_collate: bool = False,
+    ) -> None:
+        assert prefetch_depth > 0, "prefetch_depth must be positive"
+        self.dataloader = dataloader
+        self.batch_size = batch_size
+        self.device = device
+        self.prefetch_depth = prefetch_depth
+        self.slots: List[_Slot] = [
+            _Slot(device, host_collate) for _ in range(prefetch_depth + 1)
+        ]
+        self.futures: List[Future[Tuple[_Slot, Batch]]] = []
+        self.iter: Optional[Iterator[Batch]] = None
+        self.count = 0
+        self.current: Optional[_Slot] = None
+
+        self.pool = ThreadPoolExecutor(max_workers=1)
+
+    def __iter__(self) -> "PrefetchCollator":
+        # wait for any in flight batches from a previous iteration
+        for future in self.futures:
+            future.exception()
+        self.iter = iter(self.dataloader)
+        self.futures = []
+        self.count = 0
+        self._release()
+        return self
+
+    def _release(self) -> None:
+        """
+        Marks the current batch as done once the consumer's queued work
+        completes so its slot can be refilled.
+        """
+        slot = self.current
+        if slot is not None and (released := slot.released) is not None:
+            released.record(torch.cuda.current_stream(self.device))
+        self.current = None
+
+    def _transfer(self, slot: _Slot, batch: Batch) -> Batch:
+        """
+        Copies each host buffer to the device with a single copy and returns
+        the batch with the same views into the device buffers.
+        """
+        host = slot.host
+        assert host is not None
+        device_bufs = {}
+        for key, host_buf in host.tensors.items():
+            buf = slot.buffers.buffer(key, host_buf.shape, host_buf.dtype)
+            buf.copy_(host_buf, non_blocking=True)
+            device_bufs[host_buf.untyped_storage().data_ptr()] = buf
+
+        def view(t: torch.Tensor) -> torch.Tensor:
+            buf = device_bufs[t.untyped_storage().data_ptr()]
+            return buf.as_strided(t.shape, t.stride(), t.storage_offset())
+
+        return Batch(
+            **{
+                field.name: _map_tensors(view, getattr(batch, field.name))
+                for field in fields(Batch)
+            }
+        )
+
+    def _get_batch(self, slot: _Slot) -> Tuple[_Slot, Batch]:
+        it = self.iter
+        assert it, "must have iterator"
+
+        items = []
+        while len(items) < self.batch_size:
+            item = next(it)
+            if item is None:
+                continue
+            if not isinstance(item, Batch):
+                # PooledBatch without pin_memory
+                item = item.to(torch.device("cpu"))
+            items.append(item)
+
+        host = slot.host
+        if host is not None:
+            if (ready := slot.ready) is not None:
+                # the previous copies from the pinned buffers must finish
+                # before they're overwritten
+                ready.synchronize()
+            host_batch = _collate_into(host, items)
+
+        stream = slot.stream
+        ctx: ContextManager[object] = nullcontext()
+        if stream is not None:
+            # pyre-fixme[6]: Optional
+            stream.wait_event(slot.released)
+            ctx = torch.cuda.stream(stream)
+        with ctx:
+            if host is not None:
+                batch = self._transfer(slot, host_batch)
+            else:
+                batch = _collate_into(slot.buffers, items)
+        if stream is not None:
+            # pyre-fixme[16]: Optional
+            slot.ready.record(stream)
+        return slot, batch
+
+    def __next__(self) -> Batch:
+        assert self.iter is not None
+        self._release()
+        while len(self.futures) <= self.prefetch_depth:
+            slot = self.slots[self.count % len(self.slots)]
+            self.futures.append(self.pool.submit(self._get_batch, slot))
+            self.count += 1
+
+        slot, batch = self.futures.pop(0).result()
+        if (ready := slot.ready) is not None:
+            torch.cuda.current_stream(self.device).wait_event(ready)
+        self.current = slot
+        return batch
+
+    def __len__(self) -> int:
+        return len(self.dataloader) // self.batch_size
@@ -0,0 +1,73 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Generic, Hashable, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """
+    LRUCache is a bounded, thread safe, in memory least recently used cache.
+
+    The cache contents and lock are dropped when pickled so a dataset holding
+    one can be sent to DataLoader workers and each worker gets its own empty
+    cache.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[K, V]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> Dict[str, object]:
+        return {"maxsize": self.maxsize}
+
+    def __setstate__(self, state: Dict[str, object]) -> None:
+        self.__init__(state["maxsize"])  # pyre-fixme[6]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._entries
+
+    def get(self, key: K) -> Optional[V]:
+        """
+        Returns the value for key and marks it as recently used.
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: K, value: V) -> None:
+        """
+        Adds the value to the cache and evicts the least recently used entry if
+        the cache is over capacity.
+        """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_create(self, key: K, create: Callable[[], V]) -> V:
+        """
+        Returns the cached value for key or creates and caches a new one.
+
+        create is called outside of the lock so concurrent misses for the same
+        key may both call it.
+        """
+        value = self.get(key)
+        if value is None:
+            value = create()
+            self.put(key, value)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
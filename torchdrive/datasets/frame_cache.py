@@ -0,0 +1,184 @@
+import fcntl
+import hashlib
+import os
+import os.path
+from contextlib import contextmanager
+from typing import Generator, List, Optional, Tuple
+
+import numpy as np
+import numpy.typing
+
+
+@contextmanager
+def file_lock(path: str, blocking: bool = True) -> Generator[bool, None, None]:
+    """
+    file_lock takes an exclusive flock on the provided path so it can be used
+    to coordinate between processes. If blocking is False and the lock is held
+    elsewhere this yields False instead of waiting.
+    """
+    with open(path, "a") as f:
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(f, flags)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class FrameCache:
+    """
+    FrameCache is an on disk LRU cache of decoded and scaled video frames.
+
+    Entries are stored as one .npy file per frame and written atomically so
+    the cache can be safely shared between DataLoader workers and ranks on the
+    same machine. Reads refresh the file mtime which is used as the LRU clock.
+
+    The total size of the entries is tracked in a size file in the cache
+    directory that's updated under a lock file whenever an entry is added or
+    removed, so max_bytes is enforced across all of the processes sharing the
+    directory. Whichever process pushes the total over max_bytes evicts.
+    """
+
+    def __init__(
+        self, cache_dir: str, max_bytes: int, evict_fraction: float = 0.1
+    ) -> None:
+        """
+        Args:
+            cache_dir: directory to store the cached frames in
+            max_bytes: size budget for the cache
+            evict_fraction: fraction of max_bytes to free when evicting
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.evict_fraction = evict_fraction
+
+        self._lock_path: str = os.path.join(cache_dir, "lock")
+        self._size_path: str = os.path.join(cache_dir, "size")
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_path(
+        self, path: str, cam: str, frame: int, dim: Tuple[int, int], fmt: str
+    ) -> str:
+        key = f"{path}:{cam}:{frame}:{dim[0]}x{dim[1]}:{fmt}".encode("utf-8")
+        digest = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + ".npy")
+
+    def get(
+        self, path: str, cam: str, frame: int, dim: Tuple[int, int], fmt: str
+    ) -> Optional[np.typing.NDArray[np.generic]]:
+        """
+        Returns the cached frame or None if it's not present.
+        """
+        entry = self._entry_path(path, cam, frame, dim, fmt)
+        try:
+            arr = np.load(entry)
+            os.utime(entry)
+        except (FileNotFoundError, ValueError, EOFError):
+            # missing or evicted between the load and the utime
+            return None
+        return arr
+
+    def put(
+        self,
+        path: str,
+        cam: str,
+        frame: int,
+        dim: Tuple[int, int],
+        fmt: str,
+        arr: np.typing.NDArray[np.generic],
+    ) -> None:
+        """
+        Adds the frame to the cache, evicting old entries if needed.
+        """
+        entry = self._entry_path(path, cam, frame, dim, fmt)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = f"{entry}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, arr)
+        size = os.path.getsize(tmp)
+
+        with file_lock(self._lock_path):
+            total = self._read_size()
+            try:
+                # overwriting an existing entry only changes the total by the
+                # difference
+                size -= os.path.getsize(entry)
+            except FileNotFoundError:
+                pass
+            os.replace(tmp, entry)
+            total += size
+            if total > self.max_bytes:
+                total = self._evict_locked()
+            self._write_size(total)
+
+    def _read_size(self) -> int:
+        """
+        Returns the total size from the size file, recomputing it from the
+        entries if it's missing. Must hold the lock.
+        """
+        try:
+            with open(self._size_path, "r") as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return self.size()
+
+    def _write_size(self, total: int) -> None:
+        with open(self._size_path, "w") as f:
+            f.write(str(total))
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        entries = []
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if not entry.name.endswith(".npy"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def size(self) -> int:
+        """
+        Returns the total size of the cache on disk in bytes.
+        """
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used entries until the cache is under
+        budget.
+        """
+        with file_lock(self._lock_path):
+            self._write_size(self._evict_locked())
+
+    def _evict_locked(self) -> int:
+        """
+        Removes the least recently used entries if the cache is over budget
+        and returns the new total size. Must hold the lock.
+        """
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            return total
+        target = self.max_bytes * (1 - self.evict_fraction)
+        entries.sort()
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
@@ -0,0 +1,231 @@
+import queue
+import uuid
+from dataclasses import dataclass, fields, replace
+from typing import Dict, Mapping, Optional, Tuple
+
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import Dataset, get_worker_info
+
+from torchdrive.data import Batch
+
+# pools in the current process by id so PooledBatches only need to carry the
+# id and slot through the DataLoader queues
+_POOLS: Dict[str, "FramePool"] = {}
+
+
+class FramePool:
+    """
+    FramePool is a preallocated pool of shared memory slots for the camera
+    frames of a single example.
+
+    DataLoader workers copy the frames of each example into a free slot and
+    only send the slot index back to the main process. The main process copies
+    the frames out of the slot, typically into pinned memory, and returns the
+    slot to the free queue. This avoids allocating a new shared memory segment
+    and passing its file descriptor for every camera of every example.
+
+    The pool must be created before the DataLoader workers are started. Since
+    workers block when there are no free slots, num_slots must be at least
+    slots_needed() for the DataLoader settings. Workers raise an error instead
+    of blocking forever if no slot is freed within timeout seconds.
+
+    Slots of PooledBatches that are dropped without being copied out, e.g.
+    when the loop exits early, are released when they're garbage collected.
+    Examples still in the DataLoader queues when its iterator is shut down are
+    lost so reset() should be called before each new iterator.
+    """
+
+    def __init__(
+        self,
+        num_slots: int,
+        shapes: Mapping[str, Tuple[int, ...]],
+        dtype: torch.dtype,
+        timeout: float = 300,
+    ) -> None:
+        """
+        Args:
+            num_slots: number of examples that can be in flight
+            shapes: the per camera color shape of an example, [N, 3, H, W]
+            dtype: the color dtype
+            timeout: seconds to wait for a free slot before raising
+        """
+        self.id: str = uuid.uuid4().hex
+        self.num_slots = num_slots
+        self.shapes: Dict[str, Tuple[int, ...]] = dict(shapes)
+        self.dtype = dtype
+        self.timeout = timeout
+        self.color: Dict[str, torch.Tensor] = {
+            cam: torch.empty((num_slots, *shape), dtype=dtype).share_memory_()
+            for cam, shape in self.shapes.items()
+        }
+        self.generation = 0
+        self.free: "mp.Queue[int]" = self._new_queue()
+        _POOLS[self.id] = self
+
+    def __setstate__(self, state: Dict[str, object]) -> None:
+        self.__dict__.update(state)
+        _POOLS[self.id] = self
+
+    @staticmethod
+    def slots_needed(num_workers: int, prefetch_factor: int, pin_memory: bool) -> int:
+        """
+        Returns the number of slots needed for a DataLoader with the specified
+        settings, the examples prefetched by the workers plus the one being
+        copied by the pin memory thread.
+        """
+        in_flight = max(num_workers * prefetch_factor, 1)
+        if pin_memory:
+            in_flight += 1
+        return in_flight
+
+    def _new_queue(self) -> "mp.Queue[int]":
+        free: "mp.Queue[int]" = mp.Queue()
+        for slot in range(self.num_slots):
+            free.put(slot)
+        return free
+
+    def reset(self) -> None:
+        """
+        Marks all slots as free. Must be called in the main process before the
+        DataLoader workers are started and after any previous workers have
+        exited. Slots from PooledBatches created before the reset aren't
+        released again.
+        """
+        self.generation += 1
+        self.free = self._new_queue()
+
+    def acquire(self, timeout: Optional[float] = None) -> int:
+        """
+        Returns a free slot, blocking until one is available or raising after
+        timeout seconds, the pool's timeout if unspecified.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            return self.free.get(timeout=timeout)
+        except queue.Empty:
+            raise RuntimeError(
+                f"no free FramePool slots after {timeout}s, num_slots "
+                f"({self.num_slots}) must be at least the number of examples "
+                "in flight, see FramePool.slots_needed"
+            ) from None
+
+    def release(self, slot: int, generation: Optional[int] = None) -> None:
+        """
+        Returns the slot to the pool. Slots acquired before the last reset()
+        are ignored.
+        """
+        if generation is not None and generation != self.generation:
+            return
+        self.free.put(slot)
+
+    def put(self, batch: Batch) -> "PooledBatch":
+        """
+        Copies the batch's color into a free slot and returns the batch
+        without color and the slot.
+        """
+        if batch.color.keys() != self.shapes.keys():
+            raise ValueError(f"expected cameras {self.shapes.keys()}")
+        slot = self.acquire()
+        try:
+            for cam, color in batch.color.items():
+                self.color[cam][slot].copy_(color)
+        except Exception:
+            self.release(slot)
+            raise
+        pooled = PooledBatch(
+            batch=replace(batch, color={}),
+            pool_id=self.id,
+            slot=slot,
+            generation=self.generation,
+        )
+        # batches from workers are owned by the process that unpickles them
+        pooled.__dict__["_owned"] = get_worker_info() is None
+        return pooled
+
+    def take(
+        self, slot: int, pin_memory: bool = False, generation: Optional[int] = None
+    ) -> Dict[str, torch.Tensor]:
+        """
+        Copies the color out of the slot and releases it.
+        """
+        try:
+            color = {}
+            for cam, shape in self.shapes.items():
+                out = torch.empty(shape, dtype=self.dtype, pin_memory=pin_memory)
+                color[cam] = out.copy_(self.color[cam][slot])
+        finally:
+            self.release(slot, generation)
+        return color
+
+
+@dataclass(frozen=True)
+class PooledBatch:
+    """
+    PooledBatch is a Batch with the color stored in a FramePool slot.
+
+    The DataLoader calls pin_memory() on it in the main process when
+    pin_memory is enabled, which copies the color directly from the slot into
+    pinned memory and returns the complete Batch.
+
+    If a PooledBatch received from a worker is garbage collected before the
+    color is taken its slot is released.
+    """
+
+    batch: Batch
+    pool_id: str
+    slot: int
+    generation: int = 0
+
+    def __getstate__(self) -> Dict[str, object]:
+        return {f.name: getattr(self, f.name) for f in fields(self)}
+
+    def __setstate__(self, state: Dict[str, object]) -> None:
+        self.__dict__.update(state)
+        # only the receiving process owns the slot, the sender drops its copy
+        self.__dict__["_owned"] = True
+
+    def __del__(self) -> None:
+        if self.__dict__.get("_owned") and not self.__dict__.get("_taken"):
+            if (pool := _POOLS.get(self.pool_id)) is not None:
+                pool.release(self.slot, self.generation)
+
+    def _take(self, pin_memory: bool) -> Batch:
+        if self.__dict__.get("_taken"):
+            raise RuntimeError("PooledBatch color was already taken")
+        self.__dict__["_taken"] = True
+        color = _POOLS[self.pool_id].take(
+            self.slot, pin_memory=pin_memory, generation=self.generation
+        )
+        return replace(self.batch, color=color)
+
+    def pin_memory(self) -> Batch:
+        return self._take(pin_memory=True)
+
+    def to(self, device: torch.device) -> Batch:
+        """
+        returns the batch transferred to the specified device and releases the
+        slot.
+        """
+        return self._take(pin_memory=False).to(device)
+
+
+class PooledDataset(Dataset):
+    """
+    PooledDataset wraps a dataset that returns Batches and returns the
+    examples as PooledBatches with the color in the FramePool.
+    """
+
+    def __init__(self, dataset: Dataset, pool: FramePool) -> None:
+        self.dataset = dataset
+        self.pool = pool
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def __getitem__(self, idx: int) -> Optional[PooledBatch]:
+        batch = self.dataset[idx]
+        if batch is None:
+            return None
+        return self.pool.put(batch)
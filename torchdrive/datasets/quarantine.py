@@ -0,0 +1,62 @@
+import os
+import os.path
+import threading
+from typing import Dict, Set, Tuple
+
+import orjson
+
+from torchdrive.datasets.frame_cache import file_lock
+
+
+class Quarantine:
+    """
+    Quarantine is a persistent list of (path, frame) examples that failed to
+    load. It's stored as a JSON lines file that DataLoader workers on all
+    ranks append to so the failing examples can be excluded from the index the
+    next time the dataset is created instead of being decoded every epoch.
+
+    Entries added in this process are also tracked in memory. The in memory
+    entries and lock are reloaded from the file when pickled.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries: Set[Tuple[str, int]] = set()
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        entry = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        # partially written line from a killed worker
+                        continue
+                    self.entries.add((entry["path"], entry["frame"]))
+
+    def __getstate__(self) -> Dict[str, object]:
+        return {"path": self.path}
+
+    def __setstate__(self, state: Dict[str, object]) -> None:
+        self.__init__(state["path"])  # pyre-fixme[6]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: Tuple[str, int]) -> bool:
+        return key in self.entries
+
+    def add(self, path: str, frame: int, error: str) -> None:
+        """
+        Records that the example starting at frame in path failed to load.
+        """
+        with self._lock:
+            if (path, frame) in self.entries:
+                return
+            self.entries.add((path, frame))
+
+        line = orjson.dumps({"path": path, "frame": frame, "error": error}) + b"\n"
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with file_lock(self.path + ".lock"), open(self.path, "ab") as f:
+            f.write(line)
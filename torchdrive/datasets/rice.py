@@ -1,12 +1,28 @@
 import functools
 import glob
-import io
+import hashlib
 import logging
+import mmap
 import os
 import os.path
 import random
 from collections import defaultdict
-from typing import Callable, cast, Dict, List, Mapping, Optional, Sequence, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass, replace
+from typing import (
+    Callable,
+    cast,
+    ContextManager,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import av
 import cv2
@@ -22,16 +38,45 @@ from torch.utils.data import Dataset
 from torchvision import transforms
 
 from torchdrive.data import Batch
-from torchdrive.transforms.mat import transformation_from_parameters
+from torchdrive.datasets.cache import LRUCache
+from torchdrive.datasets.frame_cache import file_lock, FrameCache
+from torchdrive.datasets.quarantine import Quarantine
+from torchdrive.datasets.timing import StageTimer
+from torchdrive.transforms.img import COLOR_MEAN, COLOR_STD
+from torchdrive.transforms.mat import (
+    cumulative_transform,
+    transformation_from_parameters,
+)
 
 av.logging.set_level(logging.DEBUG)  # pyre-fixme
 
 KPH_TO_MPS: float = 1000 / (60 * 60)
 FPS = 36
 
+# value each decoded pixel format is divided by to get into the 0-1 range
+FORMAT_SCALE: Dict[str, int] = {
+    "rgb48le": 2**16,
+    "rgb24": 255,
+}
+
+# AV_INPUT_BUFFER_PADDING_SIZE
+PACKET_PADDING = 64
+
+# bump when the index format or sample selection changes
+INDEX_VERSION = 1
+
 SPEED_BINS = [15, 30, 45, 60, 80]
 HEADING_BINS = [5, 15, 45, 90, 180]
 
+# undistort remap tables (map1, map2), rectified mask, K and T for a camera
+RectCalibration = Tuple[
+    np.typing.NDArray[np.int16],
+    np.typing.NDArray[np.uint16],
+    torch.Tensor,
+    torch.Tensor,
+    torch.Tensor,
+]
+
 
 def compute_bin(v: float, bins: List[int]) -> int:
     for b in bins:
@@ -40,6 +85,40 @@ def compute_bin(v: float, bins: List[int]) -> int:
     return -1
 
 
+def _mmap_file(path: str) -> mmap.mmap:
+    """
+    Memory maps the file read only. The mapping stays valid after the file is
+    closed.
+    """
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _create_decoder() -> av.CodecContext:
+    """
+    Creates a raw HEVC decoder that packets can be fed to directly without a
+    container.
+    """
+    return av.CodecContext.create("hevc", "r")
+
+
+# errors from corrupt or truncated videos, these skip the example
+DECODE_ERRORS = (
+    RuntimeError,
+    av.error.InvalidDataError,
+    IndexError,
+    av.error.MemoryError,
+)
+
+
+def _check_decode_error(e: Exception) -> None:
+    """
+    Reraises RuntimeErrors that didn't come from decoding.
+    """
+    if isinstance(e, RuntimeError) and "Stream.decode" not in str(e):
+        raise e
+
+
 def bin_weights(bins: Dict[int, int]) -> Dict[int, float]:
     mean = sum(bins.values()) / len(bins)
     return {k: mean / v for k, v in bins.items()}
@@ -83,8 +162,8 @@ def useful_array(
 def normalize01(tensor: Tensor) -> Tensor:
     return transforms.functional.normalize(
         tensor,
-        [0.3504, 0.4324, 0.2892],
-        [0.0863, 0.1097, 0.0764],
+        COLOR_MEAN,
+        COLOR_STD,
         inplace=True,
     )
 
@@ -106,6 +185,49 @@ def heading_diff(a: float, b: float) -> float:
     return diff
 
 
+# h265 path, start index, packet offsets, packet sizes
+Offsets = Tuple[str, int, Sequence[int], Sequence[int]]
+
+INFO_FIELDS: Dict[str, float] = {
+    "Speed": KPH_TO_MPS,
+    "SteeringAngle": 1,
+    "SteeringAngleOffset": 1,
+    "PitchRate": 1,
+    "RollRate": 1,
+    "YawRate": 1,
+}
+
+
+@dataclass
+class DriveMetadata:
+    """
+    DriveMetadata is the parsed metadata for a single drive that's needed to
+    load examples from it.
+
+    Args:
+        infos: the scaled INFO_FIELDS as [frame_count] float32 arrays
+        alignment: the frame offset of each camera
+        offsets: the packet offsets for each camera
+        frame_T: [frame_count, 4, 4] the car transform between each frame
+        cam_T: [frame_count, 4, 4] float64 car transform relative to the start
+            of the drive
+    """
+
+    infos: Dict[str, np.typing.NDArray[np.float32]]
+    alignment: Dict[str, int]
+    offsets: Dict[str, Offsets]
+    frame_T: torch.Tensor
+    cam_T: torch.Tensor
+
+    def relative_cam_T(self, idx: int) -> torch.Tensor:
+        """
+        Returns the car transforms from idx to the end of the drive relative
+        to the car position at idx.
+        """
+        cam_T = self.cam_T[idx:]
+        return cam_T[0].inverse().matmul(cam_T).float()
+
+
 class MultiCamDataset(Dataset):
     CAMERA_OVERLAP = {
         "main": ["narrow", "fisheye"],
@@ -130,12 +252,70 @@ class MultiCamDataset(Dataset):
         nframes_per_point: int = 2,
         limit_size: Optional[int] = None,
         dtype: torch.dtype = torch.bfloat16,
+        frame_cache: Optional[FrameCache] = None,
+        calibration_cache_size: int = 32,
+        calibration_cache_dir: Optional[str] = None,
+        batch_remap: bool = False,
+        index_cache_dir: Optional[str] = None,
+        decoder_cache_size: int = 16,
+        num_decode_threads: int = 0,
+        drive_cache_size: int = 16,
+        stage_timing: bool = False,
+        quarantine_file: Optional[str] = None,
+        replace_failed: int = 0,
+        uint8_color: bool = False,
     ) -> None:
+        """
+        Args:
+            frame_cache: optional on disk cache for decoded frames
+            calibration_cache_size: number of (drive, camera) undistortion
+                maps to keep in memory per worker
+            calibration_cache_dir: optional directory to persist the
+                undistortion maps in
+            batch_remap: decode and remap each camera's frames as uint8 into
+                a single buffer and normalize them once. This uses 8 bit
+                instead of 16 bit color.
+            index_cache_dir: optional directory to cache the dataset index in.
+                Drives are only reindexed when their source files change.
+            decoder_cache_size: number of (drive, camera) HEVC decoders and
+                memory mapped video files to keep open per worker
+            num_decode_threads: if greater than zero, decode and rectify the
+                cameras for each item concurrently using a per worker thread
+                pool of this size
+            drive_cache_size: number of drives to keep the parsed metadata
+                (infos, poses, alignment and offsets) in memory for per worker
+            stage_timing: record the time spent in each loading stage and
+                return it in Batch.load_times. The camera stages are recorded
+                per camera as "<stage>/<camera>".
+            quarantine_file: optional JSON lines file to record the examples
+                that fail to load in. Recorded examples are excluded from the
+                index and skipped without decoding.
+            replace_failed: number of nearby examples from the same drive to
+                try in place of an example that fails to load before
+                returning None
+            uint8_color: return color as unnormalized uint8 instead of
+                normalized dtype to reduce the IPC and host to device bytes.
+                The frames are decoded and remapped as in batch_remap and
+                need to be normalized on device with NormalizeColor.
+        """
         self.frames: List[Tuple[str, int]] = []
         self.dynamic = dynamic
         self.dim: Tuple[int, int] = tuple(reversed(cam_shape))
         self.nframes_per_point = nframes_per_point
         self.dtype = dtype
+        self.frame_cache = frame_cache
+        self.calibration_cache: LRUCache[Tuple[str, str], RectCalibration] = LRUCache(
+            calibration_cache_size
+        )
+        self.calibration_cache_dir = calibration_cache_dir
+        self.batch_remap = batch_remap
+        self.uint8_color = uint8_color
+        self.decoders: LRUCache[Tuple[str, str], av.CodecContext] = LRUCache(
+            decoder_cache_size
+        )
+        self.packet_files: LRUCache[str, mmap.mmap] = LRUCache(decoder_cache_size)
+        self.drive_cache: LRUCache[str, DriveMetadata] = LRUCache(drive_cache_size)
+        self.timer = StageTimer(enabled=stage_timing)
 
         self.cameras = cameras
 
@@ -152,54 +332,73 @@ class MultiCamDataset(Dataset):
         DROP_LAST_N = 20 + self.nframes_per_point
         if not dynamic:
             DROP_LAST_N += 30
-        MIN_DIST_M = 10
 
-        for path in indexes:
-            path = os.path.dirname(path)
-            infos = self._get_raw_infos(path, 0, -1)
-            if infos is None or len(infos) == 0:
-                continue
-            frame_counts = [len(infos)]
-            try:
-                for camera in self.cameras:
-                    _, _, offsets, _ = self._load_offsets(path, camera)
-                    frame_counts.append(len(offsets))
-            except FileNotFoundError:
-                continue
-            frame_count = min(frame_counts)
-            infos = infos[:frame_count]
-            self.per_path_frame_count[path] = frame_count
-
-            speeds = []
-            for i in range(DROP_FIRST_N, frame_count - DROP_LAST_N):
-                info = infos[i]
-                speed = info["Speed"]
-                if speed < 5 or speed > 80:  # kph
+        index_cache_path = None
+        lock: ContextManager[bool] = nullcontext(True)
+        if index_cache_dir is not None:
+            os.makedirs(index_cache_dir, exist_ok=True)
+            key = orjson.dumps(
+                [INDEX_VERSION, root, self.cameras, DROP_FIRST_N, DROP_LAST_N]
+            )
+            digest = hashlib.sha1(key).hexdigest()
+            index_cache_path = os.path.join(index_cache_dir, f"index_{digest}.json")
+            # only one rank/process builds the index, the rest wait and load it
+            lock = file_lock(index_cache_path + ".lock")
+
+        with lock:
+            cached: Dict[str, Dict[str, object]] = {}
+            if index_cache_path is not None and os.path.exists(index_cache_path):
+                with open(index_cache_path, "rb") as f:
+                    data = orjson.loads(f.read())
+                if data["version"] == INDEX_VERSION:
+                    cached = data["paths"]
+            dirty = False
+
+            for path in indexes:
+                path = os.path.dirname(path)
+                mtimes = self._index_mtimes(path)
+                if mtimes is None:
                     continue
-
-                # minimum travel distance
-                dist = sum(infos[j]["Speed"] / FPS for j in range(i, frame_count))
-                if dist < MIN_DIST_M:
+                entry = cached.get(path)
+                if entry is None or entry["mtimes"] != mtimes:
+                    entry = self._index_path(path, DROP_FIRST_N, DROP_LAST_N)
+                    entry["mtimes"] = mtimes
+                    cached[path] = entry
+                    dirty = True
+
+                frame_count = entry["frame_count"]
+                if frame_count is None:
                     continue
+                self.per_path_frame_count[path] = frame_count
 
-                speeds.append(speed)
-
-                self.frames.append((path, i))
-
-            if len(speeds) == 0:
-                continue
-            heading_change = heading_diff(
-                infos[0]["Heading"],
-                infos[-1]["Heading"],
-            )
-            speed = sum(speeds) / len(speeds)
-            self.speed_bins[compute_bin(speed, SPEED_BINS)] += 1
-            heading_bin = compute_bin(heading_change, HEADING_BINS)
-            self.heading_bins[heading_bin] += 1
-            self.path_heading_bin[path] = heading_bin
-
-            if limit_size is not None and len(self.frames) > limit_size:
-                break
+                speed = entry["speed"]
+                if speed is None:
+                    continue
+                for i in entry["frames"]:
+                    self.frames.append((path, i))
+                self.speed_bins[compute_bin(speed, SPEED_BINS)] += 1
+                heading_bin = compute_bin(entry["heading_change"], HEADING_BINS)
+                self.heading_bins[heading_bin] += 1
+                self.path_heading_bin[path] = heading_bin
+
+                if limit_size is not None and len(self.frames) > limit_size:
+                    break
+
+            if index_cache_path is not None and dirty:
+                tmp = f"{index_cache_path}.{os.getpid()}.tmp"
+                with open(tmp, "wb") as f:
+                    f.write(orjson.dumps({"version": INDEX_VERSION, "paths": cached}))
+                os.replace(tmp, index_cache_path)
+
+        self.quarantine: Optional[Quarantine] = None
+        if quarantine_file is not None:
+            self.quarantine = Quarantine(quarantine_file)
+            num_frames = len(self.frames)
+            self.frames = [key for key in self.frames if key not in self.quarantine]
+            if len(self.frames) < num_frames:
+                print(f"quarantined {num_frames - len(self.frames)} examples")
+        self.replace_failed = replace_failed
+        self._frame_idxs: Optional[Dict[Tuple[str, int], int]] = None
 
         self.heading_weights: Dict[int, float] = bin_weights(self.heading_bins)
         print("heading_weights", self.heading_weights)
@@ -209,6 +408,16 @@ class MultiCamDataset(Dataset):
 
         self._load_masks(mask_dir)
 
+        # filter graphs aren't thread safe so each camera gets its own
+        self.graphs: Dict[str, Graph] = {
+            camera: self._create_graph() for camera in self.cameras
+        }
+
+        self.num_decode_threads = num_decode_threads
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._pool_pid: Optional[int] = None
+
+    def _create_graph(self) -> Graph:
         graph = Graph()
         link_nodes(
             graph.add_buffer(
@@ -219,7 +428,83 @@ class MultiCamDataset(Dataset):
             graph.add("buffersink"),
         )
         graph.configure()
-        self.graph: Graph = graph
+        return graph
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        """
+        Returns the thread pool used to decode cameras in parallel. This is
+        created lazily so each DataLoader worker gets its own.
+        """
+        pid = os.getpid()
+        if self._pool is None or self._pool_pid != pid:
+            self._pool = ThreadPoolExecutor(
+                max_workers=self.num_decode_threads,
+                thread_name_prefix="decode",
+            )
+            self._pool_pid = pid
+        return self._pool
+
+    def _index_mtimes(self, path: str) -> Optional[List[int]]:
+        """
+        Returns the modification times of the files used to build the index
+        entry for the drive or None if any are missing.
+        """
+        files = [os.path.join(path, "info_noradar.json")] + [
+            os.path.join(path, f"{camera}_index.csv") for camera in self.cameras
+        ]
+        try:
+            return [os.stat(file).st_mtime_ns for file in files]
+        except FileNotFoundError:
+            return None
+
+    def _index_path(
+        self, path: str, drop_first_n: int, drop_last_n: int
+    ) -> Dict[str, object]:
+        """
+        Computes the index entry for a single drive. This contains the frame
+        count, the valid sample frames and the stats used for weighting.
+        """
+        MIN_DIST_M = 10
+
+        entry: Dict[str, object] = {
+            "frame_count": None,
+            "frames": [],
+            "speed": None,
+            "heading_change": None,
+        }
+        infos = self._get_raw_infos(path, 0, -1)
+        if infos is None or len(infos) == 0:
+            return entry
+        frame_counts = [len(infos)]
+        for camera in self.cameras:
+            _, _, offsets, _ = self._read_offsets(path, camera)
+            frame_counts.append(len(offsets))
+        frame_count = min(frame_counts)
+        infos = infos[:frame_count]
+        entry["frame_count"] = frame_count
+
+        speeds = np.array([info["Speed"] for info in infos], dtype=np.float64)
+        # distance traveled from each frame to the end of the drive
+        dists = np.cumsum(speeds[::-1] / FPS)[::-1]
+
+        idxs = np.arange(drop_first_n, max(frame_count - drop_last_n, drop_first_n))
+        valid = (
+            (speeds[idxs] >= 5)  # kph
+            & (speeds[idxs] <= 80)
+            # minimum travel distance
+            & (dists[idxs] >= MIN_DIST_M)
+        )
+        idxs = idxs[valid]
+        if len(idxs) == 0:
+            return entry
+
+        entry["frames"] = idxs.tolist()
+        entry["speed"] = float(speeds[idxs].mean())
+        entry["heading_change"] = heading_diff(
+            infos[0]["Heading"],
+            infos[-1]["Heading"],
+        )
+        return entry
 
     def _load_masks(self, mask_dir: str) -> None:
         # load masks
@@ -270,10 +555,10 @@ class MultiCamDataset(Dataset):
 
         return K, D, T
 
-    @functools.lru_cache(maxsize=16)  # noqa: B019
-    def _load_offsets(
-        self, path: str, cam: str
-    ) -> Tuple[str, int, Sequence[int], Sequence[int]]:
+    def _load_offsets(self, path: str, cam: str) -> Offsets:
+        return self._get_drive(path).offsets[cam]
+
+    def _read_offsets(self, path: str, cam: str) -> Offsets:
         index_path = os.path.join(path, f"{cam}_index.csv")
         with open(index_path, "rt") as f:
             first_line = f.readline()
@@ -304,7 +589,42 @@ class MultiCamDataset(Dataset):
         cam: str,
         frames: Union[List[int], torch.Tensor],
         dim: Optional[Tuple[int, int]] = None,
+        normalize: bool = True,
+        fmt: str = "rgb48le",
     ) -> List[torch.Tensor]:
+        """
+        Returns the decoded frames. If normalize is False the frames are left
+        in the 0-1 range instead of being normalized via normalize01.
+
+        fmt is the decoded pixel format, rgb24 skips the 16 bit RGB conversion
+        at the cost of color depth.
+        """
+        num_frames = len(frames)
+        out = []
+        stage = f"tensor/{cam}"
+        for arr in self._get_raw_frames(path, cam, frames, dim, fmt):
+            with self.timer.stage(stage):
+                color = torch.from_numpy(arr.astype(np.float32)).permute(2, 0, 1)
+                color.div_(FORMAT_SCALE[fmt])
+                if normalize:
+                    color = normalize01(color)
+            out.append(color)
+
+        assert len(out) == num_frames, f"{len(out)}, {num_frames}"
+        return out
+
+    def _get_raw_frames(
+        self,
+        path: str,
+        cam: str,
+        frames: Union[List[int], torch.Tensor],
+        dim: Optional[Tuple[int, int]],
+        fmt: str,
+    ) -> List[np.typing.NDArray[np.generic]]:
+        """
+        Returns the decoded and scaled frames as [h, w, 3] arrays in the
+        specified pixel format (rgb48le or rgb24).
+        """
         num_frames = len(frames)
         assert num_frames > 0, "got zero frames requested"
         if dim is None:
@@ -314,6 +634,55 @@ class MultiCamDataset(Dataset):
         assert max(frames) < len(offsets), f"{frames}, {len(offsets)}"
 
         frames = list(frames) if isinstance(frames, list) else frames.tolist()
+
+        decoded: Dict[int, np.typing.NDArray[np.generic]] = {}
+        cache = self.frame_cache
+        if cache is not None:
+            for frame in frames:
+                arr = cache.get(path, cam, frame, dim, fmt)
+                if arr is not None:
+                    decoded[frame] = arr
+        missing = [frame for frame in frames if frame not in decoded]
+
+        if len(missing) > 0:
+            self._decode_frames(
+                h265_path,
+                path,
+                cam,
+                missing,
+                dim,
+                fmt,
+                start_i,
+                offsets,
+                sizes,
+                decoded,
+            )
+
+        return [decoded[frame] for frame in frames]
+
+    def _decode_frames(
+        self,
+        h265_path: str,
+        path: str,
+        cam: str,
+        frames: List[int],
+        dim: Tuple[int, int],
+        fmt: str,
+        start_i: int,
+        offsets: Sequence[int],
+        sizes: Sequence[int],
+        out: Dict[int, np.typing.NDArray[np.generic]],
+    ) -> None:
+        """
+        Decodes the specified frames starting from the nearest iframes and
+        writes the scaled frames into out.
+
+        If there's a frame cache this decodes through to the end of the last
+        GOP and caches every decoded frame since neighboring samples are likely
+        to need them.
+        """
+        cache = self.frame_cache
+
         decode_idxs = []
         cur_frame = -1
         for frame in frames:
@@ -323,56 +692,106 @@ class MultiCamDataset(Dataset):
             else:
                 decode_idxs += list(range(cur_frame + 1, frame + 1))
             cur_frame = frame
+        if cache is not None:
+            gop_end = min(self._nearest_iframe(cur_frame, start_i) + 9, len(offsets))
+            decode_idxs += list(range(cur_frame + 1, gop_end))
 
-        with io.BytesIO() as data:
-            with open(h265_path, "rb") as f:
-                for idx in decode_idxs:
-                    offset = offsets[idx]
-                    size = sizes[idx]
-                    f.seek(offset)
-                    buf = f.read(size)
-                    assert len(buf) == size
-                    data.write(buf)
-
-            data.seek(0)
-            nbytes = data.getbuffer().nbytes
-            assert nbytes > 0
-
-            out = []
-            with av.open(data, format="hevc") as vid:
-                # todo seek to each frame
-                idx = 0
-                for frame in vid.decode():
-                    if idx == 0 and not frame.key_frame:
-                        raise IndexError(f"{h265_path} first frame not iframe {frame}")
-                    frame_idx = decode_idxs[idx]
-                    if frame_idx in frames:
-                        self.graph.push(frame)
-                        frame = self.graph.pull()
-                        frame = frame.reformat(format="rgb48le")
-                        frame = frame.to_ndarray()
-                        frame = (
-                            torch.from_numpy(frame.astype(np.float32))
-                            .permute(2, 0, 1)
-                            .div_(2**16)
-                        )
-                        out.append(normalize01(frame))
-                    idx += 1
-                    if idx >= len(decode_idxs):
-                        break
-
-        assert len(out) == num_frames, f"{len(out)}, {num_frames}"
-        return out
+        wanted = set(frames)
+        data = self.packet_files.get_or_create(
+            h265_path, functools.partial(_mmap_file, h265_path)
+        )
+        view = memoryview(data)
+        decoder = self.decoders.get_or_create((path, cam), _create_decoder)
+        graph = self.graphs[cam]
+        timer = self.timer
+        decode_stage = f"decode/{cam}"
+        scale_stage = f"scale/{cam}"
+
+        idx = 0
+
+        def handle(frames: List[av.VideoFrame]) -> None:
+            nonlocal idx
+            for frame in frames:
+                if idx >= len(decode_idxs):
+                    return
+                if idx == 0 and not frame.key_frame:
+                    raise IndexError(f"{h265_path} first frame not iframe {frame}")
+                frame_idx = decode_idxs[idx]
+                if frame_idx in wanted or cache is not None:
+                    with timer.stage(scale_stage):
+                        graph.push(frame)
+                        frame = graph.pull()
+                        frame = frame.reformat(format=fmt)
+                        arr = frame.to_ndarray()
+                    if cache is not None:
+                        cache.put(path, cam, frame_idx, dim, fmt, arr)
+                    if frame_idx in wanted:
+                        out[frame_idx] = arr
+                idx += 1
 
-    def _get_rect_frames(
-        self, path: str, cam: str, frames: List[int]
-    ) -> Tuple[List[torch.Tensor], torch.Tensor, torch.Tensor, torch.Tensor]:
+        try:
+            for i, frame_idx in enumerate(decode_idxs):
+                offset = offsets[frame_idx]
+                size = sizes[frame_idx]
+                end = offset + size
+                if end > len(data):
+                    raise IndexError(f"{h265_path} truncated")
+                if end + PACKET_PADDING <= len(data):
+                    # the packet references the mapped file without copying
+                    packet = av.Packet(view[offset:end])
+                else:
+                    # decoders may read past the end of the packet so copy
+                    # the tail of the file into a padded buffer
+                    padded = bytearray(size + PACKET_PADDING)
+                    padded[:size] = view[offset:end]
+                    packet = av.Packet(memoryview(padded)[:size])
+                packet.pts = i
+                with timer.stage(decode_stage):
+                    decoded = decoder.decode(packet)
+                handle(decoded)
+            # drain any delayed frames
+            with timer.stage(decode_stage):
+                decoded = decoder.decode(None)
+            handle(decoded)
+        finally:
+            # reset the decoder and release the reference frames so it can be
+            # reused from the next iframe
+            decoder.flush_buffers()
+
+        assert idx == len(decode_idxs), f"{h265_path} decoded {idx}/{len(decode_idxs)}"
+
+    def _get_rect_calibration(self, path: str, cam: str) -> RectCalibration:
         """
-        returns rectified frame, mask and calibrations
+        returns the undistortion remap tables, rectified mask, rectified K and
+        T for the camera.
+
+        The calibration is fixed per drive and camera so this is cached per
+        worker and optionally on disk.
         """
-        K, D, T = self._get_calibration(path, cam)
+        return self.calibration_cache.get_or_create(
+            (path, cam), lambda: self._load_rect_calibration(path, cam)
+        )
+
+    def _load_rect_calibration(self, path: str, cam: str) -> RectCalibration:
+        cache_path = None
+        if self.calibration_cache_dir is not None:
+            stat = os.stat(os.path.join(path, f"field_calibration_{cam}.json"))
+            key = f"{path}:{cam}:{self.dim[0]}x{self.dim[1]}:{stat.st_mtime_ns}"
+            digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+            cache_path = os.path.join(self.calibration_cache_dir, digest + ".npz")
+            try:
+                with np.load(cache_path) as data:
+                    return (
+                        data["map1"],
+                        data["map2"],
+                        torch.from_numpy(data["mask"]),
+                        torch.from_numpy(data["K"]),
+                        torch.from_numpy(data["T"]),
+                    )
+            except FileNotFoundError:
+                pass
 
-        mask = self.masks[cam]
+        K, D, T = self._get_calibration(path, cam)
 
         K = K.clone().numpy()[:3, :3]
         # convert to image space
@@ -394,18 +813,92 @@ class MultiCamDataset(Dataset):
         K[2, 2] = 1
         K[3, 3] = 1
 
+        mask = cv2_remap(self.masks[cam], map1, map2, border_mode=cv2.BORDER_CONSTANT)
+
+        if cache_path is not None:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                np.savez(
+                    f,
+                    map1=map1,
+                    map2=map2,
+                    mask=mask.numpy(),
+                    K=K.numpy(),
+                    T=T.numpy(),
+                )
+            os.replace(tmp, cache_path)
+
+        return map1, map2, mask, K, T
+
+    def _get_rect_frames(
+        self, path: str, cam: str, frames: List[int], normalize: bool = True
+    ) -> Tuple[List[torch.Tensor], torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        returns rectified frame, mask and calibrations
+        """
+        with self.timer.stage(f"calibration/{cam}"):
+            map1, map2, mask, K, T = self._get_rect_calibration(path, cam)
+
         out = []
-        for frame in self._get_frames(path, cam, frames):
-            if cam == "backup":
-                # fill in the black part of the backup camera frame with mean
-                # color to avoid screwing up normalization
-                maxes = frame.mean(dim=(1, 2))
-                frame[:, self.dim[0] // 3 * 2 :, :] = maxes.reshape(3, 1, 1)
-            frame = cv2_remap(frame, map1, map2, border_mode=cv2.BORDER_REPLICATE)
+        stage = f"remap/{cam}"
+        for frame in self._get_frames(path, cam, frames, normalize=normalize):
+            with self.timer.stage(stage):
+                if cam == "backup":
+                    # fill in the black part of the backup camera frame with
+                    # mean color to avoid screwing up normalization
+                    maxes = frame.mean(dim=(1, 2))
+                    frame[:, self.dim[0] // 3 * 2 :, :] = maxes.reshape(3, 1, 1)
+                frame = cv2_remap(frame, map1, map2, border_mode=cv2.BORDER_REPLICATE)
             out.append(frame)
 
-        mask = cv2_remap(mask, map1, map2, border_mode=cv2.BORDER_CONSTANT)
-        return out, mask, K, T
+        return out, mask.clone(), K.clone(), T.clone()
+
+    def _get_rect_frames_batched(
+        self, path: str, cam: str, frames: List[int], normalize: bool = True
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        returns rectified frames as a single normalized [N, 3, h, w] tensor,
+        mask and calibrations.
+
+        Unlike _get_rect_frames this decodes to 8 bit RGB and keeps the frames
+        as uint8 through the remap into a single stacked buffer. The float
+        conversion and normalization run once on the stacked frames. If
+        normalize is False the frames are returned as uint8.
+        """
+        with self.timer.stage(f"calibration/{cam}"):
+            map1, map2, mask, K, T = self._get_rect_calibration(path, cam)
+
+        w, h = self.dim
+        raw = self._get_raw_frames(path, cam, frames, self.dim, "rgb24")
+        out = np.empty((len(raw), h, w, 3), dtype=np.uint8)
+        with self.timer.stage(f"remap/{cam}"):
+            for i, frame in enumerate(raw):
+                if cam == "backup":
+                    # fill in the black part of the backup camera frame with
+                    # mean color to avoid screwing up normalization
+                    frame = frame.copy()
+                    maxes = frame.mean(axis=(0, 1))
+                    frame[self.dim[0] // 3 * 2 :, :] = maxes.round()
+                cv2.remap(
+                    frame,
+                    map1,
+                    map2,
+                    dst=out[i],
+                    interpolation=cv2.INTER_CUBIC,
+                    borderMode=cv2.BORDER_REPLICATE,
+                )
+
+        with self.timer.stage(f"tensor/{cam}"):
+            color = torch.from_numpy(out).permute(0, 3, 1, 2)
+            if normalize:
+                color = color.to(
+                    torch.float32, memory_format=torch.contiguous_format
+                ).div_(255)
+                color = normalize01(color)
+            else:
+                color = color.contiguous()
+        return color, mask.clone(), K.clone(), T.clone()
 
     def _get_info(self, path: str, idx: int) -> Dict[str, object]:
         info_path = os.path.join(path, f"info_{idx:03d}.json")
@@ -413,20 +906,128 @@ class MultiCamDataset(Dataset):
             return orjson.loads(f.read())
 
     def __getitem__(self, idx: int) -> Optional[Batch]:
+        return self._load_first(self._candidates(idx))
+
+    def _load_first(self, candidates: Iterator[int]) -> Optional[Batch]:
+        for i in candidates:
+            batch = self._load_example(i)
+            if batch is not None:
+                return batch
+        return None
+
+    def _is_quarantined(self, idx: int) -> bool:
+        quarantine = self.quarantine
+        return quarantine is not None and self.frames[idx] in quarantine
+
+    def _candidates(self, idx: int) -> Iterator[int]:
+        """
+        Yields idx followed by up to replace_failed nearby examples from the
+        same drive to load if it fails. The replacements are spaced so they
+        don't share any frames or GOPs with the failing example. Quarantined
+        examples are skipped.
+        """
+        if not self._is_quarantined(idx):
+            yield idx
+
+        path, _ = self.frames[idx]
+        yield from self._replacements(path, idx)
+
+    def _replacements(self, path: str, idx: int) -> Iterator[int]:
+        """
+        Yields up to replace_failed non quarantined examples from path, in
+        order of distance from idx.
+        """
+        step = self.nframes_per_point + 9
+        remaining = self.replace_failed
+        offset = step
+        while remaining > 0:
+            in_drive = False
+            for i in (idx + offset, idx - offset):
+                if i < 0 or i >= len(self.frames) or self.frames[i][0] != path:
+                    continue
+                in_drive = True
+                if remaining > 0 and not self._is_quarantined(i):
+                    remaining -= 1
+                    yield i
+            if not in_drive:
+                return
+            offset += step
+
+    def _load_example(self, idx: int) -> Optional[Batch]:
+        timer = self.timer
+        if timer.enabled:
+            # drop the times from any previously failed example
+            timer.pop()
         try:
-            return self._getitem(idx)
-        except RuntimeError as e:
-            if "Stream.decode" not in str(e):
-                raise
-            print(e)
-        except av.error.InvalidDataError as e:
+            batch = self._getitem(idx)
+        except DECODE_ERRORS as e:
+            _check_decode_error(e)
             print(e)
-        except IndexError as e:
-            print(e)
-        except av.error.MemoryError as e:
+            if (quarantine := self.quarantine) is not None:
+                path, frame = self.frames[idx]
+                quarantine.add(path, frame, repr(e))
+            return None
+        if timer.enabled:
+            batch = replace(batch, load_times=timer.pop())
+        return batch
+
+    def _frame_candidates(self, path: str, frame: int) -> Iterator[int]:
+        """
+        Like _candidates but for the example starting at frame in path. If the
+        example was quarantined before the index was loaded only the
+        replacements around where it would have been are yielded.
+        """
+        frame_idxs = self._frame_idxs
+        if frame_idxs is None:
+            frame_idxs = {key: i for i, key in enumerate(self.frames)}
+            self._frame_idxs = frame_idxs
+        idx = frame_idxs.get((path, frame))
+        if idx is not None:
+            return self._candidates(idx)
+
+        # the index is sorted by frame within each drive so the examples
+        # after the missing one start at the next indexed frame
+        frame_count = self.per_path_frame_count[path]
+        for i in range(frame + 1, frame_count):
+            if (idx := frame_idxs.get((path, i))) is not None:
+                return self._replacements(path, idx)
+        for i in range(frame - 1, -1, -1):
+            if (idx := frame_idxs.get((path, i))) is not None:
+                return self._replacements(path, idx + 1)
+        return iter(())
+
+    def get_window(self, path: str, idxs: List[int]) -> Sequence[Optional[Batch]]:
+        """
+        Returns the examples starting at each of the frame idxs in path,
+        decoding the shared frames only once. This is only supported in
+        dynamic mode.
+
+        Like __getitem__, all of the examples are None if decoding fails. If
+        there's a quarantine or replacement policy the examples are instead
+        loaded one at a time so only the failing ones are affected and they're
+        replaced the same way as __getitem__, including examples that were
+        quarantined when the index was loaded. The stage times for the shared
+        decode are attached to the first example.
+        """
+        timer = self.timer
+        if timer.enabled:
+            timer.pop()
+        try:
+            batches = self._get_window(path, idxs)
+            if timer.enabled:
+                batches[0] = replace(batches[0], load_times=timer.pop())
+            return batches
+        except DECODE_ERRORS as e:
+            _check_decode_error(e)
             print(e)
+        if self.quarantine is not None or self.replace_failed > 0:
+            return [self._load_first(self._frame_candidates(path, idx)) for idx in idxs]
+        return [None] * len(idxs)
 
     def _get_alignment(self, path: str) -> Dict[str, int]:
+        return self._get_drive(path).alignment
+
+    def _read_alignment(self, path: str) -> Dict[str, int]:
         path = os.path.join(path, "alignment.json")
         with open(path, "rb") as f:
             return orjson.loads(f.read())
@@ -442,60 +1043,81 @@ class MultiCamDataset(Dataset):
             return info[a:b]
 
     def _get_infos(self, path: str, a: int, b: int) -> Dict[str, torch.Tensor]:
-        fields = {
-            "Speed": KPH_TO_MPS,
-            "SteeringAngle": 1,
-            "SteeringAngleOffset": 1,
-            "PitchRate": 1,
-            "RollRate": 1,
-            "YawRate": 1,
-        }
-        out = defaultdict(lambda: [])
-        raw_infos = self._get_raw_infos(path, a, b)
-        assert raw_infos is not None
-        for info in raw_infos:
-            for k, scale in fields.items():
-                out[k].append(info[k] * scale)
-        return {k: torch.tensor(v, dtype=torch.float) for k, v in out.items()}
-
-    def _cam_T(self, infos: Dict[str, torch.Tensor]) -> Tuple[Tensor, Tensor]:
-        frames = len(infos["Speed"])
-        speed = infos["Speed"] / FPS
-        roll = infos["RollRate"] / FPS
-        pitch = infos["PitchRate"] / FPS
-        yaw = infos["YawRate"] / FPS
-
-        translation = torch.zeros(frames, 3, dtype=torch.float)
+        infos = self._get_drive(path).infos
+        return {k: torch.from_numpy(v[a:b]) for k, v in infos.items()}
+
+    def _get_drive(self, path: str) -> DriveMetadata:
+        return self.drive_cache.get_or_create(
+            path, functools.partial(self._load_drive, path)
+        )
+
+    def _load_drive(self, path: str) -> DriveMetadata:
+        """
+        Parses the metadata for the drive. The infos are truncated to the
+        frame count from the index.
+        """
+        frame_count = self.per_path_frame_count[path]
+        with self.timer.stage("info"):
+            raw_infos = self._get_raw_infos(path, 0, frame_count)
+            assert raw_infos is not None
+            infos = {
+                k: (np.array([info[k] for info in raw_infos]) * scale).astype(
+                    np.float32
+                )
+                for k, scale in INFO_FIELDS.items()
+            }
+        with self.timer.stage("cam_T"):
+            frame_T = self._frame_T(infos)
+            cam_T = cumulative_transform(frame_T.double())
+        with self.timer.stage("offsets"):
+            alignment = self._read_alignment(path)
+            offsets = {
+                cam: self._read_offsets(path, cam)
+                for cam in set(self.cameras) | {"main"}
+            }
+
+        return DriveMetadata(
+            infos=infos,
+            alignment=alignment,
+            offsets=offsets,
+            frame_T=frame_T,
+            cam_T=cam_T,
+        )
+
+    def _frame_T(self, infos: Mapping[str, np.typing.NDArray[np.float32]]) -> Tensor:
+        """
+        Returns the car transform between each frame.
+        """
+        speed = torch.from_numpy(infos["Speed"]) / FPS
+        roll = torch.from_numpy(infos["RollRate"]) / FPS
+        pitch = torch.from_numpy(infos["PitchRate"]) / FPS
+        yaw = torch.from_numpy(infos["YawRate"]) / FPS
+
+        translation = torch.zeros(len(speed), 3, dtype=torch.float)
         translation[:, 0] = speed
 
         axisangle = torch.stack((roll, pitch, yaw), dim=1)
         assert translation.shape == axisangle.shape, translation.shape
 
-        frame_T = transformation_from_parameters(
+        return transformation_from_parameters(
             axisangle.unsqueeze(1), translation.unsqueeze(1), invert=True
         )
 
-        cam_T = torch.zeros(frames, 4, 4, dtype=torch.float)
-        cam_T[0] = torch.eye(4)
-        for i in range(1, frames):
-            cam_T[i] = torch.matmul(cam_T[i - 1], frame_T[i - 1])
-        return cam_T, frame_T
-
     def _getitem(self, idx: int) -> Batch:
         path: str
-        camera: str
         idx: int
         path, idx = self.frames[idx]
 
         # metadata
         frame_count = self.per_path_frame_count[path]
-        infos = self._get_infos(path, idx, frame_count)
-        alignment: Mapping[str, int] = self._get_alignment(path)
+        drive = self._get_drive(path)
+        with self.timer.stage("info"):
+            infos = self._get_infos(path, idx, frame_count)
 
         speeds = infos["Speed"]
         dists = (speeds / FPS).cumsum(dim=0)
 
-        _, start_i, _, _ = self._load_offsets(path, "main")
+        _, start_i, _, _ = drive.offsets["main"]
 
         max_dist = 65
         max_idxs = (dists > max_dist).nonzero()
@@ -525,37 +1147,96 @@ class MultiCamDataset(Dataset):
         if len(set(frames)) != len(frames):
             raise RuntimeError(f"duplicate frame index in {frames}")
 
-        cam_Ts, frame_T = self._cam_T(infos)
+        Ks, Ts, colors, masks = self._load_cameras(path, frames)
+        return self._make_batch(path, idx, frames, Ks, Ts, colors, masks)
 
-        info_idxs = [i - idx for i in frames]
-        dists = dists[info_idxs]
-        cam_T = cam_Ts[info_idxs]
-        frame_T = frame_T[info_idxs]
-        frame_time = torch.tensor(info_idxs, dtype=torch.float) / 36
+    def _load_cameras(self, path: str, frames: List[int]) -> Tuple[
+        Dict[str, torch.Tensor],
+        Dict[str, torch.Tensor],
+        Dict[str, torch.Tensor],
+        Dict[str, torch.Tensor],
+    ]:
+        """
+        Loads the rectified frames for each camera.
+
+        Returns:
+            Ks, Ts, colors, masks
+        """
+        alignment: Mapping[str, int] = self._get_drive(path).alignment
 
         Ks: Dict[str, torch.Tensor] = {}
         Ts: Dict[str, torch.Tensor] = {}
         colors: Dict[str, torch.Tensor] = {}
         masks: Dict[str, torch.Tensor] = {}
 
-        def load(cam: str, frames: List[int]) -> None:
-            label = cam
-
+        def load(
+            cam: str, frames: List[int]
+        ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
             # align camera frames
             cam_alignment = alignment[cam]
             assert cam_alignment >= 0
             frames = [i - cam_alignment for i in frames]
 
-            color, mask, K, T = self._get_rect_frames(path, cam, frames)
+            if self.uint8_color:
+                color, mask, K, T = self._get_rect_frames_batched(
+                    path, cam, frames, normalize=False
+                )
+            elif self.batch_remap:
+                color, mask, K, T = self._get_rect_frames_batched(path, cam, frames)
+            else:
+                frame_colors, mask, K, T = self._get_rect_frames(path, cam, frames)
+                color = torch.stack(frame_colors)
             # mask[:, 0:240, :] = 0
+            if not self.uint8_color:
+                with self.timer.stage(f"tensor/{cam}"):
+                    color = color.to(self.dtype)
+            return color, mask.to(self.dtype), K, T
+
+        if self.num_decode_threads > 0:
+            pool = self._get_pool()
+            futures = [pool.submit(load, camera, frames) for camera in self.cameras]
+            results = [future.result() for future in futures]
+        else:
+            results = [load(camera, frames) for camera in self.cameras]
+
+        for label, (color, mask, K, T) in zip(self.cameras, results):
             Ks[label] = K
             # out["inv_K", label] = K.pinverse()
             Ts[label] = T
-            colors[label] = torch.stack(color).to(self.dtype)
-            masks[label] = mask.to(self.dtype)
+            colors[label] = color
+            masks[label] = mask
 
-        for camera in self.cameras:
-            load(camera, frames)
+        return Ks, Ts, colors, masks
+
+    def _make_batch(
+        self,
+        path: str,
+        idx: int,
+        frames: List[int],
+        Ks: Dict[str, torch.Tensor],
+        Ts: Dict[str, torch.Tensor],
+        colors: Dict[str, torch.Tensor],
+        masks: Dict[str, torch.Tensor],
+    ) -> Batch:
+        """
+        Creates the Batch for the example starting at idx from the loaded
+        camera frames.
+        """
+        frame_count = self.per_path_frame_count[path]
+        drive = self._get_drive(path)
+        with self.timer.stage("info"):
+            infos = self._get_infos(path, idx, frame_count)
+            dists = (infos["Speed"] / FPS).cumsum(dim=0)
+
+        with self.timer.stage("cam_T"):
+            cam_Ts = drive.relative_cam_T(idx)
+            frame_T = drive.frame_T[idx:]
+
+        info_idxs = [i - idx for i in frames]
+        dists = dists[info_idxs]
+        cam_T = cam_Ts[info_idxs]
+        frame_T = frame_T[info_idxs]
+        frame_time = torch.tensor(info_idxs, dtype=torch.float) / 36
 
         return Batch(
             weight=torch.tensor(self.heading_weights[self.path_heading_bin[path]]),
@@ -568,4 +1249,38 @@ class MultiCamDataset(Dataset):
             distances=dists,
             frame_T=frame_T,
             frame_time=frame_time,
+            frame_ids=[[(path, frame) for frame in frames]],
         )
+
+    def _get_window(self, path: str, idxs: List[int]) -> List[Batch]:
+        """
+        Returns the dynamic examples starting at each of idxs. The frames for
+        all of the examples are decoded in a single pass and shared. Frames
+        between the examples that none of them use are decoded but not
+        rectified.
+        """
+        assert self.dynamic, "windows are only supported in dynamic mode"
+        frames = sorted(
+            {i for idx in idxs for i in range(idx, idx + self.nframes_per_point)}
+        )
+        Ks, Ts, colors, masks = self._load_cameras(path, frames)
+        positions = {frame: i for i, frame in enumerate(frames)}
+
+        batches = []
+        for idx in idxs:
+            offset = positions[idx]
+            batches.append(
+                self._make_batch(
+                    path,
+                    idx,
+                    frames[offset : offset + self.nframes_per_point],
+                    Ks={cam: K.clone() for cam, K in Ks.items()},
+                    Ts={cam: T.clone() for cam, T in Ts.items()},
+                    colors={
+                        cam: color[offset : offset + self.nframes_per_point].clone()
+                        for cam, color in colors.items()
+                    },
+                    masks={cam: mask.clone() for cam, mask in masks.items()},
+                )
+            )
+        return batches
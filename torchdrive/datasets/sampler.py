@@ -0,0 +1,101 @@
+from collections import defaultdict
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+import torch
+from torch.utils.data import Sampler
+
+
+class LocalitySampler(Sampler[int]):
+    """
+    LocalitySampler is a distributed sampler that shuffles contiguous chunks
+    of each drive instead of individual examples.
+
+    Examples are grouped into chunks of chunk_size frames from the same drive.
+    The chunk order is shuffled and the examples within each chunk are
+    shuffled. Each rank gets a contiguous range of the shuffled chunks which is
+    split into one lane per DataLoader worker. The lanes are interleaved to
+    match the round robin order the DataLoader hands out indexes in, so each
+    worker reads a few drives at a time. This lets the workers reuse open
+    files, decoders, calibrations and decoded GOPs.
+
+    When the DataLoader batches the examples in the workers, batch_size must
+    match so each batch is taken from a single lane and the batches are
+    interleaved instead of the examples.
+
+    Like DistributedSampler with drop_last=True, every rank gets the same
+    number of examples and set_epoch must be called to change the order.
+    """
+
+    def __init__(
+        self,
+        frames: Sequence[Tuple[str, int]],
+        num_replicas: int = 1,
+        rank: int = 0,
+        seed: int = 0,
+        chunk_size: int = 9 * 4,
+        num_workers: int = 0,
+        shuffle_within_chunk: bool = True,
+        batch_size: int = 1,
+    ) -> None:
+        """
+        Args:
+            frames: the (path, frame) of each example, i.e. dataset.frames
+            num_replicas: number of distributed processes
+            rank: rank of the current process
+            seed: random seed, must be the same on all ranks
+            chunk_size: number of frames per chunk, should be a multiple of
+                the GOP size
+            num_workers: number of DataLoader workers
+            shuffle_within_chunk: shuffle the examples within each chunk
+            batch_size: the DataLoader batch size, 1 if it doesn't batch
+        """
+        assert 0 <= rank < num_replicas, f"invalid rank {rank}"
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.num_lanes: int = max(num_workers, 1)
+        self.shuffle_within_chunk = shuffle_within_chunk
+        self.batch_size = batch_size
+
+        chunks: Dict[Tuple[str, int], List[int]] = defaultdict(list)
+        for i, (path, frame) in enumerate(frames):
+            chunks[path, frame // chunk_size].append(i)
+        self.chunks: List[List[int]] = [
+            sorted(idxs, key=lambda i: frames[i][1]) for idxs in chunks.values()
+        ]
+
+        num_samples = len(frames) // num_replicas
+        self.num_samples: int = num_samples - num_samples % (
+            self.num_lanes * batch_size
+        )
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        return self.num_samples
+
+    def __iter__(self) -> Iterator[int]:
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+
+        indices: List[int] = []
+        for chunk_idx in torch.randperm(len(self.chunks), generator=g).tolist():
+            chunk = self.chunks[chunk_idx]
+            if self.shuffle_within_chunk:
+                perm = torch.randperm(len(chunk), generator=g).tolist()
+                chunk = [chunk[i] for i in perm]
+            indices += chunk
+
+        start = self.rank * (len(indices) // self.num_replicas)
+        indices = indices[start : start + self.num_samples]
+
+        lane_size = self.num_samples // self.num_lanes
+        lanes = [
+            indices[i * lane_size : (i + 1) * lane_size] for i in range(self.num_lanes)
+        ]
+        bs = self.batch_size
+        for step in range(0, lane_size, bs):
+            for lane in lanes:
+                yield from lane[step : step + bs]
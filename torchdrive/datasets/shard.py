@@ -0,0 +1,310 @@
+"""
+Memory-mapped training shards for MultiCamDataset.
+
+A shard is a directory per drive containing the decoded, rectified camera
+frames as uint8 arrays along with the masks, calibrations and per frame car
+transforms. This moves all of the decoding, scaling and remapping out of the
+training loop. Shards are written by preprocess.py and read by ShardDataset.
+
+Layout of each drive directory:
+
+    meta.json           drive metadata and the valid sample indexes
+    speed.npy           [frame_count] car speed in m/s
+    frame_T.npy         [frame_count, 4, 4] per frame car relative transform
+    cam_T.npy           [frame_count, 4, 4] float64 cumulative car transform
+    {cam}_color.npy     [cam_frames, 3, h, w] uint8 rectified frames, the
+                        frames before the first iframe are zero
+    {cam}_mask.npy      [1, h, w] rectified mask
+    {cam}_K.npy         [4, 4] rectified intrinsics
+    {cam}_T.npy         [4, 4] extrinsics
+"""
+
+import os
+import os.path
+import shutil
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import numpy.typing
+import orjson
+import torch
+from torch.utils.data import Dataset
+
+from torchdrive.data import Batch
+from torchdrive.datasets.rice import (
+    _check_decode_error,
+    bin_weights,
+    DECODE_ERRORS,
+    FPS,
+    MultiCamDataset,
+    normalize01,
+)
+
+SHARD_VERSION = 1
+
+
+def write_drive_shard(
+    dataset: MultiCamDataset, path: str, output: str, chunk_size: int = 9 * 4
+) -> str:
+    """
+    Decodes and rectifies all frames for the specified drive and writes them
+    into a shard directory under output.
+
+    Args:
+        dataset: the source dataset, used for decoding and calibration
+        path: the drive path, must be in dataset.per_path_frame_count
+        output: directory to write the shard into
+        chunk_size: number of frames to decode at a time, should be a multiple
+            of the GOP size
+    Returns:
+        the shard directory
+    """
+    frame_count = dataset.per_path_frame_count[path]
+    name = os.path.basename(os.path.normpath(path))
+    shard_dir = os.path.join(output, name)
+    tmp_dir = shard_dir + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    drive = dataset._get_drive(path)
+    # cumulative transform from the start of the drive, per sample transforms
+    # are computed relative to this at load time
+    np.save(os.path.join(tmp_dir, "speed.npy"), drive.infos["Speed"])
+    np.save(os.path.join(tmp_dir, "frame_T.npy"), drive.frame_T.numpy())
+    np.save(os.path.join(tmp_dir, "cam_T.npy"), drive.cam_T.numpy())
+
+    alignment = drive.alignment
+    first_frames: Dict[str, int] = {}
+    h, w = reversed(dataset.dim)
+    for cam in dataset.cameras:
+        _, start_i, offsets, _ = drive.offsets[cam]
+        cam_frames = min(frame_count - alignment[cam], len(offsets))
+        # the frames before the first iframe can't be decoded and are left
+        # zeroed, samples using them are dropped below
+        first_frame = dataset._nearest_iframe(max(start_i, 0) + 8, start_i)
+        first_frames[cam] = first_frame
+        color = np.lib.format.open_memmap(
+            os.path.join(tmp_dir, f"{cam}_color.npy"),
+            mode="w+",
+            dtype=np.uint8,
+            shape=(cam_frames, 3, h, w),
+        )
+        mask = K = T = None
+        for start in range(first_frame, cam_frames, chunk_size):
+            frames = list(range(start, min(start + chunk_size, cam_frames)))
+            out, mask, K, T = dataset._get_rect_frames(
+                path, cam, frames, normalize=False
+            )
+            color[start : start + len(frames)] = (
+                torch.stack(out).mul_(255).round_().clamp_(0, 255).byte().numpy()
+            )
+        color.flush()
+        del color
+        assert mask is not None and K is not None and T is not None
+        np.save(os.path.join(tmp_dir, f"{cam}_mask.npy"), mask.numpy())
+        np.save(os.path.join(tmp_dir, f"{cam}_K.npy"), K.numpy())
+        np.save(os.path.join(tmp_dir, f"{cam}_T.npy"), T.numpy())
+
+    meta = {
+        "version": SHARD_VERSION,
+        "path": path,
+        "cameras": dataset.cameras,
+        "dim": dataset.dim,
+        "frame_count": frame_count,
+        "alignment": {cam: alignment[cam] for cam in dataset.cameras},
+        "heading_bin": dataset.path_heading_bin[path],
+        "first_frame": first_frames,
+        "frames": [
+            idx
+            for p, idx in dataset.frames
+            if p == path
+            and all(
+                idx - alignment[cam] >= first_frames[cam] for cam in dataset.cameras
+            )
+        ],
+    }
+    with open(os.path.join(tmp_dir, "meta.json"), "wb") as f:
+        f.write(orjson.dumps(meta))
+
+    if os.path.exists(shard_dir):
+        shutil.rmtree(shard_dir)
+    os.rename(tmp_dir, shard_dir)
+    return shard_dir
+
+
+def try_write_drive_shard(
+    dataset: MultiCamDataset, path: str, output: str, chunk_size: int = 9 * 4
+) -> Optional[str]:
+    """
+    write_drive_shard but logs and skips drives with corrupt or truncated
+    videos instead of raising.
+
+    Returns:
+        the shard directory or None if the drive failed to decode
+    """
+    try:
+        return write_drive_shard(dataset, path, output, chunk_size=chunk_size)
+    except DECODE_ERRORS as e:
+        _check_decode_error(e)
+        print(f"skipping {path}: {e}")
+        name = os.path.basename(os.path.normpath(path))
+        shutil.rmtree(os.path.join(output, name + ".tmp"), ignore_errors=True)
+        return None
+
+
+class _ShardDrive:
+    """
+    Memory mapped arrays for a single drive shard.
+    """
+
+    def __init__(self, shard_dir: str, cameras: List[str]) -> None:
+        def load(name: str) -> np.typing.NDArray[np.generic]:
+            return np.load(os.path.join(shard_dir, name), mmap_mode="r")
+
+        with open(os.path.join(shard_dir, "meta.json"), "rb") as f:
+            self.meta: Dict[str, object] = orjson.loads(f.read())
+        self.speed: np.typing.NDArray[np.float32] = load("speed.npy")
+        self.frame_T: np.typing.NDArray[np.float32] = load("frame_T.npy")
+        self.cam_T: np.typing.NDArray[np.float64] = load("cam_T.npy")
+        self.color: Dict[str, np.typing.NDArray[np.uint8]] = {
+            cam: load(f"{cam}_color.npy") for cam in cameras
+        }
+        self.mask: Dict[str, torch.Tensor] = {
+            cam: torch.from_numpy(np.load(os.path.join(shard_dir, f"{cam}_mask.npy")))
+            for cam in cameras
+        }
+        self.K: Dict[str, torch.Tensor] = {
+            cam: torch.from_numpy(np.load(os.path.join(shard_dir, f"{cam}_K.npy")))
+            for cam in cameras
+        }
+        self.T: Dict[str, torch.Tensor] = {
+            cam: torch.from_numpy(np.load(os.path.join(shard_dir, f"{cam}_T.npy")))
+            for cam in cameras
+        }
+
+
+class ShardDataset(Dataset):
+    """
+    ShardDataset reads preprocessed drive shards written by write_drive_shard
+    and returns the same Batch as the dynamic mode of MultiCamDataset.
+
+    Arrays are memory mapped lazily in each worker so the page cache is shared
+    between all DataLoader workers.
+    """
+
+    def __init__(
+        self,
+        shard_dir: str,
+        cameras: List[str],
+        nframes_per_point: int,
+        limit_size: Optional[int] = None,
+        dtype: torch.dtype = torch.bfloat16,
+        uint8_color: bool = False,
+    ) -> None:
+        """
+        Args:
+            uint8_color: return color as the stored uint8 instead of
+                normalized dtype, see MultiCamDataset
+        """
+        self.cameras = cameras
+        self.nframes_per_point = nframes_per_point
+        self.dtype = dtype
+        self.uint8_color = uint8_color
+
+        self.frames: List[Tuple[str, int]] = []
+        self.path_heading_bin: Dict[str, int] = {}
+        self.heading_bins: Dict[int, int] = defaultdict(lambda: 0)
+        self.dim: Optional[Tuple[int, int]] = None
+
+        for name in sorted(os.listdir(shard_dir)):
+            path = os.path.join(shard_dir, name)
+            meta_path = os.path.join(path, "meta.json")
+            if not os.path.exists(meta_path):
+                continue
+            with open(meta_path, "rb") as f:
+                meta = orjson.loads(f.read())
+            if meta["version"] != SHARD_VERSION:
+                raise ValueError(f"{path}: unsupported shard version {meta['version']}")
+            missing = set(cameras) - set(meta["cameras"])
+            if len(missing) > 0:
+                raise ValueError(f"{path}: shard missing cameras {missing}")
+            dim = tuple(meta["dim"])
+            if self.dim is None:
+                self.dim = dim
+            assert self.dim == dim, f"{path}: mismatched dim {dim} {self.dim}"
+
+            heading_bin = meta["heading_bin"]
+            self.path_heading_bin[path] = heading_bin
+            self.heading_bins[heading_bin] += 1
+            for idx in meta["frames"]:
+                self.frames.append((path, idx))
+
+            if limit_size is not None and len(self.frames) > limit_size:
+                break
+
+        self.heading_weights: Dict[int, float] = bin_weights(self.heading_bins)
+
+        self._drives: Dict[str, _ShardDrive] = {}
+
+    def __getstate__(self) -> Dict[str, object]:
+        # don't pickle the memory maps into the workers
+        state = dict(self.__dict__)
+        state["_drives"] = {}
+        state["heading_bins"] = dict(self.heading_bins)
+        return state
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def _get_drive(self, path: str) -> _ShardDrive:
+        drive = self._drives.get(path)
+        if drive is None:
+            drive = _ShardDrive(path, self.cameras)
+            self._drives[path] = drive
+        return drive
+
+    def __getitem__(self, idx: int) -> Batch:
+        path, idx = self.frames[idx]
+        drive = self._get_drive(path)
+
+        info_idxs = list(range(self.nframes_per_point))
+        frames = [idx + i for i in info_idxs]
+
+        speed = torch.from_numpy(np.array(drive.speed[idx:]))
+        dists = (speed / FPS).cumsum(dim=0)[info_idxs]
+
+        cam_T = torch.from_numpy(np.array(drive.cam_T[idx:]))
+        cam_Ts = cam_T[0].inverse().matmul(cam_T).float()
+        frame_T = torch.from_numpy(np.array(drive.frame_T[frames]))
+        frame_time = torch.tensor(info_idxs, dtype=torch.float) / FPS
+
+        alignment: Dict[str, int] = drive.meta["alignment"]  # pyre-fixme[9]
+        colors: Dict[str, torch.Tensor] = {}
+        masks: Dict[str, torch.Tensor] = {}
+        for cam in self.cameras:
+            start = frames[0] - alignment[cam]
+            color = torch.from_numpy(
+                np.array(drive.color[cam][start : start + len(frames)])
+            )
+            if self.uint8_color:
+                colors[cam] = color
+            else:
+                color = color.float().div_(255)
+                colors[cam] = normalize01(color).to(self.dtype)
+            masks[cam] = drive.mask[cam].to(self.dtype)
+
+        return Batch(
+            weight=torch.tensor(self.heading_weights[self.path_heading_bin[path]]),
+            K=dict(drive.K),
+            T=dict(drive.T),
+            color=colors,
+            mask=masks,
+            cam_T=cam_Ts[info_idxs],
+            long_cam_T=cam_Ts,
+            distances=dists,
+            frame_T=frame_T,
+            frame_time=frame_time,
+            frame_ids=[[(path, frame) for frame in frames]],
+        )
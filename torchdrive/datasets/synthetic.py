@@ -0,0 +1,199 @@
+"""
+Synthetic drives for testing and benchmarking MultiCamDataset without access
+to real data. The videos are HEVC encoded locally with PyAV in the same
+layout as the real drives.
+"""
+
+import os
+import os.path
+from fractions import Fraction
+from typing import Dict, List, Sequence, Tuple
+
+import av
+import numpy as np
+import numpy.typing
+import orjson
+from PIL import Image
+
+
+def synthetic_frame(idx: int, width: int, height: int) -> np.typing.NDArray[np.uint8]:
+    """
+    Returns a [height, width, 3] RGB frame with moving gradients and edges so
+    the encoded size and decode cost are closer to real video than a solid
+    color.
+    """
+    x = np.arange(width, dtype=np.float32)[None, :]
+    y = np.arange(height, dtype=np.float32)[:, None]
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    frame[..., 0] = (x + idx * 4) % 256
+    frame[..., 1] = (y * 2 + idx * 2) % 256
+    frame[..., 2] = ((x // 32 + y // 32 + idx // 9) % 2) * 200
+    return frame
+
+
+def write_hevc(
+    path: str,
+    num_frames: int,
+    width: int,
+    height: int,
+    gop_size: int = 9,
+) -> List[Tuple[int, int]]:
+    """
+    Encodes a synthetic HEVC elementary stream with a fixed GOP size and no
+    B-frames and writes it to path.
+
+    Returns:
+        the (offset, size) of each frame packet in the file
+    """
+    encoder = av.CodecContext.create("libx265", "w")
+    encoder.width = width
+    encoder.height = height
+    encoder.pix_fmt = "yuv420p10le"
+    encoder.time_base = Fraction(1, 36)
+    encoder.options = {
+        "x265-params": f"keyint={gop_size}:min-keyint={gop_size}:scenecut=0:"
+        "bframes=0:repeat-headers=1:log-level=error",
+    }
+
+    offsets = []
+    with open(path, "wb") as f:
+
+        def write(packets: List[av.Packet]) -> None:
+            for packet in packets:
+                buf = bytes(packet)
+                offsets.append((f.tell(), len(buf)))
+                f.write(buf)
+
+        for i in range(num_frames):
+            frame = av.VideoFrame.from_ndarray(
+                synthetic_frame(i, width, height), format="rgb24"
+            )
+            frame = frame.reformat(format="yuv420p10le")
+            frame.pts = i
+            write(encoder.encode(frame))
+        write(encoder.encode(None))
+
+    assert len(offsets) == num_frames, f"{len(offsets)} != {num_frames}"
+    return offsets
+
+
+def write_index(path: str, offsets: List[Tuple[int, int]], start_i: int = 0) -> None:
+    """
+    Writes a camera index file in the format read by
+    MultiCamDataset._read_offsets.
+    """
+    with open(path, "wt") as f:
+        f.write(f"{start_i}\n")
+        for offset, size in offsets:
+            f.write(f"{offset} {size}\n")
+
+
+def synthetic_infos(num_frames: int, seed: int = 0) -> List[Dict[str, float]]:
+    """
+    Returns per frame car infos for a drive with a smoothly varying speed and
+    heading.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(num_frames) / 36
+    speed = 40 + 20 * np.sin(t / 5 + rng.uniform(0, np.pi))
+    yaw_rate = 0.1 * np.sin(t / 3)
+    heading = np.cumsum(np.degrees(yaw_rate) / 36) % 360
+    return [
+        {
+            "Speed": float(speed[i]),
+            "Heading": float(heading[i]),
+            "SteeringAngle": float(yaw_rate[i] * 100),
+            "SteeringAngleOffset": 0.0,
+            "PitchRate": 0.0,
+            "RollRate": 0.0,
+            "YawRate": float(yaw_rate[i]),
+        }
+        for i in range(num_frames)
+    ]
+
+
+def write_drive(
+    root: str,
+    name: str,
+    cameras: Sequence[str],
+    num_frames: int,
+    width: int = 1280,
+    height: int = 960,
+    seed: int = 0,
+    start_i: int = 0,
+) -> str:
+    """
+    Writes a synthetic drive directory with the infos, alignment, calibration,
+    HEVC video and index files for each camera.
+
+    If start_i is set the videos start partway through a GOP like the real
+    drives, the frames before start_i reference missing frames and the first
+    iframe is at start_i.
+
+    Returns:
+        the drive directory
+    """
+    path = os.path.join(root, name)
+    os.makedirs(path, exist_ok=True)
+
+    with open(os.path.join(path, "info_noradar.json"), "wb") as f:
+        f.write(orjson.dumps(synthetic_infos(num_frames, seed=seed)))
+    with open(os.path.join(path, "alignment.json"), "wb") as f:
+        f.write(orjson.dumps({cam: 0 for cam in cameras}))
+
+    for cam in cameras:
+        calibration = {
+            # fx, fy, cx, cy, fisheye distortion
+            "intrinsics": [600.0, 600.0, 640.0, 480.0, 0.01, 0.001, 0.0, 0.0],
+            # rotation, translation, pitch, yaw, roll
+            "extrinsics": [1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0, 0.0, 0.0, 0.0],
+        }
+        with open(os.path.join(path, f"field_calibration_{cam}.json"), "wb") as f:
+            f.write(orjson.dumps(calibration))
+
+        # drop the start of the first GOP
+        skip = -start_i % 9
+        offsets = write_hevc(
+            os.path.join(path, f"{cam}.h265"), num_frames + skip, width, height
+        )[skip:]
+        write_index(os.path.join(path, f"{cam}_index.csv"), offsets, start_i=start_i)
+
+    return path
+
+
+def write_masks(mask_dir: str, cameras: Sequence[str], width: int, height: int) -> None:
+    """
+    Writes an all valid mask for each camera.
+    """
+    os.makedirs(mask_dir, exist_ok=True)
+    for cam in cameras:
+        Image.new("L", (width, height), 255).save(os.path.join(mask_dir, f"{cam}.png"))
+
+
+def write_dataset(
+    root: str,
+    num_drives: int,
+    cameras: Sequence[str],
+    num_frames: int,
+    width: int = 1280,
+    height: int = 960,
+) -> Tuple[str, str]:
+    """
+    Writes a synthetic dataset with num_drives drives, the camera masks and
+    the index file.
+
+    Returns:
+        the index file and mask directory to pass to MultiCamDataset
+    """
+    os.makedirs(root, exist_ok=True)
+    for i in range(num_drives):
+        write_drive(
+            root, f"drive{i}", cameras, num_frames, width=width, height=height, seed=i
+        )
+    mask_dir = os.path.join(root, "masks")
+    write_masks(mask_dir, cameras, width, height)
+    index_file = os.path.join(root, "index.txt")
+    with open(index_file, "wt") as f:
+        for i in range(num_drives):
+            f.write(f"drive{i}\n")
+    return index_file, mask_dir
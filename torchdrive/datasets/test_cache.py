@@ -0,0 +1,44 @@
+import pickle
+import unittest
+
+from torchdrive.datasets.cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_lru(self) -> None:
+        cache = LRUCache[str, int](maxsize=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        # b was the least recently used
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(len(cache), 2)
+
+    def test_get_or_create(self) -> None:
+        cache = LRUCache[str, int](maxsize=2)
+        calls = []
+
+        def create() -> int:
+            calls.append(1)
+            return 10
+
+        self.assertEqual(cache.get_or_create("a", create), 10)
+        self.assertEqual(cache.get_or_create("a", create), 10)
+        self.assertEqual(len(calls), 1)
+
+    def test_disabled(self) -> None:
+        cache = LRUCache[str, int](maxsize=0)
+        cache.put("a", 1)
+        self.assertIsNone(cache.get("a"))
+
+    def test_pickle(self) -> None:
+        cache = LRUCache[str, int](maxsize=2)
+        cache.put("a", 1)
+        out = pickle.loads(pickle.dumps(cache))
+        self.assertEqual(out.maxsize, 2)
+        self.assertEqual(len(out), 0)
+        out.put("a", 1)
+        self.assertEqual(out.get("a"), 1)
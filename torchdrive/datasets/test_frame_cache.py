@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from torchdrive.datasets.frame_cache import FrameCache
+
+
+class TestFrameCache(unittest.TestCase):
+    def test_get_put(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = FrameCache(tmpdir, max_bytes=2**20)
+            dim = (64, 48)
+            self.assertIsNone(cache.get("drive", "main", 1, dim, "rgb48le"))
+
+            arr = np.random.randint(0, 2**16, size=(48, 64, 3), dtype=np.uint16)
+            cache.put("drive", "main", 1, dim, "rgb48le", arr)
+            out = cache.get("drive", "main", 1, dim, "rgb48le")
+            self.assertIsNotNone(out)
+            np.testing.assert_array_equal(out, arr)
+
+            self.assertIsNone(cache.get("drive", "main", 2, dim, "rgb48le"))
+            self.assertIsNone(cache.get("drive", "narrow", 1, dim, "rgb48le"))
+            self.assertIsNone(cache.get("drive", "main", 1, (32, 24), "rgb48le"))
+
+    def test_evict(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            arr = np.zeros((10, 100), dtype=np.uint8)
+            cache = FrameCache(tmpdir, max_bytes=5 * arr.nbytes)
+            dim = (100, 10)
+            for i in range(10):
+                cache.put("drive", "main", i, dim, "rgb24", arr)
+                # mtime resolution can be coarse so set it explicitly
+                entry = cache._entry_path("drive", "main", i, dim, "rgb24")
+                os.utime(entry, (i, i))
+
+            cache.evict()
+            self.assertLessEqual(cache.size(), 5 * (arr.nbytes + 128))
+            # most recently used entries are retained
+            self.assertIsNotNone(cache.get("drive", "main", 9, dim, "rgb24"))
+            self.assertIsNone(cache.get("drive", "main", 0, dim, "rgb24"))
+
+    def test_shared_budget(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            arr = np.zeros((10, 100), dtype=np.uint8)
+            max_bytes = 10 * (arr.nbytes + 128)
+            # one cache per DataLoader worker/rank sharing the directory
+            caches = [
+                FrameCache(tmpdir, max_bytes=max_bytes, evict_fraction=0.5)
+                for _ in range(4)
+            ]
+            dim = (100, 10)
+            for i in range(8):
+                for j, cache in enumerate(caches):
+                    cache.put("drive", "main", i * len(caches) + j, dim, "rgb24", arr)
+                    self.assertLessEqual(cache.size(), max_bytes)
+                    self.assertEqual(cache._read_size(), cache.size())
+
+            # overwriting an entry doesn't change the size
+            size = caches[0].size()
+            caches[1].put("drive", "main", 31, dim, "rgb24", arr)
+            self.assertEqual(caches[0]._read_size(), size)
+            self.assertIsNotNone(caches[2].get("drive", "main", 31, dim, "rgb24"))
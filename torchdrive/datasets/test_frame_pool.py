@@ -0,0 +1,139 @@
+import gc
+import pickle
+import unittest
+from dataclasses import replace
+from unittest.mock import patch
+
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from torchdrive.data import Batch, dummy_item
+from torchdrive.datasets.frame_pool import FramePool, PooledBatch, PooledDataset
+
+
+class ColorDataset(Dataset[Batch]):
+    def __len__(self) -> int:
+        return 20
+
+    def __getitem__(self, idx: int) -> Batch:
+        item = dummy_item()
+        return replace(
+            item,
+            weight=torch.tensor(float(idx)),
+            color={cam: torch.full((3, 3, 48, 64), float(idx)) for cam in item.color},
+        )
+
+
+def _pool(num_slots: int, timeout: float = 300) -> FramePool:
+    shapes = {"left": (3, 3, 48, 64), "right": (3, 3, 48, 64)}
+    return FramePool(num_slots, shapes, torch.float32, timeout=timeout)
+
+
+class TestFramePool(unittest.TestCase):
+    def test_put_take(self) -> None:
+        pool = _pool(2)
+        item = ColorDataset()[3]
+        pooled = pool.put(item)
+        self.assertIsInstance(pooled, PooledBatch)
+        self.assertEqual(pooled.batch.color, {})
+        self.assertEqual(pool.free.qsize(), 1)
+
+        batch = pooled.to(torch.device("cpu"))
+        self.assertEqual(pool.free.qsize(), 2)
+        torch.testing.assert_close(batch.color, item.color)
+        self.assertEqual(batch.weight, item.weight)
+
+    def test_wrong_cameras(self) -> None:
+        pool = _pool(1)
+        item = ColorDataset()[0]
+        with self.assertRaisesRegex(ValueError, "expected cameras"):
+            pool.put(replace(item, color={"left": item.color["left"]}))
+        self.assertEqual(pool.free.qsize(), 1)
+
+    def test_timeout(self) -> None:
+        pool = _pool(1, timeout=0.1)
+        item = ColorDataset()[0]
+        pooled = pool.put(item)
+        with self.assertRaisesRegex(RuntimeError, "no free FramePool slots"):
+            pool.put(item)
+        pooled.to(torch.device("cpu"))
+        with self.assertRaisesRegex(RuntimeError, "already taken"):
+            pooled.to(torch.device("cpu"))
+
+    def test_release_on_gc(self) -> None:
+        pool = _pool(2)
+        item = ColorDataset()[0]
+        with patch("torchdrive.datasets.frame_pool.get_worker_info"):
+            pooled = pool.put(item)
+            # as received from a worker
+            received = pickle.loads(pickle.dumps(pooled))
+        # the worker's copy doesn't release the slot
+        del pooled
+        gc.collect()
+        self.assertEqual(pool.free.qsize(), 1)
+        del received
+        gc.collect()
+        self.assertEqual(pool.free.qsize(), 2)
+
+        # taken batches aren't released again
+        pooled = pool.put(item)
+        pooled.to(torch.device("cpu"))
+        del pooled
+        gc.collect()
+        self.assertEqual(pool.free.qsize(), 2)
+
+        # in process batches are released
+        pool.put(item)
+        gc.collect()
+        self.assertEqual(pool.free.qsize(), 2)
+
+    def test_reset(self) -> None:
+        pool = _pool(2)
+        stale = pool.put(ColorDataset()[0])
+        pool.reset()
+        self.assertEqual(pool.free.qsize(), 2)
+        # slots from before the reset aren't released again
+        stale.to(torch.device("cpu"))
+        self.assertEqual(pool.free.qsize(), 2)
+
+    def test_slots_needed(self) -> None:
+        self.assertEqual(FramePool.slots_needed(2, 2, pin_memory=True), 5)
+        self.assertEqual(FramePool.slots_needed(2, 4, pin_memory=False), 8)
+        self.assertEqual(FramePool.slots_needed(0, 2, pin_memory=False), 1)
+
+    def test_dataloader_early_exit(self) -> None:
+        pool = _pool(FramePool.slots_needed(2, 2, pin_memory=False), timeout=10)
+        dataloader = DataLoader(
+            PooledDataset(ColorDataset(), pool),
+            batch_size=None,
+            num_workers=2,
+            prefetch_factor=2,
+        )
+        for i, pooled in enumerate(dataloader):
+            if i == 2:
+                break
+            pooled.to(torch.device("cpu"))
+        del pooled
+        gc.collect()
+
+        pool.reset()
+        for i, pooled in enumerate(dataloader):
+            pooled.to(torch.device("cpu"))
+        self.assertEqual(i, 19)
+        self.assertEqual(pool.free.qsize(), pool.num_slots)
+
+    def test_dataloader(self) -> None:
+        pool = _pool(FramePool.slots_needed(2, 2, pin_memory=True))
+        dataloader = DataLoader(
+            PooledDataset(ColorDataset(), pool),
+            batch_size=None,
+            num_workers=2,
+            prefetch_factor=2,
+        )
+        for i, pooled in enumerate(dataloader):
+            batch = pooled.to(torch.device("cpu"))
+            self.assertEqual(batch.weight.item(), i)
+            for color in batch.color.values():
+                self.assertTrue((color == i).all())
+        self.assertEqual(i, 19)
+        self.assertEqual(pool.free.qsize(), 5)
@@ -0,0 +1,34 @@
+import os.path
+import pickle
+import tempfile
+import unittest
+
+from torchdrive.datasets.quarantine import Quarantine
+
+
+class TestQuarantine(unittest.TestCase):
+    def test_persist(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "quarantine", "failed.jsonl")
+            q = Quarantine(path)
+            self.assertEqual(len(q), 0)
+            q.add("drive1", 10, "bad frame")
+            q.add("drive1", 10, "bad frame")
+            self.assertIn(("drive1", 10), q)
+
+            with open(path, "ab") as f:
+                f.write(b'{"path": "drive2"')
+
+            q = Quarantine(path)
+            self.assertEqual(len(q), 1)
+            self.assertIn(("drive1", 10), q)
+            self.assertNotIn(("drive1", 11), q)
+
+    def test_pickle(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "failed.jsonl")
+            q = Quarantine(path)
+            q.add("drive1", 10, "bad frame")
+            q = pickle.loads(pickle.dumps(q))
+            self.assertEqual(q.path, path)
+            self.assertIn(("drive1", 10), q)
@@ -1,8 +1,440 @@
+import os
+import tempfile
 import unittest
+from typing import Sequence
+from unittest.mock import patch
 
-from torchdrive.datasets.rice import compute_bin
+import numpy as np
+import torch
+
+from torchdrive.datasets.cache import LRUCache
+from torchdrive.datasets.frame_cache import FrameCache
+from torchdrive.datasets.quarantine import Quarantine
+from torchdrive.datasets.rice import compute_bin, FPS, MultiCamDataset
+from torchdrive.datasets.synthetic import write_dataset
+from torchdrive.datasets.timing import StageTimer
+from torchdrive.transforms.batch import NormalizeColor
+
+
+def _calibration_dataset(calibration_cache_dir: str = None) -> MultiCamDataset:
+    dataset = MultiCamDataset.__new__(MultiCamDataset)
+    dataset.dim = (64, 48)
+    dataset.masks = {"main": torch.ones(1, 48, 64)}
+    dataset.calibration_cache = LRUCache(4)
+    dataset.calibration_cache_dir = calibration_cache_dir
+    dataset.timer = StageTimer()
+    return dataset
+
+
+def _write_dataset(
+    root: str,
+    num_drives: int = 1,
+    num_frames: int = 45,
+    cameras: Sequence[str] = ("main",),
+) -> None:
+    write_dataset(root, num_drives, cameras, num_frames, width=64, height=48)
+
+
+def _fake_dataset(
+    root: str, cameras: Sequence[str] = ("main",), **kwargs: object
+) -> MultiCamDataset:
+    return MultiCamDataset(
+        index_file=os.path.join(root, "index.txt"),
+        mask_dir=os.path.join(root, "masks"),
+        cameras=list(cameras),
+        dynamic=True,
+        cam_shape=(48, 64),
+        nframes_per_point=5,
+        **kwargs,
+    )
+
+
+def _calibration() -> tuple:
+    K = torch.tensor(
+        [
+            [0.5, 0, 0.5, 0],
+            [0, 0.5, 0.5, 0],
+            [0, 0, 1, 0],
+            [0, 0, 0, 1],
+        ]
+    )
+    D = np.array([[0.01], [0.001], [0.0], [0.0]])
+    return K, D, torch.eye(4)
 
 
 class TestRice(unittest.TestCase):
     def test_compute_bin(self) -> None:
         self.assertEqual(compute_bin(5, [0, 2, 4, 6, 8]), 6)
+
+    def test_rect_calibration_cache(self) -> None:
+        dataset = _calibration_dataset()
+        with patch.object(
+            dataset, "_get_calibration", return_value=_calibration()
+        ) as get_calibration:
+            map1, map2, mask, K, T = dataset._get_rect_calibration("drive", "main")
+            dataset._get_rect_calibration("drive", "main")
+        get_calibration.assert_called_once()
+        self.assertEqual(map1.shape, (48, 64, 2))
+        self.assertEqual(mask.shape, (1, 48, 64))
+        self.assertEqual(K.shape, (4, 4))
+
+    def test_rect_calibration_disk_cache(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(f"{tmpdir}/field_calibration_main.json", "w") as f:
+                f.write("{}")
+            a = _calibration_dataset(calibration_cache_dir=f"{tmpdir}/cache")
+            with patch.object(a, "_get_calibration", return_value=_calibration()):
+                want = a._get_rect_calibration(tmpdir, "main")
+
+            b = _calibration_dataset(calibration_cache_dir=f"{tmpdir}/cache")
+            with patch.object(b, "_get_calibration") as get_calibration:
+                got = b._get_rect_calibration(tmpdir, "main")
+            get_calibration.assert_not_called()
+            for x, y in zip(want, got):
+                np.testing.assert_array_equal(np.asarray(x), np.asarray(y))
+
+    def test_rect_frames_batched(self) -> None:
+        dataset = _calibration_dataset()
+        frames = [
+            np.random.randint(0, 256, size=(48, 64, 3), dtype=np.uint8)
+            for _ in range(3)
+        ]
+
+        def get_raw_frames(path, cam, idxs, dim, fmt):
+            if fmt == "rgb24":
+                return frames
+            return [frame.astype(np.uint16) * 256 for frame in frames]
+
+        with patch.object(
+            dataset, "_get_calibration", return_value=_calibration()
+        ), patch.object(dataset, "_get_raw_frames", side_effect=get_raw_frames):
+            want, want_mask, want_K, _ = dataset._get_rect_frames(
+                "drive", "main", [0, 1, 2]
+            )
+            color, mask, K, _ = dataset._get_rect_frames_batched(
+                "drive", "main", [0, 1, 2]
+            )
+
+        self.assertEqual(color.shape, (3, 3, 48, 64))
+        self.assertTrue(color.is_contiguous())
+        torch.testing.assert_close(mask, want_mask)
+        torch.testing.assert_close(K, want_K)
+        # uint8 saturates cubic overshoot so compare the bulk of the values
+        diff = (color - torch.stack(want)).abs()
+        self.assertLess(diff.mean().item(), 0.1)
+
+    def test_index_cache(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root = os.path.join(tmpdir, "root")
+            _write_dataset(root, num_drives=2, num_frames=100)
+
+            def build() -> MultiCamDataset:
+                return _fake_dataset(
+                    root, index_cache_dir=os.path.join(tmpdir, "cache")
+                )
+
+            want = build()
+            self.assertEqual(len(want.per_path_frame_count), 2)
+            self.assertGreater(len(want), 0)
+
+            with patch.object(MultiCamDataset, "_index_path") as index_path:
+                got = build()
+            index_path.assert_not_called()
+            self.assertCountEqual(got.frames, want.frames)
+            self.assertEqual(got.per_path_frame_count, want.per_path_frame_count)
+            self.assertEqual(got.path_heading_bin, want.path_heading_bin)
+
+            # modified drives are reindexed
+            os.utime(
+                os.path.join(root, "drive0", "main_index.csv"),
+                ns=(0, 0),
+            )
+            with patch.object(
+                MultiCamDataset, "_index_path", wraps=want._index_path
+            ) as index_path:
+                build()
+            index_path.assert_called_once()
+
+    def test_decoder_reuse(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root = os.path.join(tmpdir, "root")
+            _write_dataset(root)
+            path = os.path.join(root, "drive0")
+            dataset = _fake_dataset(root)
+
+            def frames(idxs: list) -> list:
+                return dataset._get_raw_frames(path, "main", idxs, None, "rgb24")
+
+            # each frame decoded on its own with a new decoder
+            want = {
+                i: _fake_dataset(root)._get_raw_frames(
+                    path, "main", [i], None, "rgb24"
+                )[0]
+                for i in [3, 4, 12, 44]
+            }
+
+            def check(idxs: list) -> None:
+                for i, arr in zip(idxs, frames(idxs)):
+                    np.testing.assert_array_equal(arr, want[i])
+
+            check([3, 4])
+            self.assertEqual(len(dataset.decoders), 1)
+            decoder = dataset.decoders.get((path, "main"))
+            check([12, 44])
+            check([3, 4])
+            self.assertIs(dataset.decoders.get((path, "main")), decoder)
+
+    def test_frame_cache(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root = os.path.join(tmpdir, "root")
+            _write_dataset(root)
+            path = os.path.join(root, "drive0")
+            for fmt in ("rgb48le", "rgb24"):
+                want = _fake_dataset(root)
+                dataset = _fake_dataset(
+                    root,
+                    frame_cache=FrameCache(
+                        os.path.join(tmpdir, f"cache_{fmt}"), max_bytes=2**30
+                    ),
+                )
+
+                def check(idxs: list, decoded: list) -> None:
+                    with patch.object(
+                        dataset, "_decode_frames", wraps=dataset._decode_frames
+                    ) as decode_frames:
+                        got = dataset._get_raw_frames(path, "main", idxs, None, fmt)
+                    if decoded:
+                        decode_frames.assert_called_once()
+                        self.assertEqual(decode_frames.call_args.args[3], decoded)
+                    else:
+                        decode_frames.assert_not_called()
+                    for arr, wantarr in zip(
+                        got, want._get_raw_frames(path, "main", idxs, None, fmt)
+                    ):
+                        self.assertEqual(arr.dtype, wantarr.dtype)
+                        np.testing.assert_array_equal(arr, wantarr)
+
+                check([3, 4], [3, 4])
+                # the rest of the GOP was decoded and cached
+                check([7, 8], [])
+                # partial hits only decode the missing frames
+                check([4, 8, 9, 12], [9, 12])
+                check([10, 13, 17], [])
+
+        for uint8_color in (False, True):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                root = os.path.join(tmpdir, "root")
+                _write_dataset(root)
+                want = _fake_dataset(root, uint8_color=uint8_color)
+                dataset = _fake_dataset(
+                    root,
+                    uint8_color=uint8_color,
+                    frame_cache=FrameCache(
+                        os.path.join(tmpdir, "cache"), max_bytes=2**30
+                    ),
+                )
+                for i in (0, 2, 1, 0):
+                    got = dataset[i].color["main"]
+                    wantcolor = want[i].color["main"]
+                    self.assertEqual(got.dtype, wantcolor.dtype)
+                    torch.testing.assert_close(got, wantcolor, atol=0, rtol=0)
+
+    def test_decode_threads(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root = os.path.join(tmpdir, "root")
+            cameras = ("main", "narrow", "fisheye")
+            _write_dataset(root, num_drives=2, cameras=cameras)
+            serial = _fake_dataset(root, cameras=cameras)
+            # fewer decoders than cameras so the threads evict each other's
+            dataset = _fake_dataset(
+                root, cameras=cameras, num_decode_threads=3, decoder_cache_size=2
+            )
+            self.assertIs(dataset._get_pool(), dataset._get_pool())
+            for i in (0, len(dataset) - 1, 1, 0):
+                want = serial[i]
+                got = dataset[i]
+                self.assertCountEqual(got.color.keys(), cameras)
+                torch.testing.assert_close(got.color, want.color, atol=0, rtol=0)
+                torch.testing.assert_close(got.mask, want.mask)
+                torch.testing.assert_close(got.K, want.K)
+                torch.testing.assert_close(got.T, want.T)
+            self.assertLessEqual(len(dataset.decoders), 2)
+
+    def test_drive_cache(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root = os.path.join(tmpdir, "root")
+            _write_dataset(root)
+            dataset = _fake_dataset(root)
+            with patch.object(
+                dataset, "_get_raw_infos", wraps=dataset._get_raw_infos
+            ) as get_raw_infos:
+                a = dataset[0]
+                b = dataset[1]
+            get_raw_infos.assert_called_once()
+            self.assertEqual(len(dataset.drive_cache), 1)
+
+            path = os.path.join(root, "drive0")
+            drive = dataset._get_drive(path)
+            frame_count = dataset.per_path_frame_count[path]
+            self.assertEqual(drive.cam_T.shape, (frame_count, 4, 4))
+            self.assertEqual(drive.infos["Speed"].dtype, np.float32)
+            torch.testing.assert_close(a.cam_T[0], torch.eye(4))
+            # the car moves speed / FPS each frame
+            _, idx = dataset.frames[0]
+            pos = a.long_cam_T[:, :3, 3]
+            torch.testing.assert_close(
+                (pos[1:] - pos[:-1]).norm(dim=-1),
+                torch.from_numpy(drive.infos["Speed"][idx:-1]) / FPS,
+            )
+            torch.testing.assert_close(
+                b.long_cam_T, a.long_cam_T[1].inverse() @ a.long_cam_T[1:]
+            )
+
+    def test_get_window(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root = os.path.join(tmpdir, "root")
+            _write_dataset(root)
+            dataset = _fake_dataset(root)
+            path, start = dataset.frames[0]
+            window = dataset.get_window(path, [start, start + 2, start + 3])
+            self.assertEqual(len(window), 3)
+            for batch, i in zip(window, [0, 2, 3]):
+                want = dataset[i]
+                torch.testing.assert_close(batch.color, want.color)
+                torch.testing.assert_close(batch.long_cam_T, want.long_cam_T)
+                torch.testing.assert_close(batch.distances, want.distances)
+                torch.testing.assert_close(batch.frame_T, want.frame_T)
+                self.assertEqual(batch.frame_ids, want.frame_ids)
+            self.assertEqual(
+                window[1].frame_ids,
+                [[(path, start + 2 + i) for i in range(dataset.nframes_per_point)]],
+            )
+
+    def test_get_frames_rgb24(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root = os.path.join(tmpdir, "root")
+            _write_dataset(root)
+            dataset = _fake_dataset(root)
+            path = os.path.join(root, "drive0")
+            want = dataset._get_frames(path, "main", [3, 4], normalize=False)
+            got = dataset._get_frames(
+                path, "main", [3, 4], normalize=False, fmt="rgb24"
+            )
+            self.assertEqual(got[0].shape, (3, 48, 64))
+            # the chroma edges in the synthetic frames round differently
+            for a, b in zip(got, want):
+                torch.testing.assert_close(a, b, atol=4 / 255, rtol=0)
+
+    def test_stage_timing(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root = os.path.join(tmpdir, "root")
+            _write_dataset(root)
+            dataset = _fake_dataset(root, stage_timing=True)
+            batch = dataset[0]
+            self.assertIsNotNone(batch)
+            self.assertCountEqual(
+                batch.load_times.keys(),
+                [
+                    "info",
+                    "cam_T",
+                    "offsets",
+                    "calibration/main",
+                    "decode/main",
+                    "scale/main",
+                    "remap/main",
+                    "tensor/main",
+                ],
+            )
+            self.assertEqual(dataset.timer.pop(), {})
+
+            # the drive metadata is cached
+            batch = dataset[1]
+            self.assertNotIn("offsets", batch.load_times)
+
+            first, second = dataset.get_window(os.path.join(root, "drive0"), [0, 1])
+            self.assertIn("decode/main", first.load_times)
+            self.assertIsNone(second.load_times)
+
+            dataset.timer.enabled = False
+            self.assertIsNone(dataset[0].load_times)
+
+    def test_quarantine(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root = os.path.join(tmpdir, "root")
+            _write_dataset(root, num_frames=100)
+            quarantine_file = os.path.join(tmpdir, "quarantine.jsonl")
+            dataset = _fake_dataset(
+                root, quarantine_file=quarantine_file, replace_failed=2
+            )
+            num_frames = len(dataset)
+            bad = dataset.frames[0]
+
+            def getitem(idx: int) -> object:
+                if dataset.frames[idx] == bad:
+                    raise IndexError("bad frame")
+                return idx
+
+            with patch.object(dataset, "_getitem", side_effect=getitem) as mock:
+                # replaced with the next example that doesn't share a GOP
+                self.assertEqual(dataset[0], 14)
+                self.assertIn(bad, dataset.quarantine)
+
+                # quarantined examples are skipped without loading
+                mock.reset_mock()
+                self.assertEqual(dataset[0], 14)
+                mock.assert_called_once_with(14)
+
+            # quarantined examples are excluded from the index
+            dataset = _fake_dataset(root, quarantine_file=quarantine_file)
+            self.assertEqual(len(dataset), num_frames - 1)
+            self.assertNotIn(bad, dataset.frames)
+            with patch.object(dataset, "_getitem", side_effect=IndexError("bad")):
+                self.assertIsNone(dataset[0])
+
+    def test_get_window_quarantine(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root = os.path.join(tmpdir, "root")
+            _write_dataset(root, num_frames=100)
+            path = os.path.join(root, "drive0")
+            quarantine_file = os.path.join(tmpdir, "quarantine.jsonl")
+            Quarantine(quarantine_file).add(path, 13, "bad")
+            dataset = _fake_dataset(
+                root, quarantine_file=quarantine_file, replace_failed=1
+            )
+            self.assertNotIn((path, 13), dataset.frames)
+            bad = {(path, 28)}
+
+            def getitem(idx: int) -> object:
+                if dataset.frames[idx] in bad:
+                    raise IndexError("bad frame")
+                return dataset.frames[idx]
+
+            with patch.object(
+                dataset, "_get_window", side_effect=IndexError("bad window")
+            ), patch.object(dataset, "_getitem", side_effect=getitem):
+                # 13 was quarantined when loading and its replacement 28 fails
+                self.assertEqual(
+                    dataset.get_window(path, [12, 13, 14]),
+                    [(path, 12), None, (path, 14)],
+                )
+                self.assertIn((path, 28), dataset.quarantine)
+                # the next replacement that doesn't overlap is used instead and
+                # the window matches __getitem__
+                self.assertEqual(
+                    dataset.get_window(path, [12, 13, 28]),
+                    [(path, 12), (path, 42), (path, 42)],
+                )
+                self.assertEqual(dataset[dataset.frames.index((path, 28))], (path, 42))
+
+    def test_uint8_color(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root = os.path.join(tmpdir, "root")
+            _write_dataset(root)
+            want = _fake_dataset(root, batch_remap=True, dtype=torch.float32)[0]
+            got = _fake_dataset(root, uint8_color=True)[0]
+            color = got.color["main"]
+            self.assertEqual(color.dtype, torch.uint8)
+            self.assertEqual(color.shape, (5, 3, 48, 64))
+            self.assertTrue(color.is_contiguous())
+            got = NormalizeColor(dtype=torch.float32)(got)
+            torch.testing.assert_close(got.color["main"], want.color["main"])
@@ -0,0 +1,75 @@
+import unittest
+
+from torchdrive.datasets.sampler import LocalitySampler
+
+
+def _frames() -> list:
+    return [(f"drive{d}", i) for d in range(5) for i in range(90)]
+
+
+class TestSampler(unittest.TestCase):
+    def test_partition(self) -> None:
+        frames = _frames()
+        samplers = [
+            LocalitySampler(frames, num_replicas=3, rank=rank, seed=1)
+            for rank in range(3)
+        ]
+        idxs = [list(sampler) for sampler in samplers]
+        for sampler, rank_idxs in zip(samplers, idxs):
+            self.assertEqual(len(rank_idxs), len(sampler))
+            self.assertEqual(len(rank_idxs), len(frames) // 3)
+        all_idxs = [i for rank_idxs in idxs for i in rank_idxs]
+        self.assertEqual(len(set(all_idxs)), len(all_idxs))
+
+    def test_epoch(self) -> None:
+        frames = _frames()
+        a = LocalitySampler(frames, seed=1)
+        b = LocalitySampler(frames, seed=1)
+        self.assertEqual(list(a), list(b))
+        b.set_epoch(1)
+        self.assertNotEqual(list(a), list(b))
+        self.assertCountEqual(list(a), list(b))
+
+    def test_chunks(self) -> None:
+        frames = _frames()
+        sampler = LocalitySampler(frames, chunk_size=9, shuffle_within_chunk=False)
+        idxs = list(sampler)
+        self.assertCountEqual(idxs, range(len(frames)))
+        for i in range(0, len(idxs), 9):
+            path, frame = frames[idxs[i]]
+            self.assertEqual(frame % 9, 0)
+            self.assertEqual(
+                [frames[j] for j in idxs[i : i + 9]],
+                [(path, frame + j) for j in range(9)],
+            )
+
+    def test_worker_lanes(self) -> None:
+        frames = _frames()
+        num_workers = 5
+        sampler = LocalitySampler(
+            frames, chunk_size=9, num_workers=num_workers, shuffle_within_chunk=False
+        )
+        idxs = list(sampler)
+        self.assertEqual(len(idxs) % num_workers, 0)
+        for worker in range(num_workers):
+            # the DataLoader hands out indexes round robin
+            worker_frames = [frames[i] for i in idxs[worker::num_workers]]
+            path, frame = worker_frames[0]
+            self.assertEqual(worker_frames[:9], [(path, frame + j) for j in range(9)])
+
+    def test_worker_lanes_batched(self) -> None:
+        frames = _frames()
+        num_workers = 3
+        batch_size = 3
+        want = list(LocalitySampler(frames, chunk_size=9, num_workers=num_workers))
+        sampler = LocalitySampler(
+            frames, chunk_size=9, num_workers=num_workers, batch_size=batch_size
+        )
+        idxs = list(sampler)
+        self.assertEqual(len(idxs) % (num_workers * batch_size), 0)
+        batches = [idxs[i : i + batch_size] for i in range(0, len(idxs), batch_size)]
+        for worker in range(num_workers):
+            # the DataLoader hands out whole batches round robin so each worker
+            # gets the same lane as without batching
+            worker_idxs = [i for b in batches[worker::num_workers] for i in b]
+            self.assertEqual(worker_idxs, want[worker::num_workers])
@@ -0,0 +1,127 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import orjson
+import torch
+
+from torchdrive.data import Batch, collate
+from torchdrive.datasets.rice import MultiCamDataset
+from torchdrive.datasets.shard import (
+    SHARD_VERSION,
+    ShardDataset,
+    try_write_drive_shard,
+    write_drive_shard,
+)
+from torchdrive.datasets.synthetic import write_drive, write_masks
+
+
+def write_fake_shard(shard_dir: str, cameras: list, frame_count: int = 20) -> None:
+    os.makedirs(shard_dir)
+    h, w = 12, 16
+    frame_T = np.tile(np.eye(4, dtype=np.float32), (frame_count, 1, 1))
+    frame_T[:, 0, 3] = 1
+    cam_T = np.tile(np.eye(4), (frame_count, 1, 1))
+    cam_T[:, 0, 3] = np.arange(frame_count)
+    np.save(os.path.join(shard_dir, "speed.npy"), np.ones(frame_count, np.float32))
+    np.save(os.path.join(shard_dir, "frame_T.npy"), frame_T)
+    np.save(os.path.join(shard_dir, "cam_T.npy"), cam_T)
+    for cam in cameras:
+        np.save(
+            os.path.join(shard_dir, f"{cam}_color.npy"),
+            np.random.randint(0, 255, (frame_count, 3, h, w), dtype=np.uint8),
+        )
+        np.save(
+            os.path.join(shard_dir, f"{cam}_mask.npy"), np.ones((1, h, w), np.float32)
+        )
+        np.save(os.path.join(shard_dir, f"{cam}_K.npy"), np.eye(4, dtype=np.float32))
+        np.save(os.path.join(shard_dir, f"{cam}_T.npy"), np.eye(4, dtype=np.float32))
+    meta = {
+        "version": SHARD_VERSION,
+        "path": shard_dir,
+        "cameras": cameras,
+        "dim": (w, h),
+        "frame_count": frame_count,
+        "alignment": {cam: 0 for cam in cameras},
+        "heading_bin": 5,
+        "frames": list(range(2, 10)),
+    }
+    with open(os.path.join(shard_dir, "meta.json"), "wb") as f:
+        f.write(orjson.dumps(meta))
+
+
+class TestShard(unittest.TestCase):
+    def test_shard_dataset(self) -> None:
+        cameras = ["left", "right"]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            write_fake_shard(os.path.join(tmpdir, "drive1"), cameras)
+            write_fake_shard(os.path.join(tmpdir, "drive2"), cameras)
+
+            dataset = ShardDataset(tmpdir, cameras=cameras, nframes_per_point=3)
+            self.assertEqual(len(dataset), 16)
+
+            batch = dataset[1]
+            self.assertIsInstance(batch, Batch)
+            self.assertEqual(batch.color["left"].shape, (3, 3, 12, 16))
+            self.assertEqual(batch.color["left"].dtype, torch.bfloat16)
+            self.assertEqual(batch.mask["left"].shape, (1, 12, 16))
+            self.assertEqual(batch.cam_T.shape, (3, 4, 4))
+            self.assertEqual(batch.long_cam_T.shape, (20 - 3, 4, 4))
+            # car positions are relative to the first frame
+            torch.testing.assert_close(batch.cam_T[0], torch.eye(4))
+            self.assertEqual(batch.cam_T[2, 0, 3].item(), 2)
+            torch.testing.assert_close(batch.distances, torch.tensor([1, 2, 3]) / 36)
+            path, idx = dataset.frames[1]
+            self.assertEqual(batch.frame_ids, [[(path, idx + i) for i in range(3)]])
+
+            self.assertIsNotNone(collate([dataset[0], dataset[9]]))
+
+    def test_shard_dataset_missing_camera(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            write_fake_shard(os.path.join(tmpdir, "drive1"), ["left"])
+            with self.assertRaisesRegex(ValueError, "missing cameras"):
+                ShardDataset(tmpdir, cameras=["left", "right"], nframes_per_point=3)
+
+    def test_write_drive_shard_start_i(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root = os.path.join(tmpdir, "root")
+            # the first 12 frames can't be decoded
+            write_drive(root, "drive0", ["main"], 72, width=64, height=48, start_i=12)
+            write_drive(root, "drive1", ["main"], 72, width=64, height=48)
+            write_masks(os.path.join(root, "masks"), ["main"], 64, 48)
+            with open(os.path.join(root, "index.txt"), "wt") as f:
+                f.write("drive0\ndrive1\n")
+            dataset = MultiCamDataset(
+                index_file=os.path.join(root, "index.txt"),
+                mask_dir=os.path.join(root, "masks"),
+                cameras=["main"],
+                dynamic=True,
+                cam_shape=(48, 64),
+                nframes_per_point=3,
+            )
+            path = os.path.join(root, "drive0")
+            output = os.path.join(tmpdir, "shards")
+            shard_dir = write_drive_shard(dataset, path, output, chunk_size=18)
+
+            with open(os.path.join(shard_dir, "meta.json"), "rb") as f:
+                meta = orjson.loads(f.read())
+            self.assertEqual(meta["first_frame"], {"main": 12})
+            self.assertGreater(len(meta["frames"]), 0)
+            self.assertEqual(min(meta["frames"]), 12)
+
+            color = np.load(os.path.join(shard_dir, "main_color.npy"))
+            self.assertEqual(color[:12].max(), 0)
+            for frame in (12, 20, 40):
+                (want,), _, _, _ = dataset._get_rect_frames(
+                    path, "main", [frame], normalize=False
+                )
+                want = want.mul(255).round().clamp(0, 255).byte().numpy()
+                np.testing.assert_array_equal(color[frame], want)
+
+            # corrupt drives are skipped
+            path = os.path.join(root, "drive1")
+            with open(os.path.join(path, "main.h265"), "r+b") as f:
+                f.truncate(100)
+            self.assertIsNone(try_write_drive_shard(dataset, path, output))
+            self.assertEqual(os.listdir(output), ["drive0"])
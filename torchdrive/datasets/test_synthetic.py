@@ -0,0 +1,30 @@
+import os
+import tempfile
+import unittest
+
+import av
+import orjson
+
+from torchdrive.datasets.synthetic import synthetic_frame, write_drive
+
+
+class TestSynthetic(unittest.TestCase):
+    def test_write_drive(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = write_drive(tmpdir, "drive", ["main"], 12, width=64, height=48)
+            with open(os.path.join(path, "info_noradar.json"), "rb") as f:
+                self.assertEqual(len(orjson.loads(f.read())), 12)
+            with open(os.path.join(path, "main_index.csv"), "rt") as f:
+                lines = f.readlines()
+            self.assertEqual(lines[0], "0\n")
+            self.assertEqual(len(lines), 13)
+
+            with av.open(os.path.join(path, "main.h265"), format="hevc") as vid:
+                frames = list(vid.decode())
+            self.assertEqual(len(frames), 12)
+            self.assertEqual((frames[0].width, frames[0].height), (64, 48))
+            self.assertEqual([f.key_frame for f in frames].count(True), 2)
+
+    def test_synthetic_frame(self) -> None:
+        frame = synthetic_frame(3, 64, 48)
+        self.assertEqual(frame.shape, (48, 64, 3))
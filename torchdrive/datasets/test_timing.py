@@ -0,0 +1,32 @@
+import pickle
+import unittest
+
+from torchdrive.datasets.timing import StageTimer
+
+
+class TestTiming(unittest.TestCase):
+    def test_stage_timer(self) -> None:
+        timer = StageTimer(enabled=True)
+        with timer.stage("a"):
+            pass
+        with timer.stage("a"):
+            pass
+        timer.add("b", 2.0)
+        times = timer.pop()
+        self.assertCountEqual(times.keys(), ["a", "b"])
+        self.assertGreater(times["a"], 0)
+        self.assertEqual(times["b"], 2.0)
+        self.assertEqual(timer.pop(), {})
+
+    def test_disabled(self) -> None:
+        timer = StageTimer()
+        with timer.stage("a"):
+            pass
+        self.assertEqual(timer.pop(), {})
+
+    def test_pickle(self) -> None:
+        timer = StageTimer(enabled=True)
+        timer.add("a", 1.0)
+        timer = pickle.loads(pickle.dumps(timer))
+        self.assertTrue(timer.enabled)
+        self.assertEqual(timer.pop(), {})
@@ -0,0 +1,93 @@
+import os
+import tempfile
+import unittest
+from typing import List, Optional, Sequence
+from unittest.mock import MagicMock, patch
+
+import torch
+
+from torchdrive.datasets.rice import MultiCamDataset
+from torchdrive.datasets.synthetic import write_dataset
+from torchdrive.datasets.window import SlidingWindowDataset
+
+
+def _fake_dataset() -> MagicMock:
+    dataset = MagicMock()
+    dataset.dynamic = True
+    dataset.frames = [("drive1", i) for i in range(10, 40)] + [
+        ("drive2", i) for i in range(10, 25)
+    ]
+
+    def get_window(path: str, idxs: List[int]) -> Sequence[Optional[tuple]]:
+        return [(path, idx) for idx in idxs]
+
+    dataset.get_window.side_effect = get_window
+    return dataset
+
+
+class TestWindow(unittest.TestCase):
+    def test_windows(self) -> None:
+        dataset = _fake_dataset()
+        ds = SlidingWindowDataset(dataset, window_size=4, stride=2)
+        self.assertEqual(ds.windows[0], ("drive1", [10, 12, 14, 16]))
+        self.assertEqual(ds.windows[-1], ("drive2", [18, 20, 22, 24]))
+        self.assertEqual(sum(len(idxs) for _, idxs in ds.windows), 23)
+
+        out = list(ds)
+        self.assertEqual(len(out), len(ds))
+        self.assertEqual(len(set(out)), len(out))
+        self.assertEqual(dataset.get_window.call_count, len(ds.windows))
+
+    def test_shuffle_buffer(self) -> None:
+        dataset = _fake_dataset()
+        ds = SlidingWindowDataset(dataset, window_size=9, shuffle_buffer=5, seed=1)
+        a = list(ds)
+        self.assertCountEqual(a, dataset.frames)
+        self.assertEqual(a, list(ds))
+        ds.set_epoch(1)
+        b = list(ds)
+        self.assertNotEqual(a, b)
+        self.assertCountEqual(a, b)
+
+    def test_ranks(self) -> None:
+        dataset = _fake_dataset()
+        out = []
+        for rank in range(2):
+            ds = SlidingWindowDataset(
+                dataset, window_size=4, shuffle_buffer=3, num_replicas=2, rank=rank
+            )
+            rank_out = list(ds)
+            self.assertEqual(len(rank_out), len(ds))
+            out += rank_out
+        self.assertEqual(len(set(out)), len(out))
+
+    def test_sparse_window(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            write_dataset(tmpdir, 1, ["main"], 60, width=64, height=48)
+            dataset = MultiCamDataset(
+                index_file=os.path.join(tmpdir, "index.txt"),
+                mask_dir=os.path.join(tmpdir, "masks"),
+                cameras=["main"],
+                dynamic=True,
+                cam_shape=(48, 64),
+                nframes_per_point=3,
+            )
+            # stride > nframes_per_point leaves unused frames between examples
+            ds = SlidingWindowDataset(dataset, window_size=3, stride=5)
+            path, idxs = ds.windows[0]
+            self.assertEqual(len(idxs), 3)
+
+            with patch.object(
+                dataset, "_load_cameras", wraps=dataset._load_cameras
+            ) as load_cameras:
+                window = dataset.get_window(path, idxs)
+            load_cameras.assert_called_once()
+            frames = load_cameras.call_args.args[1]
+            self.assertEqual(len(frames), 3 * 3)
+            self.assertEqual(frames, [idx + i for idx in idxs for i in range(3)])
+
+            for batch, idx in zip(window, idxs):
+                want = dataset[dataset.frames.index((path, idx))]
+                self.assertEqual(batch.frame_ids, want.frame_ids)
+                torch.testing.assert_close(batch.color, want.color)
+                torch.testing.assert_close(batch.cam_T, want.cam_T)
@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+from types import TracebackType
+from typing import ContextManager, Dict, Optional, Type
+
+
+class _Stage:
+    def __init__(self, timer: "StageTimer", name: str) -> None:
+        self.timer = timer
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc: Optional[BaseException],
+        tb: Optional[TracebackType],
+    ) -> None:
+        self.timer.add(self.name, time.perf_counter() - self.start)
+
+
+_DISABLED: ContextManager[None] = nullcontext()
+
+
+class StageTimer:
+    """
+    StageTimer accumulates the wall time spent in named stages.
+
+    When disabled stage() returns a shared no-op context manager so it can be
+    left in the data loading hot paths. It's thread safe, times recorded
+    concurrently from multiple threads are summed.
+
+    The accumulated times and lock are dropped when pickled.
+    """
+
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self.times: Dict[str, float] = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> Dict[str, object]:
+        return {"enabled": self.enabled}
+
+    def __setstate__(self, state: Dict[str, object]) -> None:
+        self.__init__(state["enabled"])  # pyre-fixme[6]
+
+    def stage(self, name: str) -> ContextManager[None]:
+        """
+        Returns a context manager that records the time spent in it under
+        name.
+        """
+        if not self.enabled:
+            return _DISABLED
+        return _Stage(self, name)
+
+    def add(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.times[name] += seconds
+
+    def pop(self) -> Dict[str, float]:
+        """
+        Returns the accumulated times in seconds and resets them.
+        """
+        with self._lock:
+            times = dict(self.times)
+            self.times.clear()
+        return times
@@ -0,0 +1,135 @@
+import random
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import torch
+from torch.utils.data import get_worker_info, IterableDataset
+
+from torchdrive.data import Batch
+from torchdrive.datasets.rice import MultiCamDataset
+
+# (path, example start frames)
+Window = Tuple[str, List[int]]
+
+
+class SlidingWindowDataset(IterableDataset):
+    """
+    SlidingWindowDataset wraps a dynamic MultiCamDataset and decodes a
+    contiguous run of frames per camera once to produce several overlapping
+    examples.
+
+    Each window covers window_size * stride frames of a drive and produces
+    the examples starting every stride frames within it. The windows are
+    shuffled per epoch and split between the ranks and DataLoader workers.
+    Since the examples from a window are highly correlated, they're mixed
+    with the other windows through a shuffle buffer.
+
+    Every worker on every rank produces the same number of examples so DDP
+    ranks stay in sync. Like MultiCamDataset, examples that fail to decode
+    are returned as None.
+    """
+
+    def __init__(
+        self,
+        dataset: MultiCamDataset,
+        window_size: int = 9,
+        stride: int = 1,
+        shuffle_buffer: int = 0,
+        seed: int = 0,
+        num_replicas: int = 1,
+        rank: int = 0,
+        num_workers: int = 0,
+    ) -> None:
+        """
+        Args:
+            dataset: the dataset to load the examples from, must be dynamic
+            window_size: max number of examples per decoded window
+            stride: number of frames between examples in a window
+            shuffle_buffer: number of examples to shuffle between windows
+            seed: random seed, must be the same on all ranks
+            num_replicas: number of distributed processes
+            rank: rank of the current process
+            num_workers: number of DataLoader workers
+        """
+        assert dataset.dynamic, "SlidingWindowDataset requires a dynamic dataset"
+        assert window_size > 0 and stride > 0
+        self.dataset = dataset
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_workers: int = max(num_workers, 1)
+
+        path_frames: Dict[str, List[int]] = defaultdict(list)
+        for path, idx in dataset.frames:
+            path_frames[path].append(idx)
+
+        self.windows: List[Window] = []
+        for path, idxs in path_frames.items():
+            valid = set(idxs)
+            for start in range(min(idxs), max(idxs) + 1, window_size * stride):
+                window = [
+                    idx
+                    for idx in range(start, start + window_size * stride, stride)
+                    if idx in valid
+                ]
+                if len(window) > 0:
+                    self.windows.append((path, window))
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _lanes(self) -> Tuple[List[List[Window]], int]:
+        """
+        Returns the windows for each (rank, worker) lane for the current epoch
+        and the number of examples per lane.
+        """
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(len(self.windows), generator=g).tolist()
+        windows = [self.windows[i] for i in order]
+
+        num_lanes = self.num_replicas * self.num_workers
+        lanes = [windows[i::num_lanes] for i in range(num_lanes)]
+        num_samples = min(sum(len(idxs) for _, idxs in lane) for lane in lanes)
+        return lanes, num_samples
+
+    def __len__(self) -> int:
+        _, num_samples = self._lanes()
+        return num_samples * self.num_workers
+
+    def _examples(self, windows: List[Window]) -> Iterator[Optional[Batch]]:
+        for path, idxs in windows:
+            yield from self.dataset.get_window(path, idxs)
+
+    def __iter__(self) -> Iterator[Optional[Batch]]:
+        worker_info = get_worker_info()
+        worker_id = 0
+        if worker_info is not None:
+            assert (
+                worker_info.num_workers == self.num_workers
+            ), f"expected {self.num_workers} workers, got {worker_info.num_workers}"
+            worker_id = worker_info.id
+
+        lanes, num_samples = self._lanes()
+        lane_id = self.rank * self.num_workers + worker_id
+        rng = random.Random(self.seed + self.epoch * len(lanes) + lane_id)
+
+        count = 0
+        buffer: List[Optional[Batch]] = []
+        examples = self._examples(lanes[lane_id])
+        # every lane has at least num_samples examples
+        while count + len(buffer) < num_samples:
+            example = next(examples)
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(example)
+                continue
+            if len(buffer) > 0:
+                i = rng.randrange(len(buffer))
+                buffer[i], example = example, buffer[i]
+            yield example
+            count += 1
+
+        rng.shuffle(buffer)
+        yield from buffer
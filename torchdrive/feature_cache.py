@@ -0,0 +1,90 @@
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+import torch
+
+
+class FeatureCache:
+    """
+    FeatureCache is a bounded LRU cache of detached per frame features such as
+    the camera encoder outputs for the frames that aren't backpropagated
+    through.
+
+    Entries are keyed by an arbitrary key, typically (drive, camera, frame),
+    and tagged with the version of the weights that produced them, typically
+    the global step. An entry is only returned if it's at most max_staleness
+    versions older than the requested version so max_staleness=0 only reuses
+    features within the same step.
+
+    The least recently used entries are evicted once the cached tensors
+    exceed max_bytes.
+    """
+
+    def __init__(self, max_bytes: int, max_staleness: int = 0) -> None:
+        self.max_bytes = max_bytes
+        self.max_staleness = max_staleness
+        self.entries: OrderedDict[Hashable, Tuple[int, torch.Tensor]] = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Hashable, version: int) -> Optional[torch.Tensor]:
+        """
+        Returns the cached features for key if they're fresh enough for the
+        version.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        entry_version, value = entry
+        if version - entry_version > self.max_staleness:
+            self._remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, version: int, value: torch.Tensor) -> None:
+        """
+        Caches a copy of the features for key computed with the weights at
+        version. The copy avoids keeping the rest of the batch alive when value
+        is a view.
+        """
+        if key in self.entries:
+            self._remove(key)
+        value = value.detach().clone()
+        nbytes = value.numel() * value.element_size()
+        if nbytes > self.max_bytes:
+            return
+        self.entries[key] = (version, value)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key: Hashable) -> None:
+        _, value = self.entries.pop(key)
+        self.nbytes -= value.numel() * value.element_size()
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns the hit rate and size since the last call and resets the
+        counters.
+        """
+        total = self.hits + self.misses
+        out = {
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": float(len(self.entries)),
+            "mb": self.nbytes / 2**20,
+        }
+        self.hits = 0
+        self.misses = 0
+        return out
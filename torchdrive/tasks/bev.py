@@ -1,16 +1,20 @@
 import random
 import time
 from abc import ABC, abstractmethod
-from typing import Callable, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from typing import Callable, cast, Dict, List, Optional, Tuple
 
 import torch
 from torch import nn
 from torch.cuda import amp
+from torch.func import functional_call, vmap
 from torch.utils.tensorboard import SummaryWriter
 
 from torchdrive.amp import autocast
 from torchdrive.autograd import autograd_pause, autograd_resume, log_grad_norm
 from torchdrive.data import Batch
+from torchdrive.feature_cache import FeatureCache
 from torchdrive.models.bev_backbone import BEVBackbone
 from torchdrive.tasks.context import Context
 from torchdrive.transforms.batch import BatchTransform, Identity
@@ -24,6 +28,48 @@ def _get_orig_mod(m: nn.Module) -> nn.Module:
     return m
 
 
+def _vmap_forward(modules: List[nn.Module], x: torch.Tensor) -> torch.Tensor:
+    """
+    Runs each module on the corresponding entry of x in a single vmapped call.
+
+    The modules must have the same architecture. The parameters are stacked
+    every call so the gradients flow back to each module's own parameters and
+    the updated buffers such as BatchNorm running statistics are copied back.
+    torch.compile wrappers are bypassed.
+
+    Args:
+        modules: the N modules to run
+        x: [N, ...] the per module inputs
+    Returns:
+        [N, ...] the stacked outputs
+    """
+    modules = [_get_orig_mod(m) for m in modules]
+    named_params = [dict(m.named_parameters()) for m in modules]
+    named_buffers = [dict(m.named_buffers()) for m in modules]
+    params = {
+        name: torch.stack([p[name] for p in named_params]) for name in named_params[0]
+    }
+    buffers = {
+        name: torch.stack([b[name] for b in named_buffers]) for name in named_buffers[0]
+    }
+
+    def call(
+        params: Dict[str, torch.Tensor],
+        buffers: Dict[str, torch.Tensor],
+        x: torch.Tensor,
+    ) -> torch.Tensor:
+        return functional_call(modules[0], (params, buffers), (x,))
+
+    out = vmap(call, randomness="different")(params, buffers, x)
+
+    with torch.no_grad():
+        for name, stacked in buffers.items():
+            for b, buf in zip(named_buffers, stacked):
+                b[name].copy_(buf)
+
+    return out
+
+
 class BEVTask(torch.nn.Module, ABC):
     @abstractmethod
     def forward(
@@ -51,6 +97,9 @@ class BEVTaskVan(torch.nn.Module):
         num_drop_encode_cameras: int = 0,
         transform: BatchTransform = Identity(),
         compile_fn: Callable[[nn.Module], nn.Module] = lambda m: m,
+        encoder_batching: str = "none",
+        feature_cache: Optional[FeatureCache] = None,
+        concurrent_tasks: bool = False,
     ) -> None:
         """
         Args:
@@ -59,6 +108,21 @@ class BEVTaskVan(torch.nn.Module):
             num_encode_frames: number of frames to merge for the encoders
             num_backprop_frames: number of frames to run backprop for
             num_drop_encode_cameras: drop input camera features
+            encoder_batching: how to batch the camera encoder calls.
+                "none" calls each camera encoder once per frame.
+                "frames" stacks the frames of each camera into a single call
+                for the non-backprop frames and one for the backprop frames.
+                "cameras" additionally runs all the cameras in the same call
+                by vmapping over the stacked per camera weights.
+                Batching changes the BatchNorm statistics in training mode
+                since they're computed across all frames in the call.
+            feature_cache: optional cache of the encoder outputs for the
+                frames that aren't backpropagated through, keyed by
+                (drive, camera, frame) and versioned by the global step so
+                nearby examples can reuse them.
+            concurrent_tasks: run the forward and backward passes of all the
+                tasks concurrently on a thread pool, each on its own CUDA
+                stream on GPU.
         """
 
         super().__init__()
@@ -70,6 +134,13 @@ class BEVTaskVan(torch.nn.Module):
         self.num_backprop_frames = num_backprop_frames
         self.transform = transform
         self.num_drop_encode_cameras = num_drop_encode_cameras
+        if encoder_batching not in ("none", "frames", "cameras"):
+            raise ValueError(f"unknown encoder_batching {encoder_batching}")
+        self.encoder_batching = encoder_batching
+        self.feature_cache = feature_cache
+        self.concurrent_tasks = concurrent_tasks
+        self._task_pool: Optional[ThreadPoolExecutor] = None
+        self._task_streams: Dict[str, torch.cuda.Stream] = {}
 
         self.backbone: nn.Module = backbone
         self.camera_encoders = nn.ModuleDict(
@@ -88,9 +159,10 @@ class BEVTaskVan(torch.nn.Module):
         if self.writer is None:
             return False, False
 
-        log_interval = 1000 // BS
+        # clamp so large (e.g. accumulated) batches log every step
+        log_interval = max(1000 // BS, 1)
         should_log = (global_step % log_interval) == 0
-        log_text_interval = log_interval // 10
+        log_text_interval = max(log_interval // 10, 1)
         log_text = (global_step % log_text_interval) == 0
 
         return should_log, log_text
@@ -106,12 +178,235 @@ class BEVTaskVan(torch.nn.Module):
             {"name": "per_cam", "params": per_cam_params, "lr": per_cam_lr},
         ]
 
+    def _encode_cameras(
+        self,
+        color: Dict[str, torch.Tensor],
+        cameras: List[str],
+        first_backprop_frame: int,
+        frame_ids: Optional[List[List[Tuple[str, int]]]] = None,
+        version: int = 0,
+    ) -> Dict[str, List[torch.Tensor]]:
+        """
+        Runs the camera encoders on the first num_encode_frames frames.
+
+        Args:
+            color: the per camera [BS, N, 3, H, W] frames
+            cameras: the cameras to encode
+            first_backprop_frame: the features for the frames before this are
+                computed without autograd
+            frame_ids: the batch frame ids for the feature cache
+            version: the weights version for the feature cache
+        Returns:
+            the per camera list of [BS, ...] features for each frame
+        """
+        camera_feats: Dict[str, List[torch.Tensor]] = {cam: [] for cam in cameras}
+        if first_backprop_frame > 0:
+            feats = self._encode_detached(
+                color, cameras, 0, first_backprop_frame, frame_ids, version
+            )
+            for cam in cameras:
+                camera_feats[cam] += feats[cam]
+        if first_backprop_frame < self.num_encode_frames:
+            feats = self._encode_frames(
+                color, cameras, first_backprop_frame, self.num_encode_frames
+            )
+            for cam in cameras:
+                camera_feats[cam] += feats[cam]
+        return camera_feats
+
+    def _encode_frames(
+        self,
+        color: Dict[str, torch.Tensor],
+        cameras: List[str],
+        start: int,
+        end: int,
+    ) -> Dict[str, List[torch.Tensor]]:
+        """
+        Runs the camera encoders on frames [start, end) batched according to
+        encoder_batching.
+        """
+        if self.encoder_batching == "none":
+            camera_feats: Dict[str, List[torch.Tensor]] = {cam: [] for cam in cameras}
+            for frame in range(start, end):
+                for cam in cameras:
+                    camera_feats[cam].append(
+                        self.camera_encoders[cam](color[cam][:, frame])
+                    )
+            return camera_feats
+
+        # frame major so the per frame outputs are contiguous
+        # [BS, F, 3, H, W] -> [F*BS, 3, H, W]
+        inputs = [
+            color[cam][:, start:end].transpose(0, 1).flatten(0, 1) for cam in cameras
+        ]
+        if self.encoder_batching == "cameras" and len(cameras) > 1:
+            outs = _vmap_forward(
+                [self.camera_encoders[cam] for cam in cameras],
+                torch.stack(inputs),
+            ).unbind(0)
+        else:
+            outs = [self.camera_encoders[cam](x) for cam, x in zip(cameras, inputs)]
+        return {
+            cam: list(out.unflatten(0, (end - start, -1)).unbind(0))
+            for cam, out in zip(cameras, outs)
+        }
+
+    def _encode_detached(
+        self,
+        color: Dict[str, torch.Tensor],
+        cameras: List[str],
+        start: int,
+        end: int,
+        frame_ids: Optional[List[List[Tuple[str, int]]]],
+        version: int,
+    ) -> Dict[str, List[torch.Tensor]]:
+        """
+        Runs the camera encoders on frames [start, end) under inference_mode.
+
+        If there's a feature cache and the batch has frame ids, the cached
+        frames are reused and the remaining frames are encoded with a single
+        call per camera.
+        """
+        cache = self.feature_cache
+        if cache is None or frame_ids is None:
+            with torch.inference_mode():
+                feats = self._encode_frames(color, cameras, start, end)
+            # inference tensors can't be saved for backward by the backbone
+            return {cam: [f.clone() for f in fs] for cam, fs in feats.items()}
+
+        BS = len(frame_ids)
+        camera_feats = {}
+        for cam in cameras:
+            # frame major
+            keys = [
+                (frame_ids[b][frame][0], cam, frame_ids[b][frame][1])
+                for frame in range(start, end)
+                for b in range(BS)
+            ]
+            feats: List[Optional[torch.Tensor]] = [
+                cache.get(key, version) for key in keys
+            ]
+            # first index of each missing frame, frames can be shared by
+            # multiple examples in the batch
+            missing: Dict[Tuple[str, str, int], int] = {}
+            for i, (key, feat) in enumerate(zip(keys, feats)):
+                if feat is None and key not in missing:
+                    missing[key] = i
+            if len(missing) > 0:
+                idxs = list(missing.values())
+                x = color[cam][[i % BS for i in idxs], [start + i // BS for i in idxs]]
+                with torch.inference_mode():
+                    out = self.camera_encoders[cam](x)
+                out = out.clone()
+                computed = dict(zip(missing.keys(), out.unbind(0)))
+                for key, feat in computed.items():
+                    cache.put(key, version, feat)
+                feats = [
+                    computed[key] if feat is None else feat
+                    for key, feat in zip(keys, feats)
+                ]
+            stacked = torch.stack(cast(List[torch.Tensor], feats))
+            camera_feats[cam] = list(stacked.unflatten(0, (end - start, BS)).unbind(0))
+        return camera_feats
+
+    def _run_tasks_concurrent(
+        self,
+        ctx: Context,
+        groups: List[Tuple[str, nn.ModuleDict, torch.Tensor]],
+        run_task: Callable[[Context, str, str, nn.Module, torch.Tensor], None],
+    ) -> None:
+        """
+        Runs all the tasks concurrently on a thread pool and on GPU each on its
+        own CUDA stream.
+
+        Each task gets its own paused copy of the BEV grid and camera features
+        as well as its own Context. The gradients from all the tasks are
+        accumulated into the shared tensors on the calling thread once all the
+        tasks finish.
+        """
+        pool = self._task_pool
+        if pool is None:
+            num_tasks = len(self.tasks) + len(self.hr_tasks)
+            pool = ThreadPoolExecutor(max_workers=num_tasks)
+            self._task_pool = pool
+
+        device = groups[0][2].device
+        main_stream: Optional[torch.cuda.Stream] = None
+        if device.type == "cuda":
+            main_stream = torch.cuda.current_stream(device)
+
+        def run_on_stream(
+            task_ctx: Context,
+            task_type: str,
+            name: str,
+            task: nn.Module,
+            task_bev: torch.Tensor,
+        ) -> None:
+            if main_stream is None:
+                run_task(task_ctx, task_type, name, task, task_bev)
+                return
+            stream = self._task_streams.get(name)
+            if stream is None:
+                stream = torch.cuda.Stream(device)
+                self._task_streams[name] = stream
+            # wait for the BEV grids and camera features
+            stream.wait_stream(main_stream)
+            with torch.cuda.stream(stream):
+                run_task(task_ctx, task_type, name, task, task_bev)
+            main_stream.wait_stream(stream)
+
+        paused: List[torch.Tensor] = []
+        futures = []
+        for task_type, tasks, shared_bev in groups:
+            for name, task in tasks.items():
+                task_bev = autograd_pause(shared_bev)
+                task_cam_feats = {
+                    cam: autograd_pause(feat) for cam, feat in ctx.cam_feats.items()
+                }
+                paused.append(task_bev)
+                paused += task_cam_feats.values()
+                task_ctx = replace(ctx, name=name, cam_feats=task_cam_feats)
+                futures.append(
+                    pool.submit(
+                        run_on_stream, task_ctx, task_type, name, task, task_bev
+                    )
+                )
+        for future in futures:
+            future.result()
+
+        # accumulate the per task gradients into the shared tensors
+        with_grad = [t for t in paused if t.grad is not None]
+        if len(with_grad) > 0:
+            autograd_resume(*with_grad)
+
     def forward(
-        self, batch: Batch, global_step: int, scaler: Optional[amp.GradScaler] = None
+        self,
+        batch: Batch,
+        global_step: int,
+        scaler: Optional[amp.GradScaler] = None,
+        log: bool = True,
     ) -> Dict[str, torch.Tensor]:
+        """
+        Args:
+            batch: the batch or micro-batch to train on
+            global_step: the optimizer step
+            scaler: the grad scaler for fp16
+            log: whether to log, set to False for all but one micro-batch of
+                an accumulated step
+
+        Returns:
+            the losses and metrics, scaled so summing them over the
+            micro-batches of an accumulated step gives the step's value
+        """
         BS = len(batch.distances)
+        # losses are weighted by batch.weight but metrics need to be averaged
+        # over the micro-batches
+        metric_scale = BS / max(batch.global_batch_size, BS)
         log_text: bool
-        log_img, log_text = self.should_log(global_step, BS)
+        # global_batch_size includes the other micro-batches when accumulating
+        log_img, log_text = self.should_log(global_step, batch.global_batch_size)
+        if not log:
+            log_img, log_text = False, False
 
         start_frame = self.num_encode_frames - 1
 
@@ -121,38 +416,37 @@ class BEVTaskVan(torch.nn.Module):
 
         # optionally dropout a camera to prevent overfitting
         drop_cameras = random.choices(self.cameras, k=self.num_drop_encode_cameras)
-        dropout_cameras = set(self.cameras) - set(drop_cameras)
+        dropout_cameras = [cam for cam in self.cameras if cam not in drop_cameras]
 
         with autocast():
             first_backprop_frame = max(
                 self.num_encode_frames - self.num_backprop_frames, 0
             )
-            camera_feats = {cam: [] for cam in dropout_cameras}
-            for frame in range(0, first_backprop_frame):
-                for cam in dropout_cameras:
-                    out = self.camera_encoders[cam](batch.color[cam][:, frame]).detach()
-                    assert not out.requires_grad
-                    camera_feats[cam].append(out)
-            for frame in range(first_backprop_frame, self.num_encode_frames):
-                pause = frame == (self.num_encode_frames - 1)
+            camera_feats = self._encode_cameras(
+                batch.color,
+                dropout_cameras,
+                first_backprop_frame,
+                frame_ids=batch.frame_ids,
+                version=global_step,
+            )
+            if first_backprop_frame < self.num_encode_frames:
                 for cam in dropout_cameras:
-                    feat = self.camera_encoders[cam](batch.color[cam][:, frame])
+                    feat = camera_feats[cam][-1]
 
                     # pause the last cam encoder backprop for tasks with image
                     # space losses
-                    if pause:
-                        feat = autograd_pause(feat)
-                        last_cam_feats[cam] = feat
-
-                        if log_text:
-                            feat = log_grad_norm(
-                                feat,
-                                self.writer,
-                                f"grad/norm/encoder/{cam}",
-                                "bev",
-                                global_step,
-                            )
-                    camera_feats[cam].append(feat)
+                    feat = autograd_pause(feat)
+                    last_cam_feats[cam] = feat
+
+                    if log_text:
+                        feat = log_grad_norm(
+                            feat,
+                            self.writer,
+                            f"grad/norm/encoder/{cam}",
+                            "bev",
+                            global_step,
+                        )
+                    camera_feats[cam][-1] = feat
 
         hr_bev, bev = self.backbone(camera_feats, batch)
 
@@ -198,36 +492,51 @@ class BEVTaskVan(torch.nn.Module):
             cam_feats=last_cam_feats,
         )
 
-        def _run_tasks(
-            task_type: str, tasks: nn.ModuleDict, task_bev: torch.Tensor
+        def _run_task(
+            task_ctx: Context,
+            task_type: str,
+            name: str,
+            task: nn.Module,
+            task_bev: torch.Tensor,
         ) -> None:
-            for name, task in tasks.items():
-                with torch.autograd.profiler.record_function(name):
-                    ctx.name = name
-
-                    task_start = time.time()
-                    per_task_bev = task_bev
-                    if log_text:
-                        per_task_bev = log_grad_norm(
-                            per_task_bev,
-                            self.writer,
-                            f"grad/norm/{task_type}",
-                            name,
-                            global_step,
-                        )
-                    task_losses = task(ctx, batch, per_task_bev)
-                    ctx.backward(task_losses)
-
-                    for k, v in task_losses.items():
-                        losses[name + "-" + k] = v
-
-                    task_times[name] = time.time() - task_start
-
+            with torch.autograd.profiler.record_function(name):
+                task_start = time.time()
+                per_task_bev = task_bev
+                if log_text:
+                    per_task_bev = log_grad_norm(
+                        per_task_bev,
+                        self.writer,
+                        f"grad/norm/{task_type}",
+                        name,
+                        global_step,
+                    )
+                task_losses = task(task_ctx, batch, per_task_bev)
+                metrics = {k for k, v in task_losses.items() if not v.requires_grad}
+                task_ctx.backward(task_losses)
+
+                for k, v in task_losses.items():
+                    if k in metrics and metric_scale != 1:
+                        v = v * metric_scale
+                    losses[name + "-" + k] = v
+
+                task_times[name] = time.time() - task_start
+
+        groups: List[Tuple[str, nn.ModuleDict, torch.Tensor]] = []
         if len(self.tasks) > 0:
-            _run_tasks("bev", self.tasks, bev)
-
+            groups.append(("bev", self.tasks, bev))
         if len(self.hr_tasks) > 0:
-            _run_tasks("hr_bev", self.hr_tasks, hr_bev)
+            groups.append(("hr_bev", self.hr_tasks, hr_bev))
+
+        tasks_start = time.time()
+        if self.concurrent_tasks:
+            self._run_tasks_concurrent(ctx, groups, _run_task)
+        else:
+            for task_type, tasks, task_bev in groups:
+                for name, task in tasks.items():
+                    ctx.name = name
+                    _run_task(ctx, task_type, name, task, task_bev)
+        # with concurrent tasks this is less than the sum of the task times
+        task_times["wall"] = time.time() - tasks_start
 
         if log_text and (writer := self.writer) is not None:
             writer.add_scalars(
@@ -235,6 +544,17 @@ class BEVTaskVan(torch.nn.Module):
                 task_times,
                 global_step=global_step,
             )
+            if (cache := self.feature_cache) is not None:
+                writer.add_scalars(
+                    "feature_cache", cache.stats(), global_step=global_step
+                )
+            if (load_times := batch.load_times) is not None:
+                # mean per example loading time
+                writer.add_scalars(
+                    "load_times",
+                    {k: v / BS for k, v in load_times.items()},
+                    global_step=global_step,
+                )
 
         # resume grad
         to_resume = []
@@ -1,15 +1,23 @@
 import unittest
+from dataclasses import replace
 from typing import Dict
 from unittest.mock import call, MagicMock
 
 import torch
+from torch import nn
 from torchvision import models
 
-from torchdrive.data import Batch, dummy_batch
+from torchdrive.data import Batch, dummy_batch, PackedBatch
+from torchdrive.feature_cache import FeatureCache
 from torchdrive.models.bev import RiceBackbone
 from torchdrive.models.regnet import RegNetEncoder
 from torchdrive.tasks.bev import BEVTask, BEVTaskVan, Context
-from torchdrive.transforms.batch import Compose, NormalizeCarPosition, RandomRotation
+from torchdrive.transforms.batch import (
+    Compose,
+    NormalizeCarPosition,
+    RandomRotation,
+    RandomTranslation,
+)
 
 
 class DummyBEVTask(BEVTask):
@@ -86,3 +94,292 @@ class TestBEV(unittest.TestCase):
             ],
         )
         self.assertEqual(len(m.param_opts(lr=1e-4)), 2)
+
+        # only one micro-batch of an accumulated step logs
+        m(dummy_batch(), global_step=500, log=False)
+        self.assertEqual(writer.add_scalar.call_count, 2)
+
+    def test_should_log(self) -> None:
+        m = BEVTaskVan(
+            tasks={},
+            hr_tasks={"dummy": DummyBEVTask()},
+            cam_shape=(48, 64),
+            bev_shape=(4, 4),
+            cameras=["left"],
+            dim=8,
+            hr_dim=1,
+            writer=MagicMock(),
+            backbone=MagicMock(),
+            cam_encoder=nn.Identity,
+        )
+        self.assertEqual(m.should_log(0, BS=2), (True, True))
+        self.assertEqual(m.should_log(50, BS=2), (False, True))
+        self.assertEqual(m.should_log(51, BS=2), (False, False))
+        # large accumulated batches log every step
+        self.assertEqual(m.should_log(1, BS=128), (False, True))
+        self.assertEqual(m.should_log(7, BS=128), (True, True))
+        self.assertEqual(m.should_log(1, BS=2000), (True, True))
+
+    def test_encoder_batching(self) -> None:
+        cameras = ["left", "right"]
+        dim = 8
+        vans = []
+        for encoder_batching in ("none", "frames", "cameras"):
+            torch.manual_seed(0)
+            vans.append(
+                BEVTaskVan(
+                    tasks={"dummy": DummyBEVTask()},
+                    hr_tasks={},
+                    cam_shape=(48, 64),
+                    bev_shape=(4, 4),
+                    cameras=cameras,
+                    dim=dim,
+                    hr_dim=1,
+                    num_encode_frames=2,
+                    num_backprop_frames=1,
+                    backbone=MagicMock(),
+                    cam_encoder=lambda: nn.Sequential(
+                        nn.Conv2d(3, dim, 16, stride=16),
+                        nn.BatchNorm2d(dim),
+                    ),
+                    encoder_batching=encoder_batching,
+                )
+            )
+        color = dummy_batch().color
+        want = vans[0]._encode_cameras(color, cameras, first_backprop_frame=1)
+        for m in vans[1:]:
+            out = m._encode_cameras(color, cameras, first_backprop_frame=1)
+            for cam in cameras:
+                self.assertEqual(len(out[cam]), 2)
+                self.assertFalse(out[cam][0].requires_grad)
+                self.assertTrue(out[cam][1].requires_grad)
+                self.assertEqual(out[cam][1].shape, (2, dim, 3, 4))
+                # each frame has its own batch statistics when unbatched
+                torch.testing.assert_close(out[cam][0], want[cam][0])
+                torch.testing.assert_close(out[cam][1], want[cam][1])
+
+            sum(out[cam][1].sum() for cam in cameras).backward()
+            for cam in cameras:
+                encoder = m.camera_encoders[cam]
+                self.assertIsNotNone(encoder[0].weight.grad)
+                # running statistics are updated per camera
+                torch.testing.assert_close(
+                    encoder[1].running_mean,
+                    vans[0].camera_encoders[cam][1].running_mean,
+                )
+
+        # with fixed statistics all frames can be encoded in the same call
+        for m in vans:
+            m.eval()
+        want = vans[0]._encode_cameras(color, cameras, first_backprop_frame=0)
+        for m in vans[1:]:
+            out = m._encode_cameras(color, cameras, first_backprop_frame=0)
+            torch.testing.assert_close(out, want)
+
+        with self.assertRaisesRegex(ValueError, "encoder_batching"):
+            BEVTaskVan(
+                tasks={},
+                hr_tasks={},
+                cam_shape=(48, 64),
+                bev_shape=(4, 4),
+                cameras=cameras,
+                dim=dim,
+                hr_dim=1,
+                backbone=MagicMock(),
+                cam_encoder=nn.Identity,
+                encoder_batching="invalid",
+            )
+
+    def test_feature_cache(self) -> None:
+        cameras = ["left", "right"]
+        dim = 8
+        torch.manual_seed(0)
+        m = BEVTaskVan(
+            tasks={"dummy": DummyBEVTask()},
+            hr_tasks={},
+            cam_shape=(48, 64),
+            bev_shape=(4, 4),
+            cameras=cameras,
+            dim=dim,
+            hr_dim=1,
+            num_encode_frames=3,
+            num_backprop_frames=1,
+            backbone=MagicMock(),
+            cam_encoder=lambda: nn.Sequential(
+                nn.Conv2d(3, dim, 16, stride=16),
+                nn.BatchNorm2d(dim),
+            ),
+            feature_cache=FeatureCache(max_bytes=2**20, max_staleness=1),
+        )
+        m.eval()
+        color = dummy_batch().color
+        want = m._encode_cameras(color, cameras, first_backprop_frame=2)
+
+        # the second example is shifted by one frame so they share frame 1
+        frame_ids = [
+            [("drive", 0), ("drive", 1), ("drive", 2)],
+            [("drive", 1), ("drive", 2), ("drive", 3)],
+        ]
+        color = {
+            cam: torch.stack((c[0], torch.cat((c[0, 1:], c[0, :1])))).contiguous()
+            for cam, c in color.items()
+        }
+        for version in range(2):
+            out = m._encode_cameras(
+                color, cameras, 2, frame_ids=frame_ids, version=version
+            )
+            for cam in cameras:
+                self.assertEqual(len(out[cam]), 3)
+                self.assertFalse(out[cam][0].requires_grad)
+                self.assertFalse(out[cam][0].is_inference())
+                self.assertTrue(out[cam][2].requires_grad)
+                torch.testing.assert_close(out[cam][0][0], want[cam][0][0])
+                torch.testing.assert_close(out[cam][1][0], want[cam][1][0])
+                torch.testing.assert_close(out[cam][0][1], want[cam][1][0])
+
+        cache = m.feature_cache
+        # 3 unique frames per camera, all hits in the second step
+        self.assertEqual(len(cache), 6)
+        self.assertEqual(cache.hits, 8)
+
+        # stale features are recomputed
+        m._encode_cameras(color, cameras, 2, frame_ids=frame_ids, version=3)
+        self.assertEqual(cache.hits, 8)
+
+    def test_concurrent_tasks(self) -> None:
+        cameras = ["left", "right"]
+        dim = 8
+        hr_dim = 1
+        bev_shape = (4, 4)
+
+        class DummyCamTask(BEVTask):
+            def forward(
+                self, ctx: Context, batch: Batch, bev: torch.Tensor
+            ) -> Dict[str, torch.Tensor]:
+                ctx.add_scalar("test", 1)
+                cam_loss = sum(feat.mean() for feat in ctx.cam_feats.values())
+                return {"cam": cam_loss + bev.mean()}
+
+        batch = dummy_batch()
+        grads = []
+        for concurrent_tasks in (False, True):
+            torch.manual_seed(0)
+            m = BEVTaskVan(
+                tasks={"dummy": DummyBEVTask(), "cam": DummyCamTask()},
+                hr_tasks={"hr_dummy": DummyBEVTask()},
+                cam_shape=(48, 64),
+                bev_shape=bev_shape,
+                cameras=cameras,
+                dim=dim,
+                hr_dim=hr_dim,
+                num_encode_frames=2,
+                num_backprop_frames=1,
+                writer=MagicMock(),
+                backbone=RiceBackbone(
+                    dim=dim,
+                    cam_dim=dim,
+                    hr_dim=hr_dim,
+                    bev_shape=bev_shape,
+                    input_shape=(48 // 16, 64 // 16),
+                    num_frames=2,
+                    cameras=cameras,
+                    num_upsamples=1,
+                ),
+                cam_encoder=lambda: nn.Sequential(
+                    nn.Conv2d(3, dim, 16, stride=16),
+                    nn.BatchNorm2d(dim),
+                ),
+                transform=NormalizeCarPosition(start_frame=1),
+                concurrent_tasks=concurrent_tasks,
+            )
+            losses = m(batch, global_step=50)
+            self.assertCountEqual(
+                losses.keys(), ["dummy-foo", "cam-cam", "hr_dummy-foo"]
+            )
+            self.assertCountEqual(
+                m.writer.add_scalar.mock_calls,
+                [
+                    call("dummy-test", 4, global_step=50),
+                    call("cam-test", 1, global_step=50),
+                    call("hr_dummy-test", 8, global_step=50),
+                ],
+            )
+            (task_times,) = [
+                c.args[1]
+                for c in m.writer.add_scalars.mock_calls
+                if c.args[0] == "task_times"
+            ]
+            self.assertCountEqual(
+                task_times.keys(), ["dummy", "cam", "hr_dummy", "wall"]
+            )
+            grads.append({k: p.grad for k, p in m.named_parameters()})
+
+        want, got = grads
+        self.assertCountEqual(got.keys(), want.keys())
+        for k, grad in want.items():
+            self.assertIsNotNone(grad, k)
+            torch.testing.assert_close(got[k], grad, msg=k)
+
+        # metrics are averaged over the micro-batches of a step
+        m.writer = None
+        losses = m(replace(batch, global_batch_size=4), global_step=50, log=False)
+        self.assertEqual(losses["dummy-foo"], 2.5)
+
+    def test_packed_batch(self) -> None:
+        cameras = ["left", "right"]
+        dim = 8
+        bev_shape = (4, 4)
+        parts = []
+
+        class SplitTask(BEVTask):
+            def forward(
+                self, ctx: Context, batch: Batch, bev: torch.Tensor
+            ) -> Dict[str, torch.Tensor]:
+                parts.extend(batch.split(1))
+                return {"loss": bev.mean()}
+
+        m = BEVTaskVan(
+            tasks={},
+            hr_tasks={"split": SplitTask()},
+            cam_shape=(48, 64),
+            bev_shape=bev_shape,
+            cameras=cameras,
+            dim=dim,
+            hr_dim=1,
+            num_encode_frames=2,
+            num_backprop_frames=1,
+            backbone=RiceBackbone(
+                dim=dim,
+                cam_dim=dim,
+                hr_dim=1,
+                bev_shape=bev_shape,
+                input_shape=(48 // 16, 64 // 16),
+                num_frames=2,
+                cameras=cameras,
+                num_upsamples=1,
+            ),
+            cam_encoder=lambda: nn.Sequential(
+                nn.Conv2d(3, dim, 16, stride=16),
+                nn.BatchNorm2d(dim),
+            ),
+            transform=Compose(
+                NormalizeCarPosition(start_frame=1),
+                RandomRotation(),
+                RandomTranslation(distances=(5.0, 5.0, 0.0)),
+            ),
+        )
+        batch = PackedBatch.pack(dummy_batch())
+        m(batch, global_step=1)
+        # the car position transforms keep the packed buffers so the split
+        # is views into them
+        self.assertEqual(len(parts), 2)
+        for part in parts:
+            self.assertIsInstance(part, PackedBatch)
+            self.assertIsNotNone(part.buffers)
+        buf = parts[1].buffers[torch.float32]
+        self.assertEqual(
+            parts[1].cam_T.untyped_storage().data_ptr(),
+            buf.untyped_storage().data_ptr(),
+        )
+        # the transforms are applied to the packed copy
+        self.assertFalse(torch.equal(parts[0].cam_T, batch.cam_T[:1]))
@@ -2,8 +2,11 @@ import unittest
 from unittest.mock import MagicMock
 
 import torch
+from torch import nn
 
 from torchdrive.autograd import (
+    activation_checkpoint,
+    activation_checkpoint_modules,
     autograd_context,
     autograd_optional,
     autograd_pause,
@@ -90,3 +93,52 @@ class TestAutograd(unittest.TestCase):
         b.mean().backward()
         self.assertEquals(writer.add_scalars.call_count, 1)
         self.assertIsNotNone(a.grad)
+
+    def test_activation_checkpoint(self) -> None:
+        def make() -> nn.Module:
+            torch.manual_seed(0)
+            return nn.Sequential(
+                nn.Conv2d(3, 4, 3), nn.BatchNorm2d(4), nn.ReLU(), nn.Conv2d(4, 4, 1)
+            )
+
+        x = torch.rand(2, 3, 8, 8)
+        want_m = make()
+        want = want_m(x)
+        want.sum().backward()
+
+        m = activation_checkpoint(make())
+        self.assertCountEqual(m.state_dict().keys(), want_m.state_dict().keys())
+        out = m(x)
+        torch.testing.assert_close(out, want)
+
+        # the backwards pass is resumed through the checkpointed module
+        paused = autograd_pause(out)
+        paused.sum().backward()
+        self.assertIsNone(m[0].weight.grad)
+        autograd_resume(paused)
+        torch.testing.assert_close(m[0].weight.grad, want_m[0].weight.grad)
+
+        # the recomputation doesn't update the running statistics
+        torch.testing.assert_close(m[1].running_mean, want_m[1].running_mean)
+        self.assertEqual(m[1].num_batches_tracked.item(), 1)
+
+        with torch.no_grad():
+            torch.testing.assert_close(m(x), want_m(x))
+
+    def test_activation_checkpoint_modules(self) -> None:
+        m = nn.Module()
+        m.encoders = nn.ModuleDict(
+            {"left": nn.Linear(2, 2), "right": nn.Sequential(nn.Linear(2, 2))}
+        )
+        m.decoder = nn.Linear(2, 2)
+        m.other = nn.Linear(2, 2)
+        # compile wrapper
+        wrapper = nn.Module()
+        wrapper._orig_mod = m.encoders["right"]
+        m.encoders["right"] = wrapper
+        names = activation_checkpoint_modules(m, ["encoders.*", "decoder"])
+        self.assertCountEqual(names, ["encoders.left", "encoders.right", "decoder"])
+        self.assertNotIn("forward", vars(m.other))
+        self.assertIn("forward", vars(m.decoder))
+        self.assertIn("forward", vars(wrapper._orig_mod))
+        self.assertNotIn("forward", vars(wrapper._orig_mod[0]))
@@ -3,7 +3,7 @@ import unittest
 import torch
 from torch import nn
 
-from torchdrive.checkpoint import remap_state_dict
+from torchdrive.checkpoint import checkpoint_interval, remap_state_dict
 
 
 class DummyModel(nn.Module):
@@ -15,6 +15,13 @@ class DummyModel(nn.Module):
 
 
 class TestCheckpoint(unittest.TestCase):
+    def test_checkpoint_interval(self) -> None:
+        self.assertEqual(checkpoint_interval(2000, 8), 250)
+        self.assertEqual(checkpoint_interval(2000, 8 * 4), 62)
+        # accumulated batches larger than checkpoint_every
+        self.assertEqual(checkpoint_interval(2000, 8 * 256), 1)
+        self.assertEqual(checkpoint_interval(2000, 2000), 1)
+
     def test_remap_state_dict(self) -> None:
         m = DummyModel()
         state_dict = {
@@ -1,5 +1,5 @@
 import unittest
-from dataclasses import replace
+from dataclasses import fields, replace
 
 import torch
 from torch.utils.data import DataLoader, Dataset
@@ -10,6 +10,9 @@ from torchdrive.data import (
     dummy_batch,
     dummy_item,
     nonstrict_collate,
+    packed_collate,
+    PackedBatch,
+    PrefetchCollator,
     TransferCollator,
 )
 
@@ -98,6 +101,138 @@ class TestData(unittest.TestCase):
         for batch in out:
             self.assertEqual(batch.batch_size(), batch_size)
 
+    def test_prefetch_collator(self) -> None:
+        items = [dummy_item() for _ in range(8)]
+        items[2] = None
+        items[3] = replace(items[3], long_cam_T=torch.rand(5, 4, 4))
+        want = [
+            collate(items[0:2]),
+            collate(items[3:5]),
+            collate(items[5:7]),
+        ]
+        dataloader = DataLoader(items, batch_size=None)
+        for host_collate in (False, True):
+            collator = PrefetchCollator(
+                dataloader,
+                batch_size=2,
+                device=torch.device("cpu"),
+                prefetch_depth=1,
+                host_collate=host_collate,
+            )
+            self.assertEqual(len(collator), 4)
+
+            for epoch in range(2):
+                ptrs = []
+                count = 0
+                for batch, target in zip(collator, want):
+                    count += 1
+                    for field in fields(Batch):
+                        torch.testing.assert_close(
+                            getattr(batch, field.name), getattr(target, field.name)
+                        )
+                    ptrs.append(batch.color["left"].data_ptr())
+                self.assertEqual(count, 3)
+                # the buffers are reused
+                self.assertEqual(len(set(ptrs)), 2)
+                self.assertEqual(ptrs[0], ptrs[2])
+
+    def test_prefetch_collator_host_collate(self) -> None:
+        dataloader = DataLoader([dummy_item() for _ in range(2)], batch_size=None)
+        collator = PrefetchCollator(
+            dataloader, batch_size=2, device=torch.device("cpu"), host_collate=True
+        )
+        batch = next(iter(collator))
+        # all cameras share a single buffer per field
+        self.assertEqual(
+            batch.color["left"].untyped_storage().data_ptr(),
+            batch.color["right"].untyped_storage().data_ptr(),
+        )
+        self.assertTrue(batch.color["right"].is_contiguous())
+        host = collator.slots[0].host
+        self.assertNotEqual(
+            host.tensors[("color", "")].data_ptr(),
+            batch.color["left"].untyped_storage().data_ptr(),
+        )
+
+    def test_packed_batch(self) -> None:
+        items = [dummy_item() for _ in range(3)]
+        items[1] = replace(
+            items[1], long_cam_T=torch.rand(5, 4, 4), load_times={"decode": 1.0}
+        )
+        want = collate(items)
+        for batch in (collate(items, packed=True), PackedBatch.pack(want)):
+            self.assertIsInstance(batch, PackedBatch)
+            # float32, bool and int64
+            self.assertEqual(len(batch.buffers), 3)
+            self.assertEqual(batch.batch_size(), 3)
+            self.assertEqual(batch.cameras(), ("left", "right"))
+            self.assertEqual(batch.global_batch_size, 3)
+            self.assertEqual(batch.load_times, {"decode": 1.0})
+            for field in fields(Batch):
+                torch.testing.assert_close(
+                    getattr(batch, field.name), getattr(want, field.name)
+                )
+
+            out = batch.to(torch.device("cpu"))
+            self.assertIsInstance(out, PackedBatch)
+            torch.testing.assert_close(out.color, want.color)
+
+            parts = batch.split(2)
+            self.assertEqual([p.batch_size() for p in parts], [2, 1])
+            for part, want_part in zip(parts, want.split(2)):
+                self.assertIsInstance(part, PackedBatch)
+                self.assertEqual(part.global_batch_size, 3)
+                for field in fields(Batch):
+                    torch.testing.assert_close(
+                        getattr(part, field.name), getattr(want_part, field.name)
+                    )
+            # splits are views
+            buf = batch.buffers[torch.float32]
+            self.assertEqual(
+                parts[1].color["left"].untyped_storage().data_ptr(),
+                buf.untyped_storage().data_ptr(),
+            )
+
+        # replaced batches fall back to the regular Batch methods
+        batch = replace(batch, weight=batch.weight * 2)
+        self.assertIsNone(batch.buffers)
+        self.assertEqual(len(batch.split(1)), 3)
+
+    def test_packed_batch_replace(self) -> None:
+        batch = PackedBatch.pack(dummy_batch())
+        cam_T = batch.cam_T
+        weight = batch.weight * 2
+        out = batch.replace(weight=weight, cam_T=cam_T + 1, global_batch_size=4)
+        self.assertIsInstance(out, PackedBatch)
+        self.assertIsNotNone(out.buffers)
+        self.assertEqual(out.global_batch_size, 4)
+        torch.testing.assert_close(out.weight, weight)
+        torch.testing.assert_close(out.cam_T, cam_T + 1)
+        torch.testing.assert_close(out.color, batch.color)
+        # the original batch isn't modified
+        torch.testing.assert_close(batch.cam_T, cam_T)
+        # buffers without replaced tensors are shared
+        self.assertIs(out.buffers[torch.bool], batch.buffers[torch.bool])
+        self.assertIsNot(out.buffers[torch.float32], batch.buffers[torch.float32])
+
+        # unchanged tensors don't copy
+        out = batch.replace(color=dict(batch.color))
+        self.assertEqual(out.buffers, batch.buffers)
+
+        # different dtypes and shapes fall back to a regular Batch
+        out = batch.replace(cam_T=cam_T.double())
+        self.assertIsNone(out.buffers)
+        out = batch.replace(cam_T=cam_T[:, :1])
+        self.assertIsNone(out.buffers)
+        out = batch.replace(cam_T=cam_T.clone().requires_grad_())
+        self.assertIsNone(out.buffers)
+
+    def test_packed_collate(self) -> None:
+        self.assertIsNone(packed_collate([None, None]))
+        self.assertIsInstance(
+            packed_collate([dummy_item(), dummy_item(), None]), PackedBatch
+        )
+
     def test_world_to_car(self) -> None:
         batch = dummy_batch()
         out = batch.world_to_car(1)
@@ -129,3 +264,31 @@ class TestData(unittest.TestCase):
         out = batch.cam_to_world(cam, frame)
         self.assertEqual(out.shape, (2, 4, 4))
         torch.testing.assert_allclose(out, target)
+
+    def test_load_times(self) -> None:
+        self.assertIsNone(dummy_batch().load_times)
+        a = replace(dummy_item(), load_times={"decode/main": 1.0, "info": 0.5})
+        b = replace(dummy_item(), load_times={"decode/main": 2.0})
+        batch = collate([a, b, dummy_item()])
+        self.assertEqual(batch.load_times, {"decode/main": 3.0, "info": 0.5})
+        for part in batch.split(1):
+            self.assertEqual(part.load_times, batch.load_times)
+        batch = batch.to(torch.device("cpu"))
+        self.assertEqual(batch.load_times, {"decode/main": 3.0, "info": 0.5})
+
+    def test_frame_ids(self) -> None:
+        self.assertIsNone(dummy_batch().frame_ids)
+        items = [
+            replace(dummy_item(), frame_ids=[[("drive", i), ("drive", i + 1)]])
+            for i in range(3)
+        ]
+        for batch in (collate(items), collate(items, packed=True)):
+            self.assertEqual(
+                batch.frame_ids,
+                [[("drive", i), ("drive", i + 1)] for i in range(3)],
+            )
+            a, b = batch.split(2)
+            self.assertEqual(a.frame_ids, batch.frame_ids[:2])
+            self.assertEqual(b.frame_ids, batch.frame_ids[2:])
+            self.assertEqual(batch.to(torch.device("cpu")).frame_ids, batch.frame_ids)
+        self.assertIsNone(collate([items[0], dummy_item()]).frame_ids)
@@ -0,0 +1,51 @@
+import unittest
+
+import torch
+
+from torchdrive.feature_cache import FeatureCache
+
+
+class TestFeatureCache(unittest.TestCase):
+    def test_get_put(self) -> None:
+        cache = FeatureCache(max_bytes=1000)
+        self.assertIsNone(cache.get(("drive", "main", 1), version=0))
+        value = torch.rand(2, 3)
+        cache.put(("drive", "main", 1), version=0, value=value)
+        out = cache.get(("drive", "main", 1), version=0)
+        torch.testing.assert_close(out, value)
+        # copies so views don't keep the batch alive
+        self.assertNotEqual(out.data_ptr(), value.data_ptr())
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.nbytes, 24)
+        self.assertEqual(cache.stats()["hit_rate"], 0.5)
+        self.assertEqual(cache.stats()["hit_rate"], 0.0)
+
+    def test_staleness(self) -> None:
+        cache = FeatureCache(max_bytes=1000, max_staleness=2)
+        cache.put("a", version=1, value=torch.rand(2))
+        self.assertIsNotNone(cache.get("a", version=3))
+        self.assertIsNone(cache.get("a", version=4))
+        # stale entries are dropped
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.nbytes, 0)
+
+    def test_eviction(self) -> None:
+        cache = FeatureCache(max_bytes=32)
+        cache.put("a", version=0, value=torch.rand(4))
+        cache.put("b", version=0, value=torch.rand(4))
+        self.assertIsNotNone(cache.get("a", version=0))
+        cache.put("c", version=0, value=torch.rand(4))
+        # b is the least recently used
+        self.assertIsNone(cache.get("b", version=0))
+        self.assertIsNotNone(cache.get("a", version=0))
+        self.assertIsNotNone(cache.get("c", version=0))
+        self.assertEqual(cache.nbytes, 32)
+
+        # too large to cache
+        cache.put("d", version=0, value=torch.rand(16))
+        self.assertIsNone(cache.get("d", version=0))
+        self.assertEqual(len(cache), 2)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.nbytes, 0)
@@ -1,8 +1,10 @@
 from abc import ABC, abstractmethod
-from dataclasses import replace
 from typing import Tuple
 
+import torch
+
 from torchdrive.data import Batch
+from torchdrive.transforms.img import COLOR_MEAN, COLOR_STD
 from torchdrive.transforms.mat import random_translation, random_z_rotation
 
 
@@ -55,8 +57,7 @@ class NormalizeCarPosition(BatchTransform):
         long_cam_T, long_cam_T_mask, long_cam_T_lengths = batch.long_cam_T
         long_cam_T = inv_start_T.matmul(long_cam_T)
 
-        return replace(
-            batch,
+        return batch.replace(
             cam_T=cam_T,
             long_cam_T=(long_cam_T, long_cam_T_mask, long_cam_T_lengths),
         )
@@ -73,8 +74,7 @@ class RandomRotation(BatchTransform):
         cam_T = batch.cam_T.matmul(rot)
         long_cam_T, long_cam_T_mask, long_cam_T_lengths = batch.long_cam_T
         long_cam_T = long_cam_T.matmul(rot)
-        return replace(
-            batch,
+        return batch.replace(
             cam_T=cam_T,
             long_cam_T=(long_cam_T, long_cam_T_mask, long_cam_T_lengths),
         )
@@ -98,8 +98,34 @@ class RandomTranslation(BatchTransform):
         cam_T = batch.cam_T.matmul(rot)
         long_cam_T, long_cam_T_mask, long_cam_T_lengths = batch.long_cam_T
         long_cam_T = long_cam_T.matmul(rot)
-        return replace(
-            batch,
+        return batch.replace(
             cam_T=cam_T,
             long_cam_T=(long_cam_T, long_cam_T_mask, long_cam_T_lengths),
         )
+
+
+class NormalizeColor(BatchTransform):
+    """
+    NormalizeColor converts uint8 camera frames to dtype and normalizes them
+    the same as normalize01. This lets the dataset ship uint8 frames to the
+    device and normalize there. Frames that aren't uint8 are left unchanged.
+    """
+
+    def __init__(self, dtype: torch.dtype = torch.bfloat16) -> None:
+        self.dtype = dtype
+
+    def __call__(self, batch: Batch) -> Batch:
+        color = {}
+        for cam, frames in batch.color.items():
+            if frames.dtype == torch.uint8:
+                mean = torch.tensor(COLOR_MEAN, device=frames.device)
+                std = torch.tensor(COLOR_STD, device=frames.device)
+                frames = (
+                    frames.float()
+                    .div_(255)
+                    .sub_(mean.view(3, 1, 1))
+                    .div_(std.view(3, 1, 1))
+                    .to(self.dtype)
+                )
+            color[cam] = frames
+        return batch.replace(color=color)
@@ -3,6 +3,10 @@ from typing import Optional
 import torch
 from matplotlib import cm
 
+# per channel mean and std of the 0-1 RGB camera frames, see normalize01
+COLOR_MEAN = (0.3504, 0.4324, 0.2892)
+COLOR_STD = (0.0863, 0.1097, 0.0764)
+
 
 @torch.no_grad()
 def normalize_img_cuda(src: torch.Tensor) -> torch.Tensor:
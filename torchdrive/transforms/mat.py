@@ -83,6 +83,32 @@ def get_translation_matrix(translation_vector: torch.Tensor) -> torch.Tensor:
     return T
 
 
+def cumulative_transform(frame_T: torch.Tensor) -> torch.Tensor:
+    """
+    Composes a sequence of relative transforms into transforms relative to
+    the start of the sequence using a parallel prefix scan. This uses
+    O(log N) batched matmuls instead of N sequential ones.
+
+    Args:
+        frame_T: [N, 4, 4] transform from each frame to the next
+    Returns:
+        [N, 4, 4] where out[0] is the identity and
+        out[i] = frame_T[0] @ ... @ frame_T[i-1]
+    """
+    N = frame_T.shape[0]
+    out = torch.empty_like(frame_T)
+    if N == 0:
+        return out
+    out[0] = torch.eye(4, dtype=frame_T.dtype, device=frame_T.device)
+    out[1:] = frame_T[:-1]
+    # after each step out[i] is the product of the previous 2*shift transforms
+    shift = 1
+    while shift < N:
+        out[shift:] = torch.matmul(out[:-shift], out[shift:])
+        shift *= 2
+    return out
+
+
 def random_z_rotation(batch_size: int, device: torch.device) -> torch.Tensor:
     """
     Returns a transformation matrix that will randomly rotate around the z
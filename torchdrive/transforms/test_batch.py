@@ -9,6 +9,7 @@ from torchdrive.transforms.batch import (
     Compose,
     Identity,
     NormalizeCarPosition,
+    NormalizeColor,
     RandomRotation,
     RandomTranslation,
 )
@@ -64,3 +65,14 @@ class TestBatchTransforms(unittest.TestCase):
         # origin shouldn't change
         zero = torch.tensor((0, 0, 0, 1.0)).expand(2, -1).unsqueeze(-1)
         torch.testing.assert_close(out.cam_T[:, 1].matmul(zero), zero)
+
+    def test_normalize_color(self) -> None:
+        batch = dummy_batch()
+        frames = torch.randint(0, 256, (2, 3, 3, 48, 64), dtype=torch.uint8)
+        batch = replace(batch, color={"left": frames, "right": batch.color["right"]})
+        out = NormalizeColor(dtype=torch.float32)(batch)
+        self.assertEqual(out.color["left"].dtype, torch.float32)
+        self.assertIs(out.color["right"], batch.color["right"])
+        mean = torch.tensor([0.3504, 0.4324, 0.2892]).view(3, 1, 1)
+        std = torch.tensor([0.0863, 0.1097, 0.0764]).view(3, 1, 1)
+        torch.testing.assert_close(out.color["left"], (frames / 255 - mean) / std)
@@ -3,6 +3,7 @@ import unittest
 import torch
 
 from torchdrive.transforms.mat import (
+    cumulative_transform,
     random_translation,
     random_z_rotation,
     transformation_from_parameters,
@@ -28,3 +29,15 @@ class TestMat(unittest.TestCase):
     def test_voxel_to_world(self) -> None:
         out = voxel_to_world((-128, -128, 0), 3, torch.device("cpu"))
         self.assertEqual(out.shape, (1, 4, 4))
+
+    def test_cumulative_transform(self) -> None:
+        for N in [0, 1, 2, 7, 64]:
+            frame_T = transformation_from_parameters(
+                torch.rand(N, 1, 3), torch.rand(N, 1, 3)
+            ).double()
+            want = torch.zeros(N, 4, 4, dtype=torch.float64)
+            if N > 0:
+                want[0] = torch.eye(4)
+            for i in range(1, N):
+                want[i] = want[i - 1].matmul(frame_T[i - 1])
+            torch.testing.assert_close(cumulative_transform(frame_T), want)
@@ -4,7 +4,19 @@ import json
 import os
 import os.path
 from collections import defaultdict
-from typing import Callable, cast, Dict, Iterator, List, Optional, Set, Tuple, Union
+from contextlib import nullcontext
+from typing import (
+    Callable,
+    cast,
+    ContextManager,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 # set device before loading CUDA/PyTorch
 LOCAL_RANK = int(os.environ.get("LOCAL_RANK", 0))
@@ -21,10 +33,17 @@ from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
 from torch.utils.tensorboard import SummaryWriter
 
-from torchdrive.checkpoint import remap_state_dict
-from torchdrive.data import Batch, transfer, TransferCollator
+from torchdrive.autograd import activation_checkpoint_modules
+from torchdrive.checkpoint import checkpoint_interval, remap_state_dict
+from torchdrive.data import Batch, packed_collate, PrefetchCollator, transfer
+from torchdrive.datasets.frame_cache import FrameCache
+from torchdrive.datasets.frame_pool import FramePool, PooledDataset
 from torchdrive.datasets.rice import MultiCamDataset
+from torchdrive.datasets.sampler import LocalitySampler
+from torchdrive.datasets.shard import ShardDataset
+from torchdrive.datasets.window import SlidingWindowDataset
 from torchdrive.dist import run_ddp_concat
+from torchdrive.feature_cache import FeatureCache
 from torchdrive.models.bev_backbone import BEVBackbone
 from torchdrive.tasks.ae import AETask
 from torchdrive.tasks.bev import BEVTask, BEVTaskVan
@@ -33,7 +52,9 @@ from torchdrive.tasks.path import PathTask
 from torchdrive.tasks.voxel import VoxelTask
 from torchdrive.transforms.batch import (
     Compose,
+    Identity,
     NormalizeCarPosition,
+    NormalizeColor,
     RandomRotation,
     RandomTranslation,
 )
@@ -48,6 +69,15 @@ def tuple_int(s: str) -> Tuple[int, ...]:
     return tuple(int(v) for v in s.split(","))
 
 
+# activation checkpointing presets to module name patterns
+CHECKPOINT_MODULES: Dict[str, str] = {
+    "cam_encoder": "camera_encoders.*",
+    "transformer": "backbone.cam_transformers.*",
+    "fpn": "backbone.fpn",
+    "upsampler": "backbone.upsample",
+    "voxel_decoder": "hr_tasks.voxel.decoder",
+}
+
 parser = argparse.ArgumentParser(description="train")
 parser.add_argument("--output", required=True, type=str, default="out")
 parser.add_argument("--load", type=str)
@@ -55,9 +85,120 @@ parser.add_argument("--epochs", type=int, default=20)
 parser.add_argument("--lr", type=float, default=1e-4)
 parser.add_argument("--dataset", type=str, required=True)
 parser.add_argument("--masks", type=str, required=True)
+parser.add_argument(
+    "--shards", type=str, help="use preprocessed shards from preprocess.py instead"
+)
 parser.add_argument("--batch_size", type=int, default=10)
 parser.add_argument("--step_size", type=int, default=15)
 parser.add_argument("--num_workers", type=int, default=16)
+parser.add_argument(
+    "--prefetch_factor",
+    type=int,
+    default=2,
+    help="number of examples loaded in advance by each DataLoader worker",
+)
+parser.add_argument(
+    "--locality_sampler",
+    default=False,
+    action="store_true",
+    help="shuffle chunks of consecutive frames instead of individual examples",
+)
+parser.add_argument(
+    "--sampler_chunk_size",
+    type=int,
+    default=36,
+    help="frames per chunk for --locality_sampler",
+)
+parser.add_argument(
+    "--window_size",
+    type=int,
+    default=0,
+    help="decode runs of frames once and emit this many overlapping examples",
+)
+parser.add_argument(
+    "--window_stride", type=int, default=1, help="frames between window examples"
+)
+parser.add_argument(
+    "--shuffle_buffer",
+    type=int,
+    default=0,
+    help="examples to shuffle across windows with --window_size",
+)
+parser.add_argument(
+    "--num_decode_threads",
+    type=int,
+    default=0,
+    help="threads per worker to decode the cameras of each example in parallel",
+)
+parser.add_argument(
+    "--quarantine_file",
+    type=str,
+    help="file to record examples that fail to load in and skip them",
+)
+parser.add_argument(
+    "--replace_failed",
+    type=int,
+    default=0,
+    help="nearby examples to try in place of one that fails to load",
+)
+parser.add_argument(
+    "--stage_timing",
+    default=False,
+    action="store_true",
+    help="log the per stage data loading times",
+)
+parser.add_argument(
+    "--frame_cache_dir", type=str, help="directory to cache decoded frames in"
+)
+parser.add_argument(
+    "--frame_cache_size", type=float, default=100, help="frame cache size in GB"
+)
+parser.add_argument(
+    "--calibration_cache_dir",
+    type=str,
+    help="directory to persist the camera undistortion maps in",
+)
+parser.add_argument(
+    "--index_cache_dir",
+    type=str,
+    help="directory to cache the dataset index in",
+)
+parser.add_argument(
+    "--batch_remap",
+    default=False,
+    action="store_true",
+    help="decode and remap frames as uint8 and normalize once per camera",
+)
+parser.add_argument(
+    "--uint8_color",
+    default=False,
+    action="store_true",
+    help="load frames as uint8 and normalize them on device",
+)
+parser.add_argument(
+    "--prefetch_depth",
+    type=int,
+    default=2,
+    help="number of batches to collate on device ahead of the current one",
+)
+parser.add_argument(
+    "--host_collate",
+    default=False,
+    action="store_true",
+    help="collate batches into pinned host buffers and copy each field at once",
+)
+parser.add_argument(
+    "--packed_batches",
+    default=False,
+    action="store_true",
+    help="collate in the DataLoader workers into packed per dtype buffers",
+)
+parser.add_argument(
+    "--frame_pool_slots",
+    type=int,
+    default=0,
+    help="return frames from the workers through this many shared memory slots",
+)
 parser.add_argument(
     "--cameras",
     default="main,narrow,fisheye,leftpillar,rightpillar,leftrepeater,rightrepeater,backup",
@@ -74,8 +215,45 @@ parser.add_argument("--skip_load_optim", default=False, action="store_true")
 parser.add_argument("--anomaly-detection", default=False, action="store_true")
 parser.add_argument("--limit_size", type=int)
 parser.add_argument("--grad_clip", type=float, default=1.0)
+parser.add_argument(
+    "--grad_accum_steps",
+    type=int,
+    default=1,
+    help="number of micro-batches of batch_size per optimizer step",
+)
 parser.add_argument("--checkpoint_every", type=int, default=2000)
 parser.add_argument("--num_encode_frames", type=int, default=3)
+parser.add_argument(
+    "--encoder_batching",
+    type=str,
+    default="none",
+    choices=("none", "frames", "cameras"),
+    help="batch the camera encoder calls across frames and cameras",
+)
+parser.add_argument(
+    "--checkpoint_modules",
+    type=tuple_str,
+    default=(),
+    help=f"activation checkpoint these modules: {','.join(CHECKPOINT_MODULES)}",
+)
+parser.add_argument(
+    "--concurrent_tasks",
+    default=False,
+    action="store_true",
+    help="run the task heads concurrently on separate CUDA streams",
+)
+parser.add_argument(
+    "--feature_cache_mb",
+    type=int,
+    default=0,
+    help="cache the encoder outputs of the non-backprop frames, 0 disables",
+)
+parser.add_argument(
+    "--feature_cache_staleness",
+    type=int,
+    default=0,
+    help="number of steps cached encoder outputs can be reused for",
+)
 parser.add_argument("--profile", default=False, action="store_true")
 parser.add_argument(
     "--grad_sizes", default=False, action="store_true", help="log grad sizes"
@@ -112,6 +290,12 @@ device = torch.device(device_id)
 torch.set_float32_matmul_precision("high")
 
 BS: int = args.batch_size
+GRAD_ACCUM_STEPS: int = args.grad_accum_steps
+assert GRAD_ACCUM_STEPS >= 1
+# examples per optimizer step
+GLOBAL_BS: int = BS * GRAD_ACCUM_STEPS
+# optimizer steps between checkpoints
+CHECKPOINT_INTERVAL: int = checkpoint_interval(args.checkpoint_every, GLOBAL_BS)
 NUM_EPOCHS: int = args.epochs
 
 if RANK == 0:
@@ -131,38 +315,131 @@ if RANK == 0:
 else:
     writer = None
 
+frame_cache: Optional[FrameCache] = None
+if args.frame_cache_dir:
+    frame_cache = FrameCache(
+        args.frame_cache_dir, max_bytes=int(args.frame_cache_size * 2**30)
+    )
 
-dataset = MultiCamDataset(
-    index_file=args.dataset,
-    mask_dir=args.masks,
-    cameras=args.cameras,
-    dynamic=True,
-    cam_shape=args.cam_shape,
-    # 3 encode frames, 3 decode frames, overlap last frame
-    nframes_per_point=args.num_encode_frames + 2,
-    limit_size=args.limit_size,
-)
+if args.shards:
+    dataset: Union[MultiCamDataset, ShardDataset] = ShardDataset(
+        shard_dir=args.shards,
+        cameras=args.cameras,
+        nframes_per_point=args.num_encode_frames + 2,
+        limit_size=args.limit_size,
+        uint8_color=args.uint8_color,
+    )
+else:
+    dataset = MultiCamDataset(
+        index_file=args.dataset,
+        mask_dir=args.masks,
+        cameras=args.cameras,
+        dynamic=True,
+        cam_shape=args.cam_shape,
+        # 3 encode frames, 3 decode frames, overlap last frame
+        nframes_per_point=args.num_encode_frames + 2,
+        limit_size=args.limit_size,
+        frame_cache=frame_cache,
+        calibration_cache_dir=args.calibration_cache_dir,
+        batch_remap=args.batch_remap,
+        index_cache_dir=args.index_cache_dir,
+        num_decode_threads=args.num_decode_threads,
+        stage_timing=args.stage_timing,
+        quarantine_file=args.quarantine_file,
+        replace_failed=args.replace_failed,
+        uint8_color=args.uint8_color,
+    )
 if RANK == 0:
     print(f"trainset size {len(dataset)}")
 
-sampler: DistributedSampler[MultiCamDataset] = DistributedSampler(
-    dataset,
-    num_replicas=WORLD_SIZE,
-    rank=RANK,
-    shuffle=True,
-    drop_last=True,
-    seed=binascii.crc32((args.load or args.output).encode("utf-8")),
-)
-dataloader = DataLoader[Batch](
-    dataset,
-    batch_size=None,
-    num_workers=args.num_workers,
-    # drop_last=True,
-    # collate_fn=nonstrict_collate,
-    pin_memory=True,
-    sampler=sampler,
-)
-collator = TransferCollator(dataloader, batch_size=args.batch_size, device=device)
+seed: int = binascii.crc32((args.load or args.output).encode("utf-8"))
+train_data: Union[MultiCamDataset, ShardDataset, SlidingWindowDataset, PooledDataset]
+sampler: Optional[Union[LocalitySampler, DistributedSampler[MultiCamDataset]]]
+if args.window_size > 0:
+    assert isinstance(dataset, MultiCamDataset), "windows require MultiCamDataset"
+    train_data = SlidingWindowDataset(
+        dataset,
+        window_size=args.window_size,
+        stride=args.window_stride,
+        shuffle_buffer=args.shuffle_buffer,
+        seed=seed,
+        num_replicas=WORLD_SIZE,
+        rank=RANK,
+        num_workers=args.num_workers,
+    )
+    sampler = None
+elif args.locality_sampler:
+    train_data = dataset
+    sampler = LocalitySampler(
+        dataset.frames,
+        num_replicas=WORLD_SIZE,
+        rank=RANK,
+        seed=seed,
+        chunk_size=args.sampler_chunk_size,
+        num_workers=args.num_workers,
+        # packed batches are collated in the workers
+        batch_size=args.batch_size if args.packed_batches else 1,
+    )
+else:
+    train_data = dataset
+    sampler = DistributedSampler(
+        dataset,
+        num_replicas=WORLD_SIZE,
+        rank=RANK,
+        shuffle=True,
+        drop_last=True,
+        seed=seed,
+    )
+# prefetch_factor can only be set with worker processes
+PREFETCH_FACTOR: Optional[int] = args.prefetch_factor if args.num_workers > 0 else None
+# host_collate copies the examples into its own pinned buffers so pinning them
+# in the DataLoader would copy them twice
+PIN_MEMORY: bool = not args.host_collate
+
+frame_pool: Optional[FramePool] = None
+if args.frame_pool_slots > 0:
+    assert args.window_size == 0, "frame pool doesn't support windows"
+    assert args.frame_pool_slots >= FramePool.slots_needed(
+        args.num_workers, args.prefetch_factor, pin_memory=PIN_MEMORY
+    ), "frame pool needs a slot for each example in flight"
+    frame_pool = FramePool(
+        args.frame_pool_slots,
+        {cam: (args.num_encode_frames + 2, 3, *args.cam_shape) for cam in args.cameras},
+        torch.uint8 if args.uint8_color else torch.bfloat16,
+    )
+    train_data = PooledDataset(train_data, frame_pool)
+
+if args.packed_batches:
+    assert args.frame_pool_slots == 0, "packed batches don't support the frame pool"
+    # collate in the workers so each batch is a few large tensors
+    collator: Union[DataLoader[Batch], PrefetchCollator] = DataLoader[Batch](
+        train_data,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        drop_last=True,
+        collate_fn=packed_collate,
+        pin_memory=True,
+        sampler=sampler,
+        prefetch_factor=PREFETCH_FACTOR,
+    )
+else:
+    dataloader = DataLoader[Batch](
+        train_data,
+        batch_size=None,
+        num_workers=args.num_workers,
+        # drop_last=True,
+        # collate_fn=nonstrict_collate,
+        pin_memory=PIN_MEMORY,
+        sampler=sampler,
+        prefetch_factor=PREFETCH_FACTOR,
+    )
+    collator = PrefetchCollator(
+        dataloader,
+        batch_size=args.batch_size,
+        device=device,
+        prefetch_depth=args.prefetch_depth,
+        host_collate=args.host_collate,
+    )
 
 if args.anomaly_detection:
     torch.set_anomaly_enabled(True)
@@ -296,7 +573,7 @@ if args.voxel:
         z_offset=0.4,
         device=device,
         semantic=args.voxelsem,
-        camera_overlap=dataset.CAMERA_OVERLAP,
+        camera_overlap=MultiCamDataset.CAMERA_OVERLAP,
         compile_fn=compile_fn,
     )
 
@@ -312,15 +589,39 @@ model = BEVTaskVan(
     output=args.output,
     compile_fn=compile_fn,
     num_encode_frames=args.num_encode_frames,
+    encoder_batching=args.encoder_batching,
+    concurrent_tasks=args.concurrent_tasks,
+    feature_cache=(
+        FeatureCache(
+            max_bytes=args.feature_cache_mb * 2**20,
+            max_staleness=args.feature_cache_staleness,
+        )
+        if args.feature_cache_mb > 0
+        else None
+    ),
     backbone=backbone,
     cam_encoder=cam_encoder,
     transform=Compose(
+        NormalizeColor() if args.uint8_color else Identity(),
         NormalizeCarPosition(start_frame=args.num_encode_frames - 1),
         RandomRotation(),
         RandomTranslation(distances=(5.0, 5.0, 0.0)),
     ),
 )
 
+if args.checkpoint_modules:
+    for name in args.checkpoint_modules:
+        assert name in CHECKPOINT_MODULES, f"unknown checkpoint module {name}"
+    # checkpoint doesn't support running inside vmap
+    assert (
+        "cam_encoder" not in args.checkpoint_modules
+        or args.encoder_batching != "cameras"
+    ), "can't checkpoint cam_encoder with --encoder_batching cameras"
+    checkpointed = activation_checkpoint_modules(
+        model, [CHECKPOINT_MODULES[name] for name in args.checkpoint_modules]
+    )
+    print(f"activation checkpointing: {checkpointed}")
+
 model = model.to(device)
 if False and WORLD_SIZE > 1:
     ddp_model: torch.nn.Module = DistributedDataParallel(
@@ -428,6 +729,16 @@ for epoch in range(NUM_EPOCHS):
 
     batch_idx = 0
     epoch_loss = 0
+    # partially accumulated steps at the end of an epoch are discarded
+    micro_batch = 0
+
+    if sampler is not None:
+        sampler.set_epoch(epoch)
+    if isinstance(train_data, SlidingWindowDataset):
+        train_data.set_epoch(epoch)
+    if frame_pool is not None:
+        # reclaim any slots lost when the previous epoch's workers exited
+        frame_pool.reset()
 
     reset_metrics()
 
@@ -448,15 +759,42 @@ for epoch in range(NUM_EPOCHS):
             continue
 
         batch = batch.to(device)
+        if GRAD_ACCUM_STEPS > 1:
+            # the weights of each micro-batch sum to 1, rescale them so the
+            # accumulated gradient is the mean over the global batch
+            batch = batch.replace(
+                weight=batch.weight / GRAD_ACCUM_STEPS,
+                global_batch_size=batch.global_batch_size * GRAD_ACCUM_STEPS,
+            )
+
+        first_micro_batch = micro_batch == 0
+        last_micro_batch = micro_batch == GRAD_ACCUM_STEPS - 1
+        micro_batch = 0 if last_micro_batch else micro_batch + 1
+
+        if first_micro_batch:
+            log_img, log_text = model.should_log(global_step, GLOBAL_BS)
+            optimizer.zero_grad(set_to_none=True)
+            step_losses = defaultdict[str, Union[float, torch.Tensor]](lambda: 0.0)
+
+        if not last_micro_batch and isinstance(ddp_model, DistributedDataParallel):
+            sync_ctx: ContextManager[object] = ddp_model.no_sync()
+        else:
+            sync_ctx = nullcontext()
+        with sync_ctx:
+            micro_losses = ddp_model(batch, global_step, scaler, log=first_micro_batch)
+        # the losses are weighted and the metrics scaled by the model so the
+        # sum is the mean over the global batch
+        for k, v in micro_losses.items():
+            step_losses[k] += v
+
+        if not last_micro_batch:
+            continue
 
-        log_img, log_text = model.should_log(global_step, BS)
-
-        optimizer.zero_grad(set_to_none=True)
-
-        losses = ddp_model(batch, global_step, scaler)
+        losses = cast(Dict[str, torch.Tensor], step_losses)
         loss: torch.Tensor = cast(torch.Tensor, sum(losses.values()))
         assert not loss.requires_grad
 
+        # only all reduce the gradients once they're fully accumulated
         run_ddp_concat(model.parameters())
 
         if scaler:
@@ -514,7 +852,7 @@ for epoch in range(NUM_EPOCHS):
                     print(f"- {k}: {v.item()}")
                 print(f"= {loss.item()}")
 
-            if global_step > 0 and (global_step % (args.checkpoint_every // BS)) == 0:
+            if global_step > 0 and (global_step % CHECKPOINT_INTERVAL) == 0:
                 save(epoch)
 
             batch_idx += 1